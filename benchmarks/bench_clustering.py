@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Leader clustering with and without lower-bound pruning, on a synthetic
+docking run: a flexible, drug-sized ligand whose poses fall around a few
+binding modes inside a pocket, plus a share of unconverged, scattered poses.
+Both must produce the very same clusters. Superposed RMSDs are never
+pruned, so both timings should match for them.
+
+    python benchmarks/bench_clustering.py [n_poses] [n_atoms]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gaudiview.clustering import leader_clustering
+
+MODES = 12
+CONFORMERS = 30
+SCATTERED = 0.3
+POCKET = 6.0  # Angstrom
+
+
+def rotation(rng, max_angle=np.pi):
+    axis = rng.normal(size=3)
+    axis /= np.linalg.norm(axis)
+    angle = rng.uniform(0, max_angle)
+    x, y, z = axis
+    k = np.array([[0, -z, y], [z, 0, -x], [-y, x, 0]])
+    return np.eye(3) + np.sin(angle) * k + (1 - np.cos(angle)) * k.dot(k)
+
+
+def ligand(rng, n_atoms):
+    # A random walk with bond-like steps, folded around its centroid
+    steps = rng.normal(size=(n_atoms, 3))
+    steps *= 1.5 / np.linalg.norm(steps, axis=1)[:, np.newaxis]
+    xyz = np.cumsum(steps, axis=0)
+    return xyz - xyz.mean(axis=0)
+
+
+def conformer(rng, xyz):
+    # Rotate the tail of the chain around a random bond, like a torsion
+    pivot = rng.randint(1, len(xyz) - 2)
+    axis = xyz[pivot + 1] - xyz[pivot]
+    axis /= np.linalg.norm(axis)
+    x, y, z = axis
+    k = np.array([[0, -z, y], [z, 0, -x], [-y, x, 0]])
+    angle = rng.uniform(-np.pi, np.pi)
+    rot = np.eye(3) + np.sin(angle) * k + (1 - np.cos(angle)) * k.dot(k)
+    moved = xyz.copy()
+    moved[pivot + 1:] = (xyz[pivot + 1:] - xyz[pivot]).dot(rot.T) + xyz[pivot]
+    return moved - moved.mean(axis=0)
+
+
+def docking_run(n_poses, n_atoms, seed=0):
+    rng = np.random.RandomState(seed)
+    conformers = [ligand(rng, n_atoms)]
+    for _ in range(CONFORMERS - 1):
+        conformers.append(conformer(rng, conformers[rng.randint(len(conformers))]))
+    modes = [(conformers[rng.randint(CONFORMERS)], rotation(rng),
+              rng.uniform(-POCKET, POCKET, 3)) for _ in range(MODES)]
+    weights = rng.dirichlet(np.ones(MODES))
+    solutions = []
+    for i in range(n_poses):
+        if rng.uniform() < SCATTERED:
+            reference = conformers[rng.randint(CONFORMERS)]
+            rot, shift = rotation(rng), rng.uniform(-POCKET, POCKET, 3)
+        else:
+            reference, rot, shift = modes[rng.choice(MODES, p=weights)]
+            rot = rot.dot(rotation(rng, max_angle=0.35))
+            shift = shift + rng.normal(scale=0.7, size=3)
+        xyz = reference.dot(rot.T) + shift + rng.normal(scale=0.25, size=(n_atoms, 3))
+        solutions.append(('solution_{:06d}'.format(i), 'ligand', xyz))
+    return solutions
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - t0, result
+
+
+def main(n_poses, n_atoms):
+    solutions = docking_run(n_poses, n_atoms)
+    print('{} poses of {} heavy atoms'.format(n_poses, n_atoms))
+    print('{:>10} {:>8} {:>10} {:>12} {:>12} {:>8}'.format(
+        'rmsd', 'cutoff', 'clusters', 'full (s)', 'pruned (s)', 'speedup'))
+    for superpose in (False, True):
+        for cutoff in (1.0, 2.0, 3.0):
+            full, expected = timeit(leader_clustering, solutions, cutoff,
+                                    superpose=superpose, prune=False)
+            pruned, clusters = timeit(leader_clustering, solutions, cutoff,
+                                      superpose=superpose, prune=True)
+            assert clusters == expected, 'Pruning changed the clusters'
+            print('{:>10} {:>8.1f} {:>10} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+                'superposed' if superpose else 'in place', cutoff, len(clusters),
+                full, pruned, full / pruned))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if sys.argv[1:] else 10000,
+         int(sys.argv[2]) if sys.argv[2:] else 35)
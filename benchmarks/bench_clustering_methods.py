@@ -0,0 +1,225 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Checks and timings of the clustering code that has no simpler
+reference in the package, on the synthetic docking run of
+bench_clustering.py:
+
+- Average linkage and DBSCAN on a neighbour list, against naive
+  implementations on the full RMSD matrix, also when everything ends
+  up in a single cluster.
+- ClusteringJob, with one and several workers, against the sequential
+  leader_clustering.
+- The automorphisms of benzoate (4: ring flip times carboxylate flip)
+  and the symmetry-corrected RMSD of a pose with its oxygens swapped.
+
+    python benchmarks/bench_clustering_methods.py [n_poses] [n_atoms]
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_clustering import docking_run, timeit
+from gaudiview.clustering import (ClusteringJob, MIN_SAMPLES, average_linkage_from_neighbours,
+                                  dbscan_from_neighbours, leader_clustering)
+from gaudiview.coords import read_solution
+from gaudiview.neighbours import NeighbourList
+from gaudiview.rmsd import rmsd_many_to_many
+from gaudiview.symmetry import automorphisms, symmetry_of
+
+ATOM = '{0:>7d} C{0:<6d} {1:>9.4f} {2:>9.4f} {3:>9.4f} C.3     1  LIG1       0.0000\n'
+
+
+def write_mol2(path, xyz):
+    with open(path, 'w') as f:
+        f.write('@<TRIPOS>MOLECULE\nligand\n{} 0 1 0 0\nSMALL\nNO_CHARGES\n\n'.format(len(xyz)))
+        f.write('@<TRIPOS>ATOM\n')
+        for i, (x, y, z) in enumerate(xyz, 1):
+            f.write(ATOM.format(i, x, y, z))
+
+
+def naive_average_linkage(rmsds, cutoff):
+    """
+    Merge the two closest clusters, one pair at a time, while their
+    average RMSD is below `cutoff`. Returns the clusters as sets of rows.
+    """
+    clusters = [set([i]) for i in range(len(rmsds))]
+    sums = rmsds.astype(float).copy()
+    np.fill_diagonal(sums, np.inf)
+    sizes = np.ones(len(rmsds))
+    while len(clusters) > 1:
+        average = sums / np.outer(sizes, sizes)
+        i, j = np.unravel_index(np.argmin(average), average.shape)
+        if average[i, j] >= cutoff:
+            break
+        i, j = min(i, j), max(i, j)
+        clusters[i] |= clusters.pop(j)
+        sums[i] += sums[j]
+        sums[:, i] += sums[:, j]
+        sums[i, i] = np.inf
+        sums = np.delete(np.delete(sums, j, axis=0), j, axis=1)
+        sizes[i] += sizes[j]
+        sizes = np.delete(sizes, j)
+    return clusters
+
+
+def naive_dbscan(rmsds, cutoff, min_samples=MIN_SAMPLES):
+    """
+    DBSCAN as documented in dbscan_from_neighbours, on the full matrix.
+    """
+    n = len(rmsds)
+    close = (rmsds < cutoff) & ~np.eye(n, dtype=bool)
+    core = close.sum(axis=1) + 1 >= min_samples
+    labels = -np.ones(n, dtype=int)
+    for start in np.flatnonzero(core):
+        if labels[start] >= 0:
+            continue
+        labels[start], stack = start, [start]
+        while stack:
+            i = stack.pop()
+            for j in np.flatnonzero(close[i] & core):
+                if labels[j] < 0:
+                    labels[j] = start
+                    stack.append(j)
+    clusters = {}
+    for i in range(n):
+        if not core[i]:
+            cores = np.flatnonzero(close[i] & core)
+            if len(cores):  # the closest core pose, the first one if tied
+                labels[i] = labels[cores[np.lexsort((cores, rmsds[i, cores]))[0]]]
+        clusters.setdefault(labels[i] if labels[i] >= 0 else n + i, set()).add(i)
+    return list(clusters.values())
+
+
+def members(keys, clusters):
+    index = dict((key, i) for (i, key) in enumerate(keys))
+    return sorted(sorted(index[key] for (key, rmsd) in cluster) for cluster in clusters)
+
+
+def check_single_cluster(solutions):
+    """
+    Everything ends up in one cluster: two close poses, merged in the
+    first round, and a whole run with a cutoff above any RMSD.
+    """
+    keys = ['a', 'b']
+    pair = NeighbourList.from_pairs(keys, [(np.array([0]), np.array([1]),
+                                            np.array([0.5]))], 1.0, None)
+    assert members(keys, average_linkage_from_neighbours(keys, pair, 1.0)) == [[0, 1]]
+    assert members(keys, dbscan_from_neighbours(keys, pair, 1.0, min_samples=2)) == [[0, 1]]
+    poses = np.array([xyz for (key, signature, xyz) in solutions])
+    cutoff = rmsd_many_to_many(poses).max() + 1
+    clusters = check_methods(solutions, cutoff)
+    assert len(clusters) == 1, 'Average linkage left {} clusters'.format(len(clusters))
+
+
+def check_methods(solutions, cutoff):
+    keys = [key for (key, signature, xyz) in solutions]
+    poses = np.array([xyz for (key, signature, xyz) in solutions])
+    rmsds = rmsd_many_to_many(poses)
+    first, second = np.triu_indices(len(poses), k=1)
+    # Every pair, so averages do not depend on the radius
+    full = NeighbourList.from_pairs(keys, [(first, second, rmsds[first, second])],
+                                    rmsds.max() + 1, None)
+    elapsed, clusters = timeit(average_linkage_from_neighbours, keys, full, cutoff)
+    naive_elapsed, expected = timeit(naive_average_linkage, rmsds, cutoff)
+    assert members(keys, clusters) == sorted(sorted(c) for c in expected), \
+        'Average linkage differs from the naive implementation'
+    print('{:>16} {:>10} {:>12.3f} {:>12.3f}'.format('average linkage', len(clusters),
+                                                     elapsed, naive_elapsed))
+    linkage = clusters
+    # DBSCAN only needs the pairs within the cutoff
+    within = rmsds[first, second] < cutoff
+    sparse = NeighbourList.from_pairs(
+        keys, [(first[within], second[within], rmsds[first, second][within])], cutoff, None)
+    elapsed, clusters = timeit(dbscan_from_neighbours, keys, sparse, cutoff)
+    naive_elapsed, expected = timeit(naive_dbscan, rmsds, cutoff)
+    assert members(keys, clusters) == sorted(sorted(c) for c in expected), \
+        'DBSCAN differs from the naive implementation'
+    print('{:>16} {:>10} {:>12.3f} {:>12.3f}'.format('DBSCAN', len(clusters),
+                                                     elapsed, naive_elapsed))
+    return linkage
+
+
+def run_job(keys, paths, cutoff, **kwargs):
+    job = ClusteringJob(keys, paths, cutoff, **kwargs)
+    while not job.poll():
+        time.sleep(0.001)
+    return job.clusters
+
+
+def check_jobs(solutions, cutoff):
+    tmpdir = tempfile.mkdtemp('gaudiview-bench')
+    try:
+        keys, paths = [], []
+        for key, signature, xyz in solutions:
+            keys.append(key)
+            paths.append(os.path.join(tmpdir, key + '.mol2'))
+            write_mol2(paths[-1], xyz)
+        # As read back from the files, rounded like the job will see them
+        solutions = [(key, structure.signature, structure.heavy_coords())
+                     for (key, structure) in zip(keys, map(read_solution, paths))]
+        for superpose in (False, True):
+            elapsed, expected = timeit(leader_clustering, solutions, cutoff,
+                                       superpose=superpose)
+            timings = []
+            for workers in (1, 3):
+                job_elapsed, clusters = timeit(run_job, keys, paths, cutoff,
+                                               superpose=superpose, workers=workers)
+                assert clusters == expected, 'ClusteringJob differs from leader_clustering'
+                timings.append(job_elapsed)
+            print('{:>10} {:>10} {:>12.3f} {:>12.3f} {:>12.3f}'.format(
+                'superposed' if superpose else 'in place', len(expected), elapsed, *timings))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def check_symmetry():
+    # Benzoate: ring carbons 0-5, carboxylate carbon 6 and oxygens 7, 8
+    elements = ['C'] * 7 + ['O'] * 2
+    bonds = [(i, (i + 1) % 6) for i in range(6)] + [(0, 6), (6, 7), (6, 8)]
+    permutations = automorphisms(elements, bonds)
+    assert len(permutations) == 4, 'Benzoate has 4 automorphisms, not {}'.format(
+        len(permutations))
+    angles = np.arange(6) * np.pi / 3
+    xyz = np.zeros((9, 3))
+    xyz[:6, 0], xyz[:6, 1] = 1.4 * np.cos(angles), 1.4 * np.sin(angles)
+    xyz[6:] = [[2.9, 0, 0], [3.5, 1.1, 0], [3.5, -1.1, 0]]
+    swapped = xyz[[0, 1, 2, 3, 4, 5, 6, 8, 7]]
+    symmetry = symmetry_of(elements, bonds)
+    plain = rmsd_many_to_many(xyz[np.newaxis], swapped[np.newaxis])[0, 0]
+    corrected = symmetry.rmsd_pairs(xyz[np.newaxis], swapped[np.newaxis])[0]
+    assert plain > 0.5 and corrected < 1e-6, 'Swapped oxygens are not equivalent'
+    print('benzoate: {} automorphisms, RMSD {:.3f} -> {:.3f} with symmetry'.format(
+        len(permutations), plain, corrected))
+
+
+def main(n_poses, n_atoms, cutoff=2.0):
+    solutions = docking_run(n_poses, n_atoms)
+    print('{} poses of {} heavy atoms, cutoff {}'.format(n_poses, n_atoms, cutoff))
+    print('{:>16} {:>10} {:>12} {:>12}'.format('method', 'clusters', 'sparse (s)', 'naive (s)'))
+    check_methods(solutions, cutoff)
+    check_single_cluster(solutions[:200])
+    print('{:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+        'rmsd', 'clusters', 'leader (s)', '1 worker (s)', '3 workers (s)'))
+    check_jobs(solutions, cutoff)
+    check_symmetry()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if sys.argv[1:] else 500,
+         int(sys.argv[2]) if sys.argv[2:] else 35)
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+DBSCAN and average linkage in ClusteringJob on a large synthetic docking
+run (see bench_clustering.py), with the pair limit of the GUI: DBSCAN
+clusters the pairs as they are found, and average linkage keeps them
+only while it runs. Prints the time and the peak memory of each, and
+checks the streamed DBSCAN against dbscan_from_neighbours.
+
+    python benchmarks/bench_clustering_scale.py [n_poses] [n_atoms] [workers]
+"""
+
+from __future__ import print_function
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_clustering import docking_run, timeit
+from bench_clustering_methods import members, write_mol2
+from gaudiview.clustering import ClusteringJob, dbscan_from_neighbours
+
+#: CLUSTER_CACHE_PAIRS of the GUI
+MAX_PAIRS = 2000000
+
+
+def peak_memory():
+    # In MB: the largest of this process and of its finished workers
+    usage = [resource.getrusage(who).ru_maxrss for who in
+             (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return max(usage) / 1024.0
+
+
+def finish(job):
+    while not job.poll():
+        time.sleep(0.01)
+    return job.clusters
+
+
+def main(n_poses, n_atoms, workers=None, cutoff=2.0):
+    solutions = docking_run(n_poses, n_atoms)
+    tmpdir = tempfile.mkdtemp('gaudiview-bench')
+    try:
+        keys, paths = [], []
+        for key, signature, xyz in solutions:
+            keys.append(key)
+            paths.append(os.path.join(tmpdir, key + '.mol2'))
+            write_mol2(paths[-1], xyz)
+        del solutions
+        print('{} poses of {} heavy atoms, cutoff {}, at most {} pairs kept'.format(
+            n_poses, n_atoms, cutoff, MAX_PAIRS))
+        print('{:>16} {:>10} {:>12} {:>12} {:>14}'.format(
+            'method', 'clusters', 'pairs', 'time (s)', 'peak (MB)'))
+        results = {}
+        for method in ('DBSCAN', 'Average linkage'):
+            job = ClusteringJob(keys, paths, cutoff, workers=workers, radius=cutoff,
+                                method=method, max_pairs=MAX_PAIRS)
+            elapsed, clusters = timeit(finish, job)
+            results[method] = clusters
+            print('{:>16} {:>10} {:>12} {:>12.1f} {:>14.0f}'.format(
+                method, len(clusters), 'not kept' if job.neighbours is None else
+                job.neighbours.pairs, elapsed, peak_memory()))
+        # Every pair within the cutoff, kept this time, as a reference
+        job = ClusteringJob(keys, paths, cutoff, workers=workers, radius=cutoff,
+                            method='Leader')
+        finish(job)
+        expected = dbscan_from_neighbours(keys, job.neighbours, cutoff)
+        assert members(keys, results['DBSCAN']) == members(keys, expected), \
+            'Streamed DBSCAN differs from dbscan_from_neighbours'
+        print('{} pairs within the cutoff; streamed DBSCAN checked'.format(job.neighbours.pairs))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if sys.argv[1:] else 50000,
+         int(sys.argv[2]) if sys.argv[2:] else 35,
+         int(sys.argv[3]) if sys.argv[3:] else None)
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Time 5-clause filters over a synthetic results table, comparing the
+column mask engine against a row-by-row evaluation like tkintertable's
+``filterBy`` + ``doFiltering``. The first set mixes AND, OR and NOT;
+the second one only uses AND, so it goes through the range index.
+
+    python benchmarks/bench_filters.py [n_rows]
+"""
+
+from __future__ import print_function
+from collections import OrderedDict
+import operator
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+from gaudiview.columns import ColumnStore, filter_mask
+
+FILTERS = {'mixed': [('Vina', '-8', '<', 'AND'),
+                     ('Clashes', '5', '<', 'AND'),
+                     ('HBonds', '2', '>=', 'AND'),
+                     ('Filename', '_000', 'contains', 'OR'),
+                     ('Clashes', '0', '=', 'NOT')],
+           'AND only': [('Vina', '-8', '<', 'AND'),
+                        ('Clashes', '5', '<', 'AND'),
+                        ('HBonds', '2', '>=', 'AND'),
+                        ('Filename', '5', 'contains', 'AND'),
+                        ('Vina', '-11.5', '>', 'AND')]}
+OPS = {'=': operator.eq, '>': operator.gt, '<': operator.lt,
+       '>=': operator.ge, '<=': operator.le}
+
+
+def make_store(n):
+    rng = np.random.RandomState(0)
+    keys = ['gaudi_{:07d}.zip'.format(i) for i in range(n)]
+    columns = OrderedDict([('Filename', keys),
+                           ('Vina', rng.uniform(-12, 0, n)),
+                           ('Clashes', rng.randint(0, 20, n).astype(float)),
+                           ('HBonds', rng.randint(0, 6, n).astype(float))])
+    return ColumnStore(keys, columns, kinds={'Filename': 'text'})
+
+
+def filter_rows(store, filters):
+    sets = []
+    for column, value, op, boolean in filters:
+        names = set()
+        for key in store:
+            item = store[key][column]
+            if op == 'contains':
+                if value in str(item):
+                    names.add(key)
+            elif OPS[op](float(item), float(value)):
+                names.add(key)
+        sets.append((names, boolean))
+    names = sets[0][0]
+    for other, boolean in sets[1:]:
+        if boolean == 'AND':
+            names = names & other
+        elif boolean == 'OR':
+            names = names | other
+        else:
+            names = names - other
+    return names
+
+
+def main(n):
+    store = make_store(n)
+    for label, filters in FILTERS.items():
+        t0 = time.time()
+        mask = filter_mask(store, filters)
+        cold = time.time() - t0
+        t0 = time.time()
+        mask = filter_mask(store, filters)
+        warm = time.time() - t0
+        print('{}: {} rows, {} matches'.format(label, n, np.count_nonzero(mask)))
+        print('  masks, first run:  {:8.1f} ms'.format(cold * 1000))
+        print('  masks, next runs:  {:8.1f} ms'.format(warm * 1000))
+        if n <= 200000:
+            t0 = time.time()
+            names = filter_rows(store, filters)
+            print('  row by row:        {:8.1f} ms'.format((time.time() - t0) * 1000))
+            assert names == set(store.key_at(i) for i in np.flatnonzero(mask))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if sys.argv[1:] else 100000)
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Compare the specialized GaudiMM output parser against plain PyYaml
+on synthetic ``*.gaudi-output`` files.
+
+    python benchmarks/bench_gaudi_output.py [n_results ...]
+"""
+
+from __future__ import print_function
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import yaml
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gaudiview.parsers import parse_gaudi_output
+
+OBJECTIVES = ['Clashes (Contacts, min)', 'Vina (Energy, min)', 'HBonds (HBonds, max)']
+
+
+def write_output(path, n, flow_style=False):
+    results = {'GAUDI.objectives': OBJECTIVES,
+               'GAUDI.results': {}}
+    for i in range(n):
+        results['GAUDI.results']['gaudi_{:07d}.zip'.format(i)] = \
+            [round(random.uniform(-15, 15), 6) for _ in OBJECTIVES]
+    with open(path, 'w') as f:
+        f.write('# Generated by GAUDI\n\n')
+        f.write(yaml.safe_dump(results, default_flow_style=flow_style))
+
+
+def timeit(func, *args):
+    t0 = time.time()
+    func(*args)
+    return time.time() - t0
+
+
+def load_with_pyyaml(path):
+    with open(path) as f:
+        return yaml.load(f, Loader=yaml.Loader)
+
+
+def main(sizes):
+    tmpdir = tempfile.mkdtemp('gaudiview-bench')
+    try:
+        print('{:>10} {:>8} {:>12} {:>12} {:>8}'.format(
+            'results', 'style', 'pyyaml (s)', 'parser (s)', 'speedup'))
+        for n in sizes:
+            for flow_style in (False, None):
+                path = os.path.join(tmpdir, 'bench.gaudi-output')
+                write_output(path, n, flow_style=flow_style)
+                reference = timeit(load_with_pyyaml, path)
+                parser = timeit(parse_gaudi_output, path)
+                print('{:>10} {:>8} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+                    n, 'block' if flow_style is False else 'flow',
+                    reference, parser, reference / parser))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [1000, 10000, 100000])
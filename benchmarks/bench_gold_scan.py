@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Micro-benchmark of the GOLD score block scanner on synthetic mol2
+files of several sizes. The reference implementation reads the whole
+file and splits it in lines, as GoldModel.parse used to do.
+
+    python benchmarks/bench_gold_scan.py [n_files]
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gaudiview.parsers import scan_gold_solution
+
+ATOM = '{0:>7d} C{0:<6d} {1:>9.4f} {1:>9.4f} {1:>9.4f} C.3     1  LIG1       0.0000\n'
+ROTATED = ('{0:>9.4f} {0:>9.4f} {0:>9.4f} ' + ' '.join(['0.0000'] * 15) +
+           ' {1:d}\n')
+COMMENT = """@<TRIPOS>COMMENT
+> <Gold.Id.Protein>
+protein
+
+> <Gold.Score>
+Fitness  S(hb_ext) S(vdw_ext) S(hb_int) S(int)
+ 54.3210    12.3456    28.9012    0.0000 -7.8901
+
+> <Gold.Chemscore.Hbonds>
+donor_atom acceptor_atom score distance
+"""
+
+
+def write_mol2(path, n_atoms, n_rotated):
+    with open(path, 'w') as f:
+        f.write('@<TRIPOS>MOLECULE\nligand\n{} 0 1 0 0\nSMALL\nUSER_CHARGES\n\n'.format(n_atoms))
+        f.write('@<TRIPOS>ATOM\n')
+        for i in range(1, n_atoms + 1):
+            f.write(ATOM.format(i, i * 0.001))
+        f.write(COMMENT)
+        f.write('\n> <Gold.Protein.RotatedAtoms>\n')
+        for i in range(n_rotated):
+            f.write(ROTATED.format(i * 0.001, i))
+        f.write('\n')
+
+
+def scan_by_reading(path):
+    with open(path) as f:
+        lines = f.read().splitlines()
+    j = lines.index('> <Gold.Score>')
+    headers = lines[j + 1].strip().split()
+    scores = list(map(float, lines[j + 2].split()))
+    k = lines.index('@<TRIPOS>COMMENT')
+    return headers, scores, lines[k + 1:]
+
+
+def bench(func, paths, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.time()
+        for path in paths:
+            func(path)
+        best = min(best, time.time() - t0)
+    return best
+
+
+def main(n_files):
+    tmpdir = tempfile.mkdtemp('gaudiview-bench')
+    sizes = [('small ligand', 30, 0), ('large ligand', 300, 0),
+             ('flexible receptor', 50, 2000), ('huge rotated block', 50, 20000)]
+    try:
+        print('{:>20} {:>10} {:>12} {:>12} {:>8}'.format(
+            'case', 'size (KB)', 'read (ms)', 'mmap (ms)', 'speedup'))
+        for label, n_atoms, n_rotated in sizes:
+            paths = []
+            for i in range(n_files):
+                path = os.path.join(tmpdir, '{}_{}.mol2'.format(label.replace(' ', '_'), i))
+                write_mol2(path, n_atoms, n_rotated)
+                paths.append(path)
+            size = os.path.getsize(paths[0]) / 1024.
+            reference = bench(scan_by_reading, paths) * 1000 / n_files
+            scanner = bench(scan_gold_solution, paths) * 1000 / n_files
+            print('{:>20} {:>10.1f} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+                label, size, reference, scanner, reference / scanner))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if sys.argv[1:] else 200)
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+First-click cost of a GaudiMM solution, up to the point where Chimera
+gets the molecule files: extracting the whole zip to disk and listing
+it, as GaudiModel.parse_zip used to do, against extracting only the
+molecule members to a RAM-backed directory.
+
+    python benchmarks/bench_zip_loading.py [n_solutions]
+"""
+
+from __future__ import print_function
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gaudiview.cache import ram_mkdtemp
+from gaudiview.parsers import extract_structures
+
+PDB = 'ATOM  {0:>5d}  CA  ALA A{1:>4d}    {2:>8.3f}{2:>8.3f}{2:>8.3f}  1.00  0.00           C\n'
+MOL2 = '{0:>7d} C{0:<6d} {1:>9.4f} {1:>9.4f} {1:>9.4f} C.3     1  LIG1       0.0000\n'
+
+
+def write_solution(path, n_protein=8000, n_ligand=40, metadata_kb=512):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('Protein.pdb', ''.join(PDB.format(i, i // 10, i * 0.001)
+                                          for i in range(1, n_protein + 1)))
+        z.writestr('Ligand.mol2', '@<TRIPOS>ATOM\n' + ''.join(MOL2.format(i, i * 0.01)
+                                                              for i in range(1, n_ligand + 1)))
+        z.writestr('Trajectory.yaml', 'frames:\n' + ''.join(
+            '  - [{:.6f}, {:.6f}, {:.6f}]\n'.format(*[random.random() for _ in range(3)])
+            for _ in range(metadata_kb * 25)))
+
+
+def extract_all(path, tempdir):
+    tmp = os.path.join(tempdir, os.path.splitext(os.path.basename(path))[0])
+    os.mkdir(tmp)
+    with zipfile.ZipFile(path) as z:
+        z.extractall(tmp)
+        names = z.namelist()
+    return names, [os.path.join(tmp, name) for name in os.listdir(tmp)
+                   if name.endswith('.mol2') or name.endswith('.pdb')]
+
+
+def extract_needed(path, tempdir):
+    tmp = os.path.join(tempdir, os.path.splitext(os.path.basename(path))[0])
+    os.mkdir(tmp)
+    return extract_structures(path, tmp)
+
+
+def main(n):
+    srcdir = tempfile.mkdtemp('gaudiview-bench')
+    try:
+        paths = [os.path.join(srcdir, 'solution_{}.zip'.format(i)) for i in range(n)]
+        for path in paths:
+            write_solution(path)
+        for label, func, mkdtemp in (('extractall to disk', extract_all, tempfile.mkdtemp),
+                                     ('members to RAM dir', extract_needed, ram_mkdtemp)):
+            tempdir = mkdtemp('gaudiview-bench')
+            try:
+                t0 = time.time()
+                for path in paths:
+                    func(path, tempdir)
+                elapsed = (time.time() - t0) * 1000 / n
+            finally:
+                shutil.rmtree(tempdir, True)
+            print('{:>20}: {:7.2f} ms per solution ({})'.format(label, elapsed, tempdir))
+    finally:
+        shutil.rmtree(srcdir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if sys.argv[1:] else 50)
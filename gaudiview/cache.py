@@ -0,0 +1,407 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Caching helpers: bounded in-memory caches, RAM-backed temporary
+directories and a sidecar cache of parsed input files.
+
+Parsing a big run can take a while, so models can store the result
+in a binary file placed next to the input (``<input>.gaudiview-cache``).
+The cache is only reused if the input file has the same path, size and
+modification time, and every dependency (solution files, the directories
+they were globbed from...) has the same modification time.
+
+The sidecar file layout is:
+
+- 8 bytes of magic (:data:`MAGIC`).
+- A little-endian uint32 with the size of the JSON header.
+- The JSON header, with the cache key, the free-form ``info`` dict
+  and the description of the binary blocks that follow.
+- The binary blocks: NUL-separated string lists and raw arrays.
+
+This module does not depend on Chimera.
+"""
+
+# Python
+from __future__ import print_function
+from array import array
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:  # Python 2
+    from collections import Mapping, MutableMapping
+import atexit
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+MAGIC = b'GVCACHE\x01'
+SUFFIX = '.gaudiview-cache'
+ENABLED = True
+RAM_DIRS = ('/dev/shm',)
+
+
+def cache_path(path, suffix=SUFFIX):
+    """
+    Location of the sidecar cache file for input `path`.
+    """
+    return path + suffix
+
+
+def read_cache(path, suffix=SUFFIX):
+    """
+    Load the cache saved for input file `path`. Different caches
+    of the same input are told apart by their `suffix`.
+
+    Returns
+    -------
+    None, if there is no cache, it cannot be read or it is stale.
+    Otherwise, a tuple ``(info, strings, arrays)`` with the same
+    contents passed to :func:`write_cache`.
+    """
+    if not ENABLED:
+        return None
+    try:
+        with open(cache_path(path, suffix), 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            size, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(size).decode('utf-8'))
+            if header['key'] != _file_key(path):
+                return None
+            blocks = [_read_block(f, block, header['byteorder'])
+                      for block in header['blocks']]
+    except (IOError, OSError, ValueError, KeyError, EOFError, struct.error):
+        return None
+
+    dependencies, mtimes = blocks[:2]
+    for dependency, mtime in zip(dependencies, mtimes):
+        try:
+            if os.stat(dependency).st_mtime != mtime:
+                return None
+        except OSError:
+            return None
+    n_strings = header['n_strings']
+    return header['info'], blocks[2:2 + n_strings], blocks[2 + n_strings:]
+
+
+def write_cache(path, info, strings=(), arrays=(), dependencies=(), suffix=SUFFIX):
+    """
+    Save a cache for input file `path`.
+
+    Parameters
+    ----------
+    path : str
+        Input file whose parsed contents are being cached.
+    info : dict
+        JSON-serializable data, such as headers or small metadata.
+    strings : list of list of str
+        String columns, like filenames or record keys.
+    arrays : list of array.array
+        Numeric columns.
+    dependencies : list of str
+        Other files or directories whose modification time must not
+        change for the cache to be valid.
+    suffix : str, optional
+        Appended to `path` to name the cache file.
+
+    Returns
+    -------
+    True if the cache was written. Errors (read-only directories,
+    non-serializable info...) are not fatal: the cache is just skipped.
+    """
+    if not ENABLED:
+        return False
+    dependencies = list(dependencies)
+    try:
+        mtimes = array('d', (os.stat(d).st_mtime for d in dependencies))
+        payload = [_encode_strings(dependencies), _encode_array(mtimes)]
+        payload.extend(_encode_strings(s) for s in strings)
+        payload.extend(_encode_array(a) for a in arrays)
+        header = json.dumps({'key': _file_key(path),
+                             'byteorder': sys.byteorder,
+                             'info': info,
+                             'n_strings': len(strings),
+                             'blocks': [block for (block, _) in payload]}).encode('utf-8')
+    except (OSError, TypeError, ValueError):
+        return False
+
+    target = cache_path(path, suffix)
+    tmp = '{}.{}.tmp'.format(target, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for _, data in payload:
+                f.write(data)
+        _replace(tmp, target)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _encode_strings(strings):
+    encoded = [s.encode('utf-8') if not isinstance(s, bytes) else s for s in strings]
+    data = b'\0'.join(encoded)
+    return ['strings', len(encoded), len(data)], data
+
+
+def _encode_array(values):
+    if hasattr(values, 'dtype'):  # NumPy arrays, written without a copy if possible
+        typecode = values.dtype.char if values.dtype.char in 'ild' else 'd'
+        values = values.astype(typecode) if values.dtype.char != typecode else values
+        if not values.flags['C_CONTIGUOUS']:
+            values = values.copy()
+        return ['array', typecode, values.itemsize, len(values), values.nbytes], values
+    if not isinstance(values, array):
+        values = array('d', values)
+    data = values.tostring() if hasattr(values, 'tostring') else values.tobytes()
+    return ['array', values.typecode, values.itemsize, len(values), len(data)], data
+
+
+def _read_block(f, block, byteorder):
+    kind = block[0]
+    data = f.read(block[-1])
+    if len(data) != block[-1]:
+        raise EOFError('Truncated cache file')
+    if kind == 'strings':
+        if not block[1]:
+            return []
+        if bytes is str:  # Python 2
+            return data.split(b'\0')
+        return data.decode('utf-8').split('\0')
+    if kind == 'array':
+        values = array(str(block[1]))
+        if values.itemsize != block[2]:
+            raise ValueError('Cache written in an incompatible platform')
+        if hasattr(values, 'frombytes'):
+            values.frombytes(data)
+        else:
+            values.fromstring(data)
+        if byteorder != sys.byteorder:
+            values.byteswap()
+        return values
+    raise ValueError('Unknown block type ' + kind)
+
+
+def _replace(source, target):
+    try:
+        os.rename(source, target)
+    except OSError:  # Windows does not overwrite on rename
+        os.remove(target)
+        os.rename(source, target)
+
+
+def ram_mkdtemp(suffix=''):
+    """
+    Like :func:`tempfile.mkdtemp`, but in a RAM-backed filesystem if one
+    is available (see :data:`RAM_DIRS`). Those directories are removed
+    at exit, since they hold on to memory.
+    """
+    for directory in RAM_DIRS:
+        if not (os.path.isdir(directory) and os.access(directory, os.W_OK)):
+            continue
+        try:
+            path = tempfile.mkdtemp(suffix, dir=directory)
+        except OSError:
+            continue
+        atexit.register(shutil.rmtree, path, True)
+        return path
+    return tempfile.mkdtemp(suffix)
+
+
+class LRUCache(object):
+
+    """
+    A dict-like container that holds, at most, `maxsize` items. When full,
+    the least recently used item is discarded.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        return self._data.pop(key, *default)
+
+    def clear(self):
+        self._data.clear()
+
+
+class BoundedCache(MutableMapping):
+
+    """
+    Dict-like LRU container bounded both by number of items and by their
+    total weight (for example, the number of atoms of a list of models).
+
+    When an insertion exceeds either limit, the least recently used items
+    are removed and passed to ``evict(key, value)``, except the ones for
+    which ``pinned(key, value)`` is True and the item just inserted. So
+    the limits can be exceeded while too many items are pinned.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of items. None for no limit.
+    maxweight : int, optional
+        Maximum total weight. None for no limit.
+    weigh : callable, optional
+        Takes a value and returns its weight. Defaults to 1 per item.
+    evict : callable, optional
+        Called with ``(key, value)`` for each evicted item.
+    pinned : callable, optional
+        Takes ``(key, value)`` and returns True if it must not be evicted.
+    """
+
+    def __init__(self, maxsize=None, maxweight=None, weigh=None, evict=None, pinned=None):
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.weight = 0
+        self._weigh = weigh or (lambda value: 1)
+        self._evict = evict
+        self._pinned = pinned or (lambda key, value: False)
+        self._data = OrderedDict()
+        self._weights = {}
+
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            del self[key]
+        weight = self._weigh(value)
+        self._data[key] = value
+        self._weights[key] = weight
+        self.weight += weight
+        self.trim()
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self.weight -= self._weights.pop(key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        # A copy, since reading items reorders them
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def full(self):
+        return ((self.maxsize is not None and len(self._data) > self.maxsize) or
+                (self.maxweight is not None and self.weight > self.maxweight))
+
+    def trim(self):
+        """
+        Evict items until the limits are met, or only pinned items remain.
+        """
+        for key in list(self._data)[:-1]:
+            if not self.full():
+                break
+            value = self._data[key]
+            if self._pinned(key, value):
+                continue
+            del self[key]
+            if self._evict is not None:
+                self._evict(key, value)
+
+
+class LazyFileBlocks(Mapping):
+
+    """
+    Read-only mapping of file paths to the lines contained in a byte range
+    of each file. Nothing is read until an item is requested, and only the
+    last `maxsize` decoded entries are kept in memory.
+
+    Parameters
+    ----------
+    keys : list of str
+        File paths.
+    offsets, lengths : sequence of int
+        Byte range to read from each file, parallel to `keys`.
+    maxsize : int, optional
+        Number of decoded entries kept in memory.
+    """
+
+    def __init__(self, keys, offsets, lengths, maxsize=32):
+        self._index = dict((key, i) for (i, key) in enumerate(keys))
+        self.offsets = array('l', offsets)
+        self.lengths = array('l', lengths)
+        self._decoded = LRUCache(maxsize)
+
+    def __getitem__(self, key):
+        try:
+            return self._decoded[key]
+        except KeyError:
+            pass
+        i = self._index[key]
+        with open(key, 'rb') as f:
+            f.seek(self.offsets[i])
+            lines = f.read(self.lengths[i]).splitlines()
+        self._decoded[key] = lines
+        return lines
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def location(self, key):
+        """
+        Byte offset and length of the block for `key`.
+        """
+        i = self._index[key]
+        return self.offsets[i], self.lengths[i]
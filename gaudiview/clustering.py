@@ -0,0 +1,1007 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+RMSD clustering of solutions, on the coordinates returned by
+:func:`gaudiview.coords.read_solutions`.
+
+Solutions are given as ``(key, topology, coords)`` tuples, where
+`topology` is the signature of the molecule: poses of different
+molecules are never clustered together.
+
+This module does not depend on Chimera.
+"""
+
+# Python
+from __future__ import division
+from collections import OrderedDict
+from itertools import chain
+import multiprocessing
+import os
+import shutil
+# External dependencies
+import numpy as np
+# Own
+from gaudiview.cache import ram_mkdtemp
+from gaudiview.coords import read_solution, read_solution_or_none
+from gaudiview.neighbours import NeighbourList, neighbours_signature, search_rows
+from gaudiview.parsers import process_pool
+from gaudiview.rmsd import PoseStack, rmsd_one_to_many, rmsd_many_to_many, rmsd_pairs
+from gaudiview.symmetry import topology_symmetry
+
+#: Reference poses per topology used to bound RMSDs when pruning
+REFERENCES = 4
+#: Poses sampled (evenly) to choose the references from
+REFERENCE_SAMPLE = 1000
+#: Leaders of a topology needed before pruning is attempted
+PRUNE_AFTER = 8 * REFERENCES
+#: Poses (themselves included) within the cutoff of a DBSCAN core pose
+MIN_SAMPLES = 5
+#: Margin, in Angstrom, added to the lower bounds to absorb round-off
+TOLERANCE = 1e-5
+
+
+def leader_clustering(solutions, cutoff, superpose=False, prune=True, symmetries=None):
+    """
+    Greedy leader clustering: each solution, in order, joins the first
+    cluster whose leader is closer than `cutoff`, or becomes the leader
+    of a new cluster.
+
+    With `prune`, leaders that cannot be within the cutoff are skipped
+    without computing their RMSD. RMSD is a metric, so its difference
+    to a few reference poses (triangle inequality) and, for in-place
+    RMSD, the distance between centroids are lower bounds of the RMSD.
+    The clusters are exactly the same as without pruning. Superposed
+    RMSDs are not pruned: their bounds rarely skip a leader, so they
+    cost more RMSDs than they save.
+
+    Parameters
+    ----------
+    solutions : list of (key, topology, coords)
+    cutoff : float
+        RMSD threshold, in Angstrom.
+    superpose : bool, optional
+        Compare poses after optimal superposition instead of in place.
+    prune : bool, optional
+        Skip leaders whose lower bound is above the cutoff.
+    symmetries : dict, optional
+        :class:`gaudiview.symmetry.Symmetry` of each topology, for
+        symmetry-corrected RMSDs.
+
+    Returns
+    -------
+    List of clusters, in order of creation. Each cluster is a list of
+    ``(key, rmsd)`` pairs, starting with its leader (whose rmsd is None).
+    """
+    poses = {}
+    for key, topology, xyz in solutions:
+        poses.setdefault(topology, []).append(xyz)
+    clusters = []
+    leaders = {}
+    for key, topology, xyz in solutions:
+        try:
+            group = leaders[topology]
+        except KeyError:
+            symmetry = (symmetries or {}).get(topology)
+            group = leaders[topology] = _Leaders(poses[topology], superpose, prune,
+                                                 symmetry=symmetry)
+        index, rmsd = group.match(xyz, cutoff)
+        if index is None:
+            group.add(len(clusters), xyz)
+            clusters.append([(key, None)])
+        else:
+            clusters[index].append((key, rmsd))
+    return clusters
+
+
+def leader_clustering_from_neighbours(keys, neighbours, cutoff):
+    """
+    :func:`leader_clustering` of `keys`, in that order, computed from the
+    RMSDs stored in a :class:`gaudiview.neighbours.NeighbourList`. The
+    result is the same if `cutoff` is not above the radius of the list.
+    """
+    _check_radius(neighbours, cutoff)
+    cluster_of = np.full(len(neighbours), -1, dtype=np.int64)  # for leaders only
+    clusters = []
+    for key in keys:
+        i = neighbours.index(key)
+        others, rmsds = neighbours.row(i)
+        candidates = cluster_of[others]
+        close = (candidates >= 0) & (rmsds < cutoff)
+        if close.any():
+            # The first cluster created among those within the cutoff
+            first = np.flatnonzero(close)[np.argmin(candidates[close])]
+            clusters[candidates[first]].append((key, float(rmsds[first])))
+        else:
+            cluster_of[i] = len(clusters)
+            clusters.append([(key, None)])
+    return clusters
+
+
+def average_linkage_from_neighbours(keys, neighbours, cutoff):
+    """
+    Average-linkage agglomerative clustering of `keys`: the two clusters
+    with the lowest average RMSD between their members are merged, until
+    that average reaches `cutoff`. Unlike the leader algorithm, the
+    result does not depend on the order of `keys`.
+
+    Only the RMSDs in the :class:`gaudiview.neighbours.NeighbourList`
+    are known; the rest are above its radius and count as the radius.
+    The further the radius is above the cutoff, the closer the result
+    is to that of the full RMSD matrix, which is never built.
+
+    Average linkage is reducible (merging two clusters never brings
+    the result closer to a third one than they were), so all pairs of
+    clusters that are each other's nearest are merged at once, which
+    gives the same clusters as merging one pair at a time. Each round
+    is a few array operations over the links between clusters, which
+    take 16 bytes each.
+    """
+    _check_radius(neighbours, cutoff)
+    first, second, total = neighbours.pairs_array(dtype=np.float32)
+    labels = _average_linkage(len(neighbours), first, second, total, neighbours.radius, cutoff)
+    return _clusters_from_labels(keys, neighbours, labels)
+
+
+def _average_linkage(n, first, second, total, radius, cutoff):
+    """
+    :func:`average_linkage_from_neighbours` of `n` poses, from the
+    pairs ``(first[k], second[k])`` closer than `radius`, with
+    ``first < second``, and their RMSDs, `total`. Returns the cluster
+    of each pose, as its smallest pose.
+    """
+    # Links between clusters: sum of their known RMSDs, and number of them
+    known = np.ones(len(first), dtype=np.int32)
+    sizes = np.ones(n)  # as floats, to get the averages with no integer copies
+    parent = np.arange(n, dtype=np.int32)
+    nearest = np.empty(n, dtype=np.int32)
+    while len(first):
+        pairs = sizes[first]
+        pairs *= sizes[second]
+        average = pairs - known
+        average *= radius
+        average += total
+        average /= pairs
+        del pairs
+        close = average < cutoff
+        if not close.any():
+            break
+        if close.all():  # no copies
+            close = slice(None)
+        # Nearest cluster of each one (the lowest numbered, if tied), from
+        # the links it is the first of, and then the second
+        best = np.full(n, np.inf)
+        for nodes, others in ((first, second), (second, first)):
+            nodes, others, values = nodes[close], others[close], average[close]
+            order = np.lexsort((others, values, nodes))
+            ordered = nodes[order]
+            heads = order[np.r_[True, ordered[1:] != ordered[:-1]]]
+            del order, ordered
+            nodes, others, values = nodes[heads], others[heads], values[heads]
+            better = (values < best[nodes]) | ((values == best[nodes]) &
+                                               (others < nearest[nodes]))
+            nodes = nodes[better]
+            best[nodes], nearest[nodes] = values[better], others[better]
+        del average, close
+        nodes = np.flatnonzero(best < np.inf)
+        others = nearest[nodes]
+        mutual = (nearest[others] == nodes) & (nodes < others)
+        merged, into = others[mutual], nodes[mutual]
+        parent[merged] = into
+        sizes[into] += sizes[merged]
+        # Relabel the links and add up those between the same clusters
+        first, second = parent[first], parent[second]
+        apart = first != second
+        first, second = first[apart], second[apart]
+        total, known = total[apart], known[apart]
+        del apart
+        if not len(first):  # everything merged
+            break
+        first, second = np.minimum(first, second), np.maximum(first, second)
+        order = np.lexsort((second, first))
+        first, second = first[order], second[order]
+        starts = np.flatnonzero(np.r_[True, (first[1:] != first[:-1]) |
+                                      (second[1:] != second[:-1])])
+        total = np.add.reduceat(total[order], starts) if len(starts) else total
+        known = np.add.reduceat(known[order], starts) if len(starts) else known
+        first, second = first[starts], second[starts]
+    return _roots(parent)  # follow the merges up to the surviving cluster
+
+
+def dbscan_from_neighbours(keys, neighbours, cutoff, min_samples=None):
+    """
+    Density-based clustering (DBSCAN) of `keys`, with `cutoff` as the
+    neighbourhood radius. Poses with at least `min_samples` poses
+    (themselves included) within the cutoff are core poses; core poses
+    within the cutoff of each other share their cluster, and the rest
+    join the cluster of their closest core pose, if any is within the
+    cutoff. Poses in no cluster (noise) are returned as clusters of one.
+    """
+    _check_radius(neighbours, cutoff)
+    dbscan = _DBSCAN(len(neighbours), cutoff, min_samples)
+    for first, second, rmsds in neighbours.upper_pairs():
+        dbscan.add(first, second, rmsds)
+    return _clusters_from_labels(keys, neighbours, dbscan.labels())
+
+
+class _DBSCAN(object):
+
+    """
+    :func:`dbscan_from_neighbours` of `n` poses, fed with the pairs in
+    chunks, in any order, so they never have to be stored. Poses only
+    gain neighbours, so once core they stay core: pairs of core poses
+    are merged right away in a union-find forest, and only the pairs
+    with a pose not yet core are kept, ``min_samples - 2`` per pose
+    at most.
+    """
+
+    def __init__(self, n, cutoff, min_samples=None):
+        self.cutoff = cutoff
+        self.min_samples = MIN_SAMPLES if min_samples is None else min_samples
+        self.counts = np.ones(n, dtype=np.int64)  # within the cutoff, itself included
+        self.parent = np.arange(n, dtype=np.int64)
+        self.pending = []
+
+    def add(self, first, second, rmsds):
+        close = rmsds < self.cutoff
+        first, second, rmsds = first[close], second[close], rmsds[close]
+        n = len(self.counts)
+        self.counts += np.bincount(first, minlength=n) + np.bincount(second, minlength=n)
+        core = self.counts >= self.min_samples
+        edges = core[first] & core[second]
+        _union(self.parent, first[edges], second[edges])
+        if not edges.all():
+            self.pending.append((first[~edges], second[~edges], rmsds[~edges]))
+
+    def labels(self):
+        """
+        Cluster of each pose, as a label per pose. Call it once, after
+        every pair was added.
+        """
+        n = len(self.counts)
+        core = self.counts >= self.min_samples
+        chunks = self.pending or [(np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0))]
+        first, second, rmsds = [np.concatenate(values) for values in zip(*chunks)]
+        self.pending = []
+        edges = core[first] & core[second]
+        _union(self.parent, first[edges], second[edges])
+        components = _roots(self.parent)
+        labels = np.where(core, components, -1)
+        # Pairs with a single core pose, as (border pose, core pose)
+        rows, cols = np.r_[first, second], np.r_[second, first]
+        border = ~core[rows] & core[cols]
+        if border.any():
+            b_rows, b_cols, b_rmsds = rows[border], cols[border], np.r_[rmsds, rmsds][border]
+            nearest = np.lexsort((b_cols, b_rmsds, b_rows))
+            b_rows, b_cols = b_rows[nearest], b_cols[nearest]
+            head = np.ones(len(b_rows), dtype=bool)
+            head[1:] = b_rows[1:] != b_rows[:-1]
+            labels[b_rows[head]] = components[b_cols[head]]
+        noise = labels < 0
+        labels[noise] = n + np.arange(noise.sum())  # clusters of one
+        return labels
+
+
+def _check_radius(neighbours, cutoff):
+    if cutoff > neighbours.radius:
+        raise ValueError('Cutoff {} is above the radius of the neighbour list ({})'.format(
+            cutoff, neighbours.radius))
+
+
+def _roots(parent):
+    """
+    Root of each node of the union-find forest `parent`, whose paths
+    are compressed in place.
+    """
+    while True:
+        grandparent = parent[parent]
+        if (grandparent == parent).all():
+            return parent
+        parent[:] = grandparent
+
+
+def _union(parent, first, second):
+    """
+    Join the trees of each pair of nodes ``(first[k], second[k])`` in
+    the union-find forest `parent`. Roots are the smallest node of
+    their tree.
+    """
+    while len(first):
+        roots = _roots(parent)
+        first, second = roots[first], roots[second]
+        apart = first != second
+        first, second = first[apart], second[apart]
+        first, second = np.minimum(first, second), np.maximum(first, second)
+        # Roots hooked to several others take the smallest one; the
+        # rest are joined in the next round
+        np.minimum.at(parent, second, first)
+
+
+def _label_groups(labels, rows):
+    """
+    Positions in `rows` grouped by their label in `labels`, each group
+    in order, and sorted by their first position.
+    """
+    order = np.argsort(labels[rows], kind='mergesort')  # by label, then by position
+    sorted_labels = labels[rows][order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+    groups = np.split(order, starts[1:])
+    groups.sort(key=lambda group: group[0])
+    return groups
+
+
+def _clusters_from_labels(keys, neighbours, labels):
+    """
+    Clusters in the format of :func:`leader_clustering`, from a label per
+    row of `neighbours`. Clusters are sorted by their first member in
+    `keys`, which is their representative: the RMSD of the others is
+    their RMSD to it, or None if above the radius of the list.
+    """
+    rows = np.array([neighbours.index(key) for key in keys], dtype=np.int64)
+    groups = _label_groups(labels, rows)
+    lookup = np.full(len(neighbours), np.nan)  # RMSD to the representative
+    clusters = []
+    for group in groups:
+        cluster = [(keys[group[0]], None)]
+        if len(group) > 1:
+            others, rmsds = neighbours.row(rows[group[0]])
+            lookup[others] = rmsds
+            found = lookup[rows[group[1:]]]
+            lookup[others] = np.nan
+            for position, rmsd in zip(group[1:].tolist(), found.tolist()):
+                cluster.append((keys[position], None if rmsd != rmsd else rmsd))
+        clusters.append(cluster)
+    return clusters
+
+
+def choose_references(poses, count, superpose=False, sample=None, symmetry=None):
+    """
+    Pick up to `count` of `poses` spread apart: the first one, and then
+    the one farthest from those already picked (within an even sample
+    of `sample` poses, :data:`REFERENCE_SAMPLE` by default).
+
+    Returns
+    -------
+    (R, N, 3) array of reference poses.
+    """
+    stride = max(1, len(poses) // (sample or REFERENCE_SAMPLE))
+    candidates = np.array(poses[::stride])
+    picked = [0]
+    nearest = rmsd_one_to_many(candidates[0], candidates, superpose=superpose,
+                               symmetry=symmetry)
+    while len(picked) < min(count, len(candidates)):
+        farthest = int(np.argmax(nearest))
+        if nearest[farthest] == 0:
+            break  # all remaining poses are duplicates
+        picked.append(farthest)
+        nearest = np.minimum(nearest, rmsd_one_to_many(candidates[farthest], candidates,
+                                                       superpose=superpose,
+                                                       symmetry=symmetry))
+    return candidates[picked]
+
+
+#: Clustering algorithms that run on a NeighbourList, by name
+METHODS = OrderedDict([
+    ('Leader', leader_clustering_from_neighbours),
+    ('Average linkage', average_linkage_from_neighbours),
+    ('DBSCAN', dbscan_from_neighbours),
+])
+
+
+class _Leaders(object):
+
+    """
+    Cluster leaders of one topology, with the data needed to bound
+    the RMSD between a new pose and each of them.
+    """
+
+    def __init__(self, poses, superpose=False, prune=True, references=None, symmetry=None):
+        self.all_poses = poses
+        self.superpose = superpose
+        self.symmetry = symmetry
+        self.prune = prune and not superpose  # bounds too loose to pay off
+        self.clusters = []
+        self.poses = PoseStack()
+        self.references = references
+        self.centroids = None
+        self.distances = None  # to each reference
+
+    def add(self, cluster, xyz):
+        self.clusters.append(cluster)
+        self.poses.append(xyz)
+        if self.centroids is not None:
+            self.centroids.append(xyz.mean(axis=0))
+        if self.distances is not None:
+            self.distances.append(self._reference_distances(xyz))
+
+    def _start_pruning(self):
+        """
+        Choose the references and compute the bounding data of the
+        current leaders. Postponed until there are enough leaders.
+        """
+        poses = self.poses.poses
+        self.centroids = PoseStack()
+        for centroid in poses.mean(axis=1):
+            self.centroids.append(centroid)
+        if self.references is None and REFERENCES:
+            self.references = choose_references(self.all_poses, REFERENCES,
+                                                superpose=self.superpose,
+                                                symmetry=self.symmetry)
+        if self.references is not None:
+            self.distances = PoseStack()
+            for distances in rmsd_many_to_many(poses, self.references,
+                                               superpose=self.superpose,
+                                               symmetry=self.symmetry):
+                self.distances.append(distances)
+
+    def match(self, xyz, cutoff):
+        """
+        First leader closer than `cutoff` to `xyz`, as a pair
+        ``(cluster index, rmsd)``, or ``(None, None)``.
+        """
+        if not self.clusters:
+            return None, None
+        bound = None
+        # Bounding costs as many RMSDs as there are references, so it
+        # only pays off against a larger number of leaders
+        if self.prune and len(self.clusters) > PRUNE_AFTER:
+            if self.centroids is None:
+                self._start_pruning()
+            bound = _lower_bound(
+                xyz.mean(axis=0), self.centroids.poses,
+                None if self.distances is None else self._reference_distances(xyz),
+                None if self.distances is None else self.distances.poses)
+        leader, rmsd = _first_within(xyz, self.poses.poses, cutoff, self.superpose, bound,
+                                     self.symmetry)
+        if leader is None:
+            return None, None
+        return self.clusters[leader], rmsd
+
+    def _reference_distances(self, xyz):
+        return rmsd_one_to_many(xyz, self.references, superpose=self.superpose,
+                                symmetry=self.symmetry)
+
+
+def _lower_bound(centroid, centroids=None, own_distances=None, distances=None):
+    """
+    Lower bound of the RMSD between a pose and others, from their
+    `centroids` (in-place RMSD only) and their `distances` to the
+    references, compared with those of the pose (`centroid` and
+    `own_distances`).
+    """
+    bound = 0
+    if centroids is not None:
+        delta = centroids - centroid
+        bound = np.sqrt((delta * delta).sum(axis=1))
+    if distances is not None:
+        bound = np.maximum(bound, np.abs(distances - own_distances).max(axis=1))
+    return bound
+
+
+def _first_within(xyz, leaders, cutoff, superpose=False, bound=None, symmetry=None):
+    """
+    Position of the first of the (K, N, 3) `leaders` closer than
+    `cutoff` to `xyz`, and its RMSD; or ``(None, None)``. Leaders
+    whose `bound` is above the cutoff are not compared.
+    """
+    candidates = None
+    if bound is not None and np.ndim(bound):
+        candidates = np.flatnonzero(bound <= cutoff + TOLERANCE)
+        if not len(candidates):
+            return None, None
+        leaders = leaders[candidates]
+    rmsds = rmsd_one_to_many(xyz, leaders, superpose=superpose, symmetry=symmetry)
+    hits = np.flatnonzero(rmsds < cutoff)
+    if not len(hits):
+        return None, None
+    leader = hits[0] if candidates is None else candidates[hits[0]]
+    return int(leader), float(rmsds[hits[0]])
+
+
+class ClusteringJob(object):
+
+    """
+    Clustering of solution files in a pool of processes, advanced step
+    by step with :meth:`poll`, so the caller's event loop (Tk's, in
+    Chimera) is never blocked for long.
+
+    Without a `radius`, this is :func:`leader_clustering`, as described
+    below. With it, the RMSDs within the radius are computed first (see
+    :mod:`gaudiview.neighbours`) and any of the :data:`METHODS` runs on
+    them, in a worker.
+
+    The workers read the coordinates, which are then saved as one
+    memory-mapped array per topology (in a RAM-backed directory, if
+    possible) shared by every worker, instead of being pickled into each
+    task. Poses are matched in batches: for each pose of the batch, the
+    workers find the first leader within the cutoff among the leaders
+    found so far. Older leaders come first in the sequential algorithm
+    too, so those matches are final; the main process only has to check
+    the rest against the leaders created within the same batch, in
+    order. The clusters are the same as those of :func:`leader_clustering`.
+
+    Parameters
+    ----------
+    keys : list of str
+        Solutions to cluster, in order.
+    paths : list of str
+        File of each solution, read with :func:`gaudiview.coords.read_solution`.
+    cutoff : float
+        RMSD threshold, in Angstrom.
+    superpose : bool, optional
+        Compare poses after optimal superposition instead of in place.
+    symmetry : bool, optional
+        Correct the RMSDs for the symmetry of each topology (see
+        :mod:`gaudiview.symmetry`).
+    workers : int, optional
+        Number of processes. Defaults to the number of CPUs. With 1, or if
+        a pool cannot be created, every step runs in the current process.
+    radius : float, optional
+        If given, every RMSD up to this radius (not smaller than `cutoff`)
+        is computed and kept in :attr:`neighbours`, and the clusters are
+        computed from them. Required by all methods but 'Leader'.
+    max_pairs : int, optional
+        Pairs within the radius kept, at most. Past that, the radius is
+        lowered to `cutoff`; if that is not enough either, no pairs are
+        kept (:attr:`neighbours` is None): 'Leader' falls back to the
+        batches described above, DBSCAN clusters the pairs as they are
+        found, and average linkage uses them without building
+        :attr:`neighbours`.
+    method : str, optional
+        One of :data:`METHODS`.
+    options : dict, optional
+        Keyword arguments for the method, like `min_samples` for DBSCAN.
+    neighbours : gaudiview.neighbours.NeighbourList, optional
+        RMSDs computed before. Nothing is read and no RMSD is computed.
+
+    Attributes
+    ----------
+    stage : str
+        What the job is doing now.
+    progress : tuple of int
+        Items done and total items of the current stage.
+    clusters : list
+        The result, once :meth:`poll` returns True, in the same format
+        as :func:`leader_clustering`.
+    neighbours : gaudiview.neighbours.NeighbourList
+        The RMSDs computed, if a `radius` was given.
+    radius : float
+        Radius of :attr:`neighbours`. None if no RMSDs were kept.
+    """
+
+    #: Poses matched against the leaders in each step. Batches start
+    #: small and double, since early poses tend to become leaders.
+    FIRST_BATCH_SIZE = 256
+    BATCH_SIZE = 4096
+    #: Tasks each batch is split into, per worker
+    TASKS_PER_WORKER = 4
+
+    def __init__(self, keys, paths, cutoff, superpose=False, workers=None, radius=None,
+                 method='Leader', options=None, neighbours=None, symmetry=False,
+                 max_pairs=None):
+        self.keys = list(keys)
+        self.paths = list(paths)
+        self.cutoff = cutoff
+        self.superpose = superpose
+        self.symmetry = symmetry
+        self.symmetries = {}
+        self.radius = radius
+        self.max_pairs = max_pairs
+        self.method = method
+        self.options = options or {}
+        self.neighbours = neighbours
+        if method != 'Leader' and radius is None and neighbours is None:
+            raise ValueError('{} clustering needs a radius'.format(method))
+        self._saved = 0
+        self.stage = 'Reading coordinates'
+        self.progress = (0, len(self.keys))
+        self.clusters = None
+        self.done = False
+        self.tempdir = ram_mkdtemp('gaudiview-cluster')
+        self.pool = process_pool(workers)
+        self.workers = (workers or multiprocessing.cpu_count()) if self.pool is not None else 1
+        self._steps = self._run()
+        self._pending = None
+
+    def poll(self):
+        """
+        Run the next step, if the previous one has finished. Errors
+        raised by the workers are raised here, and stop the job.
+
+        Returns
+        -------
+        True when the job is done.
+        """
+        if self.done:
+            return True
+        if self._pending is not None and not self._pending.ready():
+            return False
+        try:
+            result = None if self._pending is None else self._pending.get()
+            self._pending = self._steps.send(result)
+        except StopIteration:
+            self.close()
+        except BaseException:
+            self.close()
+            raise
+        return self.done
+
+    def close(self):
+        """
+        Stop the workers and remove the temporary files.
+        """
+        self.done = True
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        for path in [path for path in _MAPPED if path.startswith(self.tempdir)]:
+            del _MAPPED[path]
+        shutil.rmtree(self.tempdir, True)
+
+    def _map(self, func, tasks):
+        if self.pool is None:
+            return _Finished([func(task) for task in tasks])
+        return self.pool.map_async(func, tasks, chunksize=1)
+
+    def _apply(self, func, args, kwargs):
+        if self.pool is None:
+            return _Finished(func(*args, **kwargs))
+        return self.pool.apply_async(func, args, kwargs)
+
+    def _chunks(self, start, stop, size=None):
+        if size is None:
+            size = -(-(stop - start) // (self.workers * self.TASKS_PER_WORKER))
+        size = max(1, size)
+        return [(i, min(i + size, stop)) for i in range(start, stop, size)]
+
+    def _run(self):
+        """
+        The job, as a generator that yields the results to wait for.
+        """
+        if self.neighbours is None:
+            chunks = self._chunks(0, len(self.paths), size=64)
+            results = yield self._map(_read_chunk, [self.paths[i:j] for (i, j) in chunks])
+            by_topology = OrderedDict()
+            for order, (key, result) in enumerate(zip(self.keys, chain(*results))):
+                if result is None:
+                    raise IOError('Could not read the coordinates of ' + key)
+                signature, xyz = result
+                by_topology.setdefault(signature, []).append((order, xyz))
+            if self.symmetry:  # from the first solution of each topology
+                for signature, members in by_topology.items():
+                    structure = read_solution(self.paths[members[0][0]])
+                    self.symmetries[signature] = topology_symmetry(structure)
+
+            while self.clusters is None and self.neighbours is None:
+                self.progress = (0, len(self.keys))
+                if self.radius is None:
+                    self.stage = 'Clustering'
+                    steps = self._leader_steps(by_topology)
+                else:  # if there are too many pairs, the radius is dropped
+                    self.stage = 'Computing RMSDs'
+                    steps = self._neighbour_steps(by_topology)
+                result = None
+                while True:
+                    try:
+                        pending = steps.send(result)
+                    except StopIteration:
+                        break
+                    result = yield pending
+
+        if self.neighbours is not None and self.clusters is None:
+            self.stage = 'Clustering'
+            self.progress = (0, len(self.keys))
+            method = METHODS[self.method]
+            if method is leader_clustering_from_neighbours:  # fast enough here
+                self.clusters = method(self.keys, self.neighbours, self.cutoff, **self.options)
+            elif self.pool is None:
+                self.clusters = method(self.keys, self.neighbours, self.cutoff, **self.options)
+            else:
+                # The worker maps the RMSDs, instead of getting a pickled copy
+                neighbours = self.neighbours
+                paths = [self._save(array) for array in
+                         (neighbours.indptr, neighbours.indices, neighbours.distances)]
+                self.clusters = yield self._apply(_cluster, (
+                    self.method, self.keys, neighbours.keys, paths, neighbours.radius,
+                    self.cutoff), self.options)
+
+    def _save(self, array):
+        """
+        Store `array` where the workers can map it, and return its path.
+        """
+        path = os.path.join(self.tempdir, '{}.npy'.format(self._saved))
+        self._saved += 1
+        np.save(path, array)
+        return path
+
+    def _leader_steps(self, by_topology):
+        done = 0
+        clusters = []  # (order of the leader, members)
+        for signature, members in by_topology.items():
+            symmetry = self.symmetries.get(signature)
+            path = self._save(np.array([xyz for (order, xyz) in members]))
+            poses = _mapped(path)
+            distances_path = references = None
+            if len(members) > PRUNE_AFTER and REFERENCES and not self.superpose:
+                references = choose_references(poses, REFERENCES, superpose=self.superpose,
+                                               symmetry=symmetry)
+                distances = yield self._map(_reference_distances_chunk, [
+                    (path, i, j, references, self.superpose, symmetry)
+                    for (i, j) in self._chunks(0, len(poses))])
+                distances_path = self._save(np.concatenate(distances))
+
+            leaders = [0]
+            assigned = {0: []}  # leader -> [(pose, rmsd)]
+            start, size = 1, self.FIRST_BATCH_SIZE
+            while start < len(poses):
+                stop = min(start + size, len(poses))
+                snapshot = np.array(leaders)
+                tasks = [(path, distances_path, i, j, snapshot, self.cutoff, self.superpose,
+                          symmetry) for (i, j) in self._chunks(start, stop)]
+                matches = yield self._map(_match_chunk, tasks)
+                created = _Leaders(poses, self.superpose, references=references,
+                                   symmetry=symmetry)
+                for i, (leader, rmsd) in zip(range(start, stop), chain(*matches)):
+                    if leader is not None:
+                        assigned[leaders[leader]].append((i, rmsd))
+                        continue
+                    xyz = np.asarray(poses[i])
+                    leader, rmsd = created.match(xyz, self.cutoff)
+                    if leader is None:
+                        created.add(i, xyz)
+                        assigned[i] = []
+                    else:
+                        assigned[leader].append((i, rmsd))
+                leaders.extend(created.clusters)
+                start = stop
+                size = min(2 * size, self.BATCH_SIZE)
+                self.progress = (done + stop, len(self.keys))
+            done += len(poses)
+
+            for leader in leaders:
+                cluster = [(self.keys[members[leader][0]], None)]
+                cluster.extend((self.keys[members[i][0]], rmsd) for (i, rmsd) in assigned[leader])
+                clusters.append((members[leader][0], cluster))
+        clusters.sort(key=lambda item: item[0])
+        self.clusters = [cluster for (order, cluster) in clusters]
+
+    def _neighbour_steps(self, by_topology):
+        keys = sorted(self.keys)
+        index = dict((key, i) for (i, key) in enumerate(keys))
+        first, second, distances = [], [], []
+        keep, radius = True, self.radius  # pairs kept while there are not too many
+        dbscan = None
+        if self.method == 'DBSCAN':  # clustered as the pairs come
+            dbscan = _DBSCAN(len(keys), self.cutoff, self.options.get('min_samples'))
+        topologies = []  # (path, symmetry, rows) of each
+        done = found = 0
+        for signature, members in by_topology.items():
+            symmetry = self.symmetries.get(signature)
+            path = self._save(np.array([xyz for (order, xyz) in members]))
+            distances_path = centroids_path = None
+            # Without a metric, the references give no lower bounds
+            metric = symmetry is None or symmetry.metric(self.superpose)
+            if len(members) > PRUNE_AFTER and REFERENCES and metric:
+                # Sort the poses by their RMSD to the first reference, so
+                # each one is only compared with a window of the rest
+                references = choose_references(_mapped(path), REFERENCES,
+                                               superpose=self.superpose, symmetry=symmetry)
+                to_references = yield self._map(_reference_distances_chunk, [
+                    (path, i, j, references, self.superpose, symmetry)
+                    for (i, j) in self._chunks(0, len(members))])
+                to_references = np.concatenate(to_references)
+                permutation = np.argsort(to_references[:, 0], kind='mergesort')
+                members = [members[i] for i in permutation]
+                path = self._save(np.array([xyz for (order, xyz) in members]))
+                distances_path = self._save(to_references[permutation])
+                if not self.superpose:
+                    centroids_path = self._save(_mapped(path).mean(axis=1))
+            rows = np.array([index[self.keys[order]] for (order, xyz) in members],
+                            dtype=np.int32)
+            topologies.append((path, symmetry, rows))
+            for start in range(0, len(members), self.BATCH_SIZE):
+                stop = min(start + self.BATCH_SIZE, len(members))
+                tasks = [(path, distances_path, centroids_path, i, j, radius,
+                          self.superpose, symmetry) for (i, j) in self._chunks(start, stop)]
+                pairs = yield self._map(_search_chunk, tasks)
+                for i, j, rmsds in pairs:
+                    if dbscan is not None:
+                        dbscan.add(rows[i], rows[j], rmsds)
+                    if keep or dbscan is None:
+                        first.append(rows[i])
+                        second.append(rows[j])
+                        distances.append(rmsds if keep else rmsds.astype(np.float32))
+                        found += len(rmsds)
+                if keep and self.max_pairs is not None and found > self.max_pairs:
+                    if radius > self.cutoff:  # keep what this clustering needs
+                        radius = self.radius = self.cutoff
+                        for lists in (first, second, distances):
+                            lists[:] = [values[rmsds <= self.cutoff]
+                                        for (values, rmsds) in zip(lists, distances)]
+                        found = sum(len(rmsds) for rmsds in distances)
+                    if found > self.max_pairs:
+                        if self.method == 'Leader':  # the batches need no pairs
+                            self.radius = None
+                            return
+                        keep, self.radius = False, None
+                        if dbscan is not None:
+                            first, second, distances = [], [], []
+                        else:  # average linkage needs them all, in less memory
+                            distances[:] = [rmsds.astype(np.float32) for rmsds in distances]
+                self.progress = (done + stop, len(self.keys))
+            done += len(members)
+
+        if keep:
+            self.neighbours = NeighbourList.from_pairs(
+                keys, zip(first, second, distances), self.radius,
+                neighbours_signature(self.keys, self.superpose, symmetry=self.symmetry))
+            if dbscan is not None:
+                self.clusters = _clusters_from_labels(self.keys, self.neighbours,
+                                                      dbscan.labels())
+            return  # else, clustered from self.neighbours
+
+        self.stage = 'Clustering'
+        self.progress = (0, len(self.keys))
+        if dbscan is not None:
+            labels = dbscan.labels()
+        else:  # links of average linkage, with no neighbour list built
+            paths = [self._save(np.concatenate(values) if values else np.empty(0, dtype))
+                     for (values, dtype) in ((first, np.int32), (second, np.int32),
+                                             (distances, np.float32))]
+            del first[:], second[:], distances[:]
+            labels = yield self._apply(_linkage, (paths, len(keys), radius, self.cutoff), {})
+        # Without the pairs, the RMSDs to the representatives are computed again
+        rows = np.array([index[key] for key in self.keys], dtype=np.int64)
+        groups = _label_groups(labels, rows)
+        tasks, positions, count = self._representative_tasks(groups, rows, topologies)
+        rmsds = np.empty(count)
+        for part, values in zip(positions, (yield self._map(_pairs_chunk, tasks))):
+            rmsds[part] = values
+        self.clusters, cursor = [], 0
+        for group in groups:
+            cluster = [(self.keys[group[0]], None)]
+            cluster.extend(zip([self.keys[i] for i in group[1:]],
+                               rmsds[cursor:cursor + len(group) - 1].tolist()))
+            cursor += len(group) - 1
+            self.clusters.append(cluster)
+
+    def _representative_tasks(self, groups, rows, topologies):
+        """
+        Tasks of :func:`_pairs_chunk` that compute the RMSD of every
+        member of the `groups` (positions in `rows`) but the first to
+        the first, their positions in the concatenated results, and the
+        number of RMSDs.
+        """
+        others = [group[1:] for group in groups]
+        firsts = [np.repeat(group[0], len(group) - 1) for group in groups]
+        others = rows[np.concatenate(others)] if others else np.empty(0, dtype=np.int64)
+        firsts = rows[np.concatenate(firsts)] if firsts else np.empty(0, dtype=np.int64)
+        topology = np.empty(len(rows), dtype=np.int64)
+        local = np.empty(len(rows), dtype=np.int64)
+        for t, (path, symmetry, members) in enumerate(topologies):
+            topology[members] = t
+            local[members] = np.arange(len(members))
+        tasks, positions = [], []
+        for t, (path, symmetry, members) in enumerate(topologies):
+            selected = np.flatnonzero(topology[others] == t)  # both in the same topology
+            for i, j in self._chunks(0, len(selected)):
+                part = selected[i:j]
+                tasks.append((path, local[others[part]], local[firsts[part]], self.superpose,
+                              symmetry))
+                positions.append(part)
+        return tasks, positions, len(others)
+
+
+class _Finished(object):
+
+    """
+    Result of a step run synchronously, with the interface of
+    :class:`multiprocessing.pool.AsyncResult`.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
+# Memory-mapped arrays opened by this process, by path
+_MAPPED = {}
+
+
+def _mapped(path):
+    try:
+        return _MAPPED[path]
+    except KeyError:
+        array = _MAPPED[path] = np.load(path, mmap_mode='r')
+        return array
+
+
+def _read_chunk(paths):
+    results = []
+    for path in paths:
+        structure = read_solution_or_none(path)
+        if structure is None:
+            results.append(None)
+        else:
+            results.append((structure.signature, structure.heavy_coords()))
+    return results
+
+
+def _cluster(method, keys, rows, paths, radius, cutoff, **options):
+    indptr, indices, distances = [_mapped(path) for path in paths]
+    neighbours = NeighbourList(rows, indptr, indices, distances, radius, None)
+    return METHODS[method](keys, neighbours, cutoff, **options)
+
+
+def _linkage(paths, n, radius, cutoff):
+    first, second, total = [_mapped(path) for path in paths]
+    return _average_linkage(n, first, second, total, radius, cutoff)
+
+
+def _pairs_chunk(task):
+    path, first, second, superpose, symmetry = task
+    poses = _mapped(path)
+    return rmsd_pairs(poses[first], poses[second], superpose=superpose, symmetry=symmetry)
+
+
+def _reference_distances_chunk(task):
+    path, start, stop, references, superpose, symmetry = task
+    return rmsd_many_to_many(_mapped(path)[start:stop], references, superpose=superpose,
+                             symmetry=symmetry)
+
+
+def _match_chunk(task):
+    path, distances_path, start, stop, leaders, cutoff, superpose, symmetry = task
+    poses = _mapped(path)
+    leader_poses = poses[leaders]
+    centroids = distances = None
+    prune = len(leaders) > PRUNE_AFTER and not superpose
+    if prune:
+        centroids = leader_poses.mean(axis=1)
+    if prune and distances_path is not None:
+        distances = _mapped(distances_path)
+    leader_distances = None if distances is None else distances[leaders]
+    matches = []
+    for i in range(start, stop):
+        xyz = np.asarray(poses[i])
+        bound = None
+        if prune:
+            bound = _lower_bound(xyz.mean(axis=0), centroids,
+                                 None if distances is None else distances[i], leader_distances)
+        matches.append(_first_within(xyz, leader_poses, cutoff, superpose, bound, symmetry))
+    return matches
+
+
+def _search_chunk(task):
+    path, distances_path, centroids_path, start, stop, radius, superpose, symmetry = task
+    poses = _mapped(path)
+    sorted_by = bounds = None
+    if distances_path is not None:
+        distances = _mapped(distances_path)
+        centroids = None if centroids_path is None else _mapped(centroids_path)
+        sorted_by = distances[:, 0]
+
+        def bounds(i, candidates):
+            if centroids is None:
+                return _lower_bound(None, None, distances[i], distances[candidates])
+            return _lower_bound(centroids[i], centroids[candidates],
+                                distances[i], distances[candidates])
+
+    return search_rows(poses, start, stop, radius, superpose=superpose,
+                       sorted_by=sorted_by, bounds=bounds, tolerance=TOLERANCE,
+                       symmetry=symmetry)
@@ -0,0 +1,602 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Columnar storage for the results table.
+
+Instead of one dict per row, :class:`ColumnStore` keeps one NumPy array
+per numeric column and one list of interned strings per text column.
+It still behaves like the dict of dicts tkintertable expects
+(``store[key][column]``), through lightweight row views.
+
+Sort indexes are built per column on demand and kept until the column
+is written, so sorting the table again is just a lookup. Filters are
+evaluated as boolean masks over whole columns (see :func:`filter_mask`),
+using binary searches over sorted copies of numeric columns for range
+queries such as ``Vina < -8``.
+
+This module does not depend on Chimera.
+"""
+
+# Python
+from __future__ import print_function
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:  # Python 2
+    from collections import Mapping, MutableMapping
+from itertools import repeat
+import numbers
+import operator
+import sys
+# External dependencies
+import numpy as np
+
+try:
+    _intern = intern  # Python 2 builtin
+    basestring_ = basestring
+except NameError:
+    _intern = sys.intern
+    basestring_ = str
+
+FILTER_OPERATORS = ('=', '!=', '>', '<', '>=', '<=', 'contains')
+BOOLEAN_OPERATORS = ('AND', 'OR', 'NOT')
+RANGE_OPERATORS = ('=', '>', '<', '>=', '<=')
+_COMPARISONS = {'=': operator.eq, '!=': operator.ne, '>': operator.gt,
+                '<': operator.lt, '>=': operator.ge, '<=': operator.le}
+
+
+class ColumnStore(Mapping):
+
+    """
+    A table of results, stored by columns.
+
+    Parameters
+    ----------
+    keys : list of str
+        Row identifiers, usually the path to each solution.
+    columns : OrderedDict, optional
+        Column name -> values. Numeric sequences are stored as float64
+        arrays (without copying, if possible), anything else as a list of
+        interned strings.
+    kinds : dict, optional
+        Column name -> 'text', 'float' or 'int'. Guessed if not given.
+
+    Notes
+    -----
+    Missing numeric values are stored as NaN and reported as absent by
+    the row views, just like a missing key in a dict of dicts.
+    """
+
+    def __init__(self, keys, columns=None, kinds=None):
+        self._keys = list(keys)
+        self._index = dict((key, i) for (i, key) in enumerate(self._keys))
+        self.columns = OrderedDict()
+        self.kinds = {}
+        # (kind of index, column name, ...) -> array, see sort_index()
+        self._indexes = {}
+        kinds = kinds or {}
+        for name, values in (columns or {}).items():
+            self.add_column(name, values, kind=kinds.get(name))
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a store from a tkintertable-like dict of dicts:
+        ``{row_key: {column: value, ...}, ...}``.
+        """
+        names = []
+        for row in data.values():
+            for name in row:
+                if name not in names:
+                    names.append(name)
+        columns = OrderedDict((name, [row.get(name) for row in data.values()])
+                              for name in names)
+        return cls(list(data.keys()), columns)
+
+    # Mapping interface: row key -> row view
+    def __getitem__(self, key):
+        return _Row(self, self._index[key])
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    has_key = __contains__
+
+    # Row and column access
+    def row_index(self, key):
+        return self._index[key]
+
+    def key_at(self, i):
+        return self._keys[i]
+
+    def add_column(self, name, values=None, kind=None):
+        """
+        Add a new column. If `values` is None, the column is created empty.
+        Adding a column that already exists does nothing.
+        """
+        if name in self.columns:
+            return
+        n = len(self._keys)
+        if kind is None:
+            kind = 'float' if values is None else _guess_kind(values)
+        if kind == 'text':
+            if values is None:
+                values = [None] * n
+            column = [_intern_str(v) for v in values]
+        elif values is None:
+            column = np.full(n, np.nan)
+        else:
+            column = _as_float_array(values)
+        if len(column) != n:
+            raise ValueError('Column {} has {} values, expected {}'.format(name, len(column), n))
+        self.columns[name] = column
+        self.kinds[name] = kind
+
+    def get_value(self, i, name):
+        """
+        Value of column `name` at row number `i`, as a plain Python
+        object. Returns None if the value is missing.
+        """
+        value = self.columns[name][i]
+        kind = self.kinds[name]
+        if kind == 'text':
+            return value
+        if value != value:  # NaN
+            return None
+        if kind == 'int':
+            return int(value)
+        return float(value)
+
+    def set_value(self, i, name, value):
+        """
+        Set column `name` at row number `i`. Unknown columns are created.
+        """
+        if name not in self.columns:
+            self.add_column(name, kind='text' if isinstance(value, basestring_) else None)
+        if self.kinds[name] == 'text':
+            self.columns[name][i] = _intern_str(value)
+        else:
+            self.columns[name][i] = np.nan if value is None else float(value)
+        self.invalidate(name)
+
+    def set_values(self, name, keys, values):
+        """
+        Set column `name` for each of the row `keys` at once, so its
+        indexes are invalidated only once. The column must exist.
+        """
+        rows = [self._index[key] for key in keys]
+        column = self.columns[name]
+        if self.kinds[name] == 'text':
+            for i, value in zip(rows, values):
+                column[i] = _intern_str(value)
+        else:
+            column[rows] = [np.nan if value is None else float(value) for value in values]
+        self.invalidate(name)
+
+    # Sort indexes
+    def invalidate(self, name):
+        """
+        Forget the indexes built for column `name`. Called whenever the
+        column is written.
+        """
+        for key in [k for k in self._indexes if k[1] == name]:
+            del self._indexes[key]
+
+    def sort_index(self, name, reverse=False):
+        """
+        Row numbers that sort column `name`, built on first use and cached
+        until the column changes. The sort is stable and missing numbers
+        sort as 0.0, like tkintertable does.
+        """
+        key = ('sort', name, bool(reverse))
+        try:
+            return self._indexes[key]
+        except KeyError:
+            pass
+        column = self.columns[name]
+        if self.kinds[name] == 'text':
+            values = [v or '' for v in column]
+            index = np.array(sorted(range(len(values)), key=values.__getitem__,
+                                    reverse=bool(reverse)), dtype=np.intp)
+        else:
+            values = np.where(np.isnan(column), 0.0, column)
+            index = np.argsort(-values if reverse else values, kind='mergesort')
+        index.flags.writeable = False
+        self._indexes[key] = index
+        return index
+
+    def ranks(self, name):
+        """
+        Dense rank of each row in column `name` (equal values share rank),
+        suitable as a lexsort key. Cached like :meth:`sort_index`.
+        """
+        key = ('ranks', name)
+        try:
+            return self._indexes[key]
+        except KeyError:
+            pass
+        index = self.sort_index(name)
+        column = self.columns[name]
+        if self.kinds[name] == 'text':
+            ordered = [column[i] or '' for i in index]
+            changes = np.array([a != b for (a, b) in zip(ordered, ordered[1:])], dtype=bool)
+        else:
+            ordered = np.where(np.isnan(column), 0.0, column)[index]
+            changes = ordered[1:] != ordered[:-1]
+        ranks = np.empty(len(index), dtype=np.intp)
+        ranks[index] = np.concatenate([[0], np.cumsum(changes)]) if len(index) else []
+        ranks.flags.writeable = False
+        self._indexes[key] = ranks
+        return ranks
+
+    def strings(self, name):
+        """
+        Column `name` as displayed, in an object array of str. Missing
+        values are empty strings. Cached like :meth:`sort_index`.
+        """
+        key = ('strings', name)
+        try:
+            return self._indexes[key]
+        except KeyError:
+            pass
+        column = self.columns[name]
+        kind = self.kinds[name]
+        if kind == 'text':
+            values = [v if v is not None else '' for v in column]
+        elif kind == 'int':
+            values = ['' if v != v else str(int(v)) for v in column.tolist()]
+        else:
+            values = ['' if v != v else str(v) for v in column.tolist()]
+        strings = np.empty(len(values), dtype=object)
+        strings[:] = values
+        strings.flags.writeable = False
+        self._indexes[key] = strings
+        return strings
+
+    def present(self, name):
+        """
+        Boolean array, True where column `name` has a value.
+        """
+        column = self.columns[name]
+        if self.kinds[name] != 'text':
+            return ~np.isnan(column)
+        key = ('present', name)
+        try:
+            return self._indexes[key]
+        except KeyError:
+            pass
+        present = np.fromiter((v is not None for v in column), dtype=bool, count=len(column))
+        present.flags.writeable = False
+        self._indexes[key] = present
+        return present
+
+    def _joined(self, name):
+        """
+        Column `name` as displayed, joined in a single NUL-separated
+        string, plus the offset where each row starts.
+        """
+        key = ('joined', name)
+        try:
+            return self._indexes[key]
+        except KeyError:
+            pass
+        strings = self.strings(name).tolist()
+        starts = array('l', [0])
+        offset = 0
+        for string in strings:
+            offset += len(string) + 1
+            starts.append(offset)
+        joined = self._indexes[key] = '\0'.join(strings), starts
+        return joined
+
+    def _contains(self, name, value):
+        strings = self.strings(name)
+        if not value or '\0' in value:
+            return np.fromiter(map(operator.contains, strings.tolist(), repeat(value)),
+                               dtype=bool, count=len(strings))
+        text, starts = self._joined(name)
+        if text.count(value) > len(strings) // 8:
+            # Too many hits: testing every row is cheaper than jumping
+            return np.fromiter(map(operator.contains, strings.tolist(), repeat(value)),
+                               dtype=bool, count=len(strings))
+        # Few hits: let str.find skip over the rows that do not match
+        rows = []
+        i = text.find(value)
+        while i >= 0:
+            row = bisect_right(starts, i) - 1
+            rows.append(row)
+            i = text.find(value, starts[row + 1])
+        result = np.zeros(len(strings), dtype=bool)
+        result[np.array(rows, dtype=np.intp)] = True
+        return result
+
+    def range_index(self, name):
+        """
+        Sorted values of numeric column `name`, without the missing ones,
+        and the row each value comes from. Cached like :meth:`sort_index`.
+        """
+        key = ('range', name)
+        try:
+            return self._indexes[key]
+        except KeyError:
+            pass
+        column = self.columns[name]
+        rows = np.flatnonzero(~np.isnan(column))
+        rows = rows[np.argsort(column[rows], kind='mergesort')]
+        values = column[rows]
+        rows.flags.writeable = values.flags.writeable = False
+        index = self._indexes[key] = values, rows
+        return index
+
+    def is_range(self, name, op, value):
+        """
+        Whether filter ``<name> <op> value`` can be answered with
+        :meth:`range_rows`.
+        """
+        number = _number(value)
+        return (op in RANGE_OPERATORS and self.kinds.get(name, 'text') != 'text'
+                and number is not None and number == number)
+
+    def range_rows(self, name, op, value):
+        """
+        Rows whose column `name` satisfies ``<value in column> <op> value``,
+        found with a binary search over :meth:`range_index`. They are
+        returned in value order, not in row order.
+        """
+        values, rows = self.range_index(name)
+        number = float(value)
+        lo, hi = 0, len(values)
+        if op in ('<', '<='):
+            hi = np.searchsorted(values, number, 'left' if op == '<' else 'right')
+        elif op in ('>', '>='):
+            lo = np.searchsorted(values, number, 'right' if op == '>' else 'left')
+        elif op == '=':
+            lo = np.searchsorted(values, number, 'left')
+            hi = np.searchsorted(values, number, 'right')
+        else:
+            raise ValueError('{} is not a range operator'.format(op))
+        return rows[lo:hi]
+
+    def mask(self, name, op, value, rows=None):
+        """
+        Boolean array of the rows whose column `name` satisfies
+        ``<value in column> <op> value``.
+
+        Numeric columns are compared as numbers if `value` is a number;
+        everything else is compared as displayed text, like tkintertable's
+        ``filterBy``. Missing values never match.
+
+        If `rows` is given, only those rows are tested and the result has
+        one item per row in `rows`.
+        """
+        if op not in FILTER_OPERATORS:
+            raise ValueError('Unknown filter operator: {}'.format(op))
+        column = self.columns[name]
+        number = _number(value) if op != 'contains' else None
+        if self.kinds[name] != 'text' and number is not None:
+            if rows is None and self.is_range(name, op, number):
+                result = np.zeros(len(column), dtype=bool)
+                result[self.range_rows(name, op, number)] = True
+                return result
+            if rows is not None:
+                column = column[rows]
+            with np.errstate(invalid='ignore'):
+                result = _COMPARISONS[op](column, number)
+            if op == '!=':
+                result &= ~np.isnan(column)
+            return result
+        if rows is None:
+            if op == 'contains':
+                result = self._contains(name, value)
+            else:
+                result = np.asarray(_COMPARISONS[op](self.strings(name), value), dtype=bool)
+            return result & self.present(name)
+        strings = self.strings(name)[rows]
+        if op == 'contains':
+            result = np.fromiter(map(operator.contains, strings.tolist(), repeat(value)),
+                                 dtype=bool, count=len(strings))
+        else:
+            result = np.asarray(_COMPARISONS[op](strings, value), dtype=bool)
+        return result & self.present(name)[rows]
+
+    def lexsort(self, keys):
+        """
+        Row numbers sorted by several columns at once.
+
+        Parameters
+        ----------
+        keys : list of (str, bool)
+            Column name and `reverse` flag, most significant first.
+        """
+        keys = list(keys)
+        if not keys:
+            return np.arange(len(self), dtype=np.intp)
+        if len(keys) == 1:
+            return self.sort_index(*keys[0])
+        # np.lexsort sorts by the last key first
+        return np.lexsort([-self.ranks(name) if reverse else self.ranks(name)
+                           for (name, reverse) in reversed(keys)])
+
+    def longest(self, name):
+        """
+        Length of the longest entry in column `name`, as displayed.
+        """
+        column = self.columns[name]
+        if self.kinds[name] == 'text':
+            return max([len(str(v)) for v in column if v is not None] or [0])
+        present = column[~np.isnan(column)]
+        if not present.size:
+            return 0
+        if self.kinds[name] == 'int':
+            return max(len(str(int(present.min()))), len(str(int(present.max()))))
+        return max(len(str(v)) for v in present.tolist())
+
+
+def filter_mask(store, filters):
+    """
+    Evaluate several filters over a :class:`ColumnStore`.
+
+    Parameters
+    ----------
+    store : ColumnStore
+    filters : list of tuple
+        ``(column, value, operator, boolean)`` tuples, as returned by
+        tkintertable's ``FilterBar.getFilter``. They are combined left to
+        right, and the boolean operator of the first one is ignored, just
+        like ``Filtering.doFiltering`` does with sets of keys.
+
+    Returns
+    -------
+    Boolean array with one item per row of `store`.
+
+    Notes
+    -----
+    If the filters are only combined with AND and NOT, the most selective
+    numeric range filter is answered first with a binary search
+    (:meth:`ColumnStore.range_rows`), and the rest are only evaluated on
+    the rows it returned.
+    """
+    filters = list(filters)
+    if all(boolean in ('AND', 'NOT') for (_, _, _, boolean) in filters[1:]):
+        candidates = [(store.range_rows(column, op, value), i)
+                      for i, (column, value, op, boolean) in enumerate(filters)
+                      if (i == 0 or boolean == 'AND') and store.is_range(column, op, value)]
+        if candidates:
+            return _restricted_mask(store, filters, *min(candidates, key=lambda c: len(c[0])))
+    result = None
+    for column, value, op, boolean in filters:
+        mask = store.mask(column, op, value)
+        if result is None:
+            result = mask
+        elif boolean == 'AND':
+            result &= mask
+        elif boolean == 'OR':
+            result |= mask
+        elif boolean == 'NOT':
+            result &= ~mask
+        else:
+            raise ValueError('Unknown boolean operator: {}'.format(boolean))
+    if result is None:
+        return np.ones(len(store), dtype=bool)
+    return result
+
+
+def _restricted_mask(store, filters, rows, skip):
+    """
+    Mask for a conjunction of `filters`, given the `rows` that pass
+    filter number `skip`.
+    """
+    rows = np.sort(rows)
+    # Numeric filters first, so text filters are tested on fewer rows
+    rest = sorted((store.kinds.get(f[0]) == 'text', i) for i, f in enumerate(filters) if i != skip)
+    for _, i in rest:
+        if not len(rows):
+            break
+        column, value, op, boolean = filters[i]
+        mask = store.mask(column, op, value, rows=rows)
+        rows = rows[~mask] if i and boolean == 'NOT' else rows[mask]
+    result = np.zeros(len(store), dtype=bool)
+    result[rows] = True
+    return result
+
+
+class _Row(MutableMapping):
+
+    """
+    Dict-like view of one row of a :class:`ColumnStore`.
+    """
+
+    __slots__ = ('_store', '_i')
+
+    def __init__(self, store, i):
+        self._store = store
+        self._i = i
+
+    def __getitem__(self, name):
+        try:
+            value = self._store.get_value(self._i, name)
+        except KeyError:
+            raise KeyError(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self._store.set_value(self._i, name, value)
+
+    def __delitem__(self, name):
+        self._store.set_value(self._i, name, None)
+
+    def __iter__(self):
+        store, i = self._store, self._i
+        return (name for name in store.columns if store.get_value(i, name) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, name):
+        try:
+            return self._store.get_value(self._i, name) is not None
+        except KeyError:
+            return False
+
+    has_key = __contains__
+
+    def __repr__(self):
+        return '{{{}}}'.format(', '.join('{!r}: {!r}'.format(k, v) for (k, v) in self.items()))
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _intern_str(value):
+    if value is None:
+        return None
+    try:
+        return _intern(value)
+    except TypeError:  # unicode in Python 2
+        return value
+
+
+def _guess_kind(values):
+    if isinstance(values, (np.ndarray, array)):
+        return 'float'
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, numbers.Number):
+            return 'text'
+    return 'float'
+
+
+def _as_float_array(values):
+    if isinstance(values, array) and values.typecode == 'd':
+        column = np.frombuffer(values, dtype=np.float64)
+        if not column.flags.writeable:
+            column = column.copy()
+        return column
+    if isinstance(values, np.ndarray):
+        return values.astype(np.float64, copy=False)
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
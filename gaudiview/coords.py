@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Headless readers for the molecule files found in solutions.
+
+They only extract what GaudiView needs without opening the file in
+Chimera: atom serial numbers, coordinates and a signature of the
+topology (atom names, residues, bonds), so two files describing the
+same molecule in different conformations can be told apart cheaply.
+Clustering uses them to compare thousands of solutions without
+creating a single Chimera model.
+
+This module does not depend on Chimera.
+"""
+
+# Python
+from __future__ import print_function
+from collections import namedtuple
+import hashlib
+import zipfile
+# External dependencies
+import numpy as np
+# Own
+from gaudiview.parsers import map_in_pool, structure_members
+
+# Element symbols (or Mol2 atom types) that do not count as heavy atoms
+LIGHT_ELEMENTS = frozenset([b'H', b'D', b'LP', b'Du'])
+
+
+class Structure(namedtuple('Structure', 'signature serials coords heavy elements bonds')):
+
+    """
+    Contents of a molecule file.
+
+    signature : str
+        Hex digest of the topology. Equal signatures mean same atoms, in
+        the same order, with the same names, residues and bonds.
+    serials : list of int
+        Serial number of each atom, in file order.
+    coords : np.ndarray
+        (N, 3) float64 array of coordinates, in file order.
+    heavy : np.ndarray
+        (N,) boolean array, True for non-hydrogen atoms.
+    elements : list of str
+        Element symbol of each atom, in file order.
+    bonds : np.ndarray
+        (B, 2) int array of bonded atoms, as positions in file order.
+    """
+
+    __slots__ = ()
+
+    def heavy_coords(self):
+        """
+        (M, 3) coordinates of the heavy atoms, in file order. Structures
+        with the same signature list their atoms in the same order, so
+        their heavy coordinates can be compared row by row.
+        """
+        return self.coords[self.heavy]
+
+    def heavy_graph(self):
+        """
+        Molecular graph of the heavy atoms, in the order of
+        :meth:`heavy_coords`: their element symbols, and a (B, 2) int
+        array of the bonds between them.
+        """
+        index = np.full(len(self.heavy), -1, dtype=np.int64)
+        index[self.heavy] = np.arange(self.heavy.sum())
+        bonds = index[self.bonds].reshape(-1, 2)
+        bonds = bonds[(bonds >= 0).all(axis=1)]
+        elements = [element for (element, heavy) in zip(self.elements, self.heavy) if heavy]
+        return elements, bonds
+
+
+def read_structure(path):
+    """
+    Read a PDB or Mol2 file into a :class:`Structure`.
+
+    Raises
+    ------
+    ValueError
+        If the file format is not supported or the file has no atoms.
+    """
+    with open(path, 'rb') as f:
+        return parse_structure(f.read(), path)
+
+
+def parse_structure(data, name):
+    """
+    Parse the contents of a PDB or Mol2 file, whose format is guessed
+    from the extension of `name`.
+    """
+    if name.endswith('.mol2'):
+        return _read_mol2(data.splitlines())
+    if name.endswith('.pdb'):
+        return _read_pdb(data.splitlines())
+    raise ValueError('Unsupported molecule file: {}'.format(name))
+
+
+def read_solution(path):
+    """
+    Read the ligand of a solution without opening it in Chimera.
+
+    Molecule files (GOLD solutions) are read as they are. For GaudiMM
+    zips, the smallest molecule file in the archive is read straight
+    from memory, with no extraction. That is the one with the fewest
+    atoms (the ligand) for any sensible run, and the first model
+    returned by the GaudiMM controller when displaying the solution.
+    """
+    if not zipfile.is_zipfile(path):
+        return read_structure(path)
+    with zipfile.ZipFile(path) as z:
+        members = structure_members(z)
+        if not members:
+            raise ValueError('No molecule files in {}'.format(path))
+        smallest = min(members, key=lambda info: info.file_size)
+        return parse_structure(z.read(smallest), smallest.filename)
+
+
+def read_solutions(paths, workers=None):
+    """
+    :func:`read_solution` for each of `paths`, in a pool of processes
+    (see :func:`gaudiview.parsers.map_in_pool`).
+
+    Returns
+    -------
+    A list parallel to `paths`, with None for the files that could not
+    be read.
+    """
+    return map_in_pool(read_solution_or_none, paths, workers=workers, chunksize=64)
+
+
+def read_solution_or_none(path):
+    """
+    :func:`read_solution`, returning None if `path` cannot be read.
+    """
+    try:
+        return read_solution(path)
+    except (IOError, OSError, ValueError, zipfile.BadZipfile):
+        return None
+
+
+def _read_pdb(lines):
+    topology = hashlib.sha1()
+    serials, coords, heavy, elements, bonds = [], [], [], [], []
+    for line in lines:
+        record = line[:6]
+        if record in (b'ATOM  ', b'HETATM'):
+            serials.append(int(line[6:11]))
+            coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+            # element columns, or the first letter of the atom name if empty
+            element = line[76:78].strip() or line[12:16].strip().lstrip(b'0123456789')[:1]
+            elements.append(element.capitalize())
+            heavy.append(element.capitalize() not in LIGHT_ELEMENTS)
+            # name, altloc, residue name, chain, residue number, insertion code
+            topology.update(line[6:27])
+            topology.update(line[76:78].strip() + b'\n')
+        elif record in (b'CONECT', b'TER   '):
+            topology.update(line.rstrip() + b'\n')
+            if record == b'CONECT':
+                atom = int(line[6:11])
+                for start in range(11, 31, 5):
+                    if line[start:start + 5].strip():
+                        bonds.append((atom, int(line[start:start + 5])))
+    return _structure(topology, serials, coords, heavy, elements, bonds)
+
+
+def _read_mol2(lines):
+    topology = hashlib.sha1()
+    serials, coords, heavy, elements, bonds = [], [], [], [], []
+    section = None
+    for line in lines:
+        if line.startswith(b'@<TRIPOS>'):
+            section = line.strip()
+            if len(serials) and section == b'@<TRIPOS>MOLECULE':
+                break  # only the first molecule of multi-mol2 files
+            continue
+        fields = line.split()
+        if not fields:
+            continue
+        if section == b'@<TRIPOS>ATOM':
+            serials.append(int(fields[0]))
+            coords.append((float(fields[2]), float(fields[3]), float(fields[4])))
+            elements.append(fields[5].split(b'.')[0])
+            heavy.append(elements[-1] not in LIGHT_ELEMENTS)
+            # id, name, type, residue number and name
+            topology.update(b' '.join([fields[0], fields[1]] + fields[5:8]) + b'\n')
+        elif section == b'@<TRIPOS>BOND':
+            topology.update(b' '.join(fields[1:4]) + b'\n')
+            bonds.append((int(fields[1]), int(fields[2])))
+    return _structure(topology, serials, coords, heavy, elements, bonds)
+
+
+def _structure(topology, serials, coords, heavy, elements, bonds):
+    if not serials:
+        raise ValueError('No atoms found')
+    # Bonds are read as pairs of serial numbers; those to unknown atoms are dropped
+    position = dict((serial, i) for (i, serial) in enumerate(serials))
+    bonds = [(position[a], position[b]) for (a, b) in bonds if a in position and b in position]
+    return Structure(topology.hexdigest(), serials, np.array(coords, dtype=np.float64),
+                     np.array(heavy, dtype=bool), elements,
+                     np.array(bonds, dtype=np.int64).reshape(-1, 2))
@@ -31,8 +31,9 @@ For the controller, these are:
 :meth:`process` Get metadata from model and display it. (called
                 on double clicks).
 
-:meth:`get_table_dict:  Return a dict formatted as requested by
-                        tkintertable.
+:meth:`get_table_dict:  Return a :class:`gaudiview.columns.ColumnStore`
+                        (or a dict of dicts formatted as requested by
+                        tkintertable).
 
 For the model, there are no concrete methods. You must implement:
 
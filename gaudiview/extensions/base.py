@@ -22,11 +22,11 @@ import importlib
 import chimera
 import Midas
 import os
+import traceback
 from functools import partial
-try:
-    from subalign import untransformed_rmsd as calculate_rmsd
-except (ImportError, chimera.UserError):
-    calculate_rmsd = lambda ref, probe: Midas.rmsd(ref.atoms, probe.atoms, log=False)
+from gaudiview.cache import BoundedCache, LRUCache
+from gaudiview.clustering import ClusteringJob, MIN_SAMPLES, leader_clustering_from_neighbours
+from gaudiview.neighbours import NeighbourList, neighbours_signature
 
 FORMATS = {
     'GaudiMM results': 'gaudiview.extensions.gaudireader',
@@ -55,14 +55,49 @@ class GaudiViewBaseController(object):
 
     __metaclass__ = abc.ABCMeta
 
+    #: Opened solutions kept in memory (None for no limit). Selected or
+    #: displayed solutions are never closed, even if that means going
+    #: over these limits.
+    MODEL_CACHE_SIZE = 200
+    MODEL_CACHE_ATOMS = 2000000
+    #: Processes used for clustering (None for one per CPU)
+    CLUSTER_WORKERS = None
+    #: Compare poses after optimal superposition instead of in place
+    CLUSTER_SUPERPOSE = False
+    #: Take the lowest RMSD over the symmetric orderings of the ligand atoms
+    CLUSTER_SYMMETRY = True
+    #: Milliseconds between checks of a running clustering job
+    CLUSTER_POLL_INTERVAL = 100
+    #: RMSDs up to this radius (or the cutoff, if larger) are kept after
+    #: clustering, so the same solutions can be clustered again at any
+    #: cutoff below it without computing any RMSD. None to disable.
+    #: Computing them makes the first clustering slower than the leader
+    #: algorithm alone (about twice, in place), so it is not done when
+    #: superposing, where every RMSD is much more expensive.
+    CLUSTER_CACHE_RADIUS = 2.0
+    #: Pairs of solutions within that radius kept, at most. Past that, only
+    #: the pairs within the cutoff are kept, and if there are still too
+    #: many, none is.
+    CLUSTER_CACHE_PAIRS = 2000000
+    #: Also keep those RMSDs next to the input file, for later sessions
+    CLUSTER_CACHE_ON_DISK = True
+    #: Poses (themselves included) within the cutoff of a DBSCAN core pose
+    CLUSTER_MIN_SAMPLES = MIN_SAMPLES
+
     def __init__(self, model=None, path=None, gui=None, *args, **kwargs):
         self.path = path
         self.gui = gui
         self.model = model(path)
+        self.model.molecules = BoundedCache(
+            maxsize=self.MODEL_CACHE_SIZE, maxweight=self.MODEL_CACHE_ATOMS,
+            weigh=self.weigh, evict=self.evict, pinned=self.is_pinned)
         self.molecules = self.model.molecules
         self.metadata = self.model.metadata
         self.selected = []
         self.displayed = []
+        self._clustering = None
+        self._clustering_poll = None
+        self._neighbours = LRUCache(4)  # signature -> NeighbourList
         self.HAS_DETAILS = True
         self.HAS_SELECTION = True
         self.HAS_MORE_GUI = False
@@ -89,10 +124,43 @@ class GaudiViewBaseController(object):
             else:
                 self.selected.append(molpath)
 
+    def owned(self, molecules):
+        """
+        Subset of `molecules` that belongs to a single entry of
+        `self.molecules`. Only those are weighed, checked for display
+        and closed by the model cache. Override if models are shared.
+        """
+        return molecules
+
+    def weigh(self, molecules):
+        return sum(m.numAtoms for m in self.owned(molecules))
+
+    def is_pinned(self, key, molecules):
+        """
+        Whether the models opened for `key` must stay open.
+        """
+        return key in self.selected or any(m.display for m in self.owned(molecules))
+
+    def evict(self, key, molecules):
+        """
+        Close the models of `key`, removed from `self.molecules` to save
+        memory. They will be opened again by :meth:`display` if needed.
+        """
+        molecules = self.owned(molecules)
+        self.displayed[:] = [m for m in self.displayed if m not in molecules]
+        chimera.openModels.close(molecules)
+
     # GUI Handlers
     def close_all(self):
-        chimera.openModels.close(
-            [m_ for m in self.model.molecules.values() for m_ in m])
+        self.cancel_clustering()
+        chimera.openModels.close(self.opened())
+
+    def opened(self):
+        """
+        Every model opened for this file. Override if some of them are
+        not listed in `self.molecules`, like shared models.
+        """
+        return list(set(m_ for m in self.model.molecules.values() for m_ in m))
 
     def double_click(self, trigger, data, row):
         """
@@ -105,6 +173,13 @@ class GaudiViewBaseController(object):
         else:
             self.process(key, row=row)
 
+    def order_changed(self, trigger, data, row):
+        """
+        Triggered when the table is sorted or filtered. Override if the
+        controller keeps state that depends on the row order.
+        """
+        pass
+
     def extend_gui(self):
         """
         Adds more stuff to the GUI. Overwrite if needed, and set
@@ -234,67 +309,140 @@ class GaudiViewBaseController(object):
     def get_table_dict(self):
         pass
 
+    def solution_path(self, key):
+        """
+        File holding solution `key`, read by :meth:`cluster` with
+        :func:`gaudiview.coords.read_solution`. Override if keys
+        are not paths.
+        """
+        return key
+
     def cluster(self):
+        """
+        Cluster the selected solutions (or all of them) by RMSD in the
+        background, with the method chosen in the GUI (see
+        :data:`gaudiview.clustering.METHODS`), and write the result in
+        the `Cluster` column.
+        """
+        if self._clustering is not None:
+            self.gui.info('Clustering is still running')
+            return
         cutoff = float(self.gui.cluster_cutoff.get())
+        method = self.gui.cluster_method.get()
+        options = {'min_samples': self.CLUSTER_MIN_SAMPLES} if method == 'DBSCAN' else {}
         column = self.gui.cluster_key.get()
         reverse = bool(self.gui.table.tablecolheader.reversedcols[column])
 
-        if 'Cluster' not in self.gui.table.model.columnlabels:
-            self.gui.table.addColumn('Cluster')
-            self.gui.table.tablecolheader.reversedcols['Cluster'] = 0
         data = self.gui.table.model.data
         if len(self.selected) > 1:
             data = [(k, data[k]) for k in self.selected]
         else:
             data = data.items()
         data.sort(key=lambda item: item[1][column], reverse=not reverse)
-
-        if self.HAS_SELECTION:
-            marked = [self.gui.selection_listbox.get(i)
-                      for i in self.gui.selection_listbox.curselection()]
-        else:
-            marked = None
-        solutions = []
-        # for key, row in data:
-        #     if marked is not None:
-        #         mols = [m for m in self.display(key) if m.openedAs[0] in marked]
-        #     else:
-        #         mols = self.display(key)
-        #     if len(mols) == 1:
-        #         solutions.append((key, mols[0]))
-        #     else:
-        #         raise chimera.UserError('Only one molecule must be selected '
-        #                                 'for clustering')
-        for key, row in data:
-            solutions.append((key, self.display(key)[0]))
-        seed = solutions.pop() + (None,)
-        clusters = [[seed]]
-        while solutions:
-            seed_key, seed_mol = solutions.pop()
-            for cluster in clusters:
-                cluster_key, cluster_mol, _ = cluster[0]
-                rmsd = calculate_rmsd(cluster_mol, seed_mol)
-                if rmsd < cutoff:
-                    cluster.append((seed_key, seed_mol, rmsd))
-                    break
-            else:
-                clusters.append([(seed_key, seed_mol, None)])
-
+        # Solutions are visited from the end of the sorted list
+        keys = [key for key, row in reversed(data)]
+
+        neighbours = self._cached_neighbours(keys, cutoff)
+        if neighbours is not None and method == 'Leader':
+            self._write_clusters(leader_clustering_from_neighbours(keys, neighbours, cutoff),
+                                 column)
+            return
+        radius = None
+        if neighbours is None:
+            if self.CLUSTER_CACHE_RADIUS is not None and not self.CLUSTER_SUPERPOSE:
+                radius = max(cutoff, self.CLUSTER_CACHE_RADIUS)
+            elif method != 'Leader':
+                radius = cutoff
+        # Heavy atoms of each ligand are read from disk: no model is opened
+        self._clustering = ClusteringJob(keys, [self.solution_path(key) for key in keys],
+                                         cutoff, superpose=self.CLUSTER_SUPERPOSE,
+                                         symmetry=self.CLUSTER_SYMMETRY,
+                                         workers=self.CLUSTER_WORKERS, radius=radius,
+                                         method=method, options=options,
+                                         neighbours=neighbours,
+                                         max_pairs=self.CLUSTER_CACHE_PAIRS)
+        self._poll_clustering(column)
+
+    def _poll_clustering(self, column):
+        job = self._clustering
+        self._clustering_poll = None
+        try:
+            finished = job.poll()
+        except Exception as e:  # the job is closed, so another one can start
+            self._clustering = None
+            if not isinstance(e, (IOError, OSError, ValueError)):
+                traceback.print_exc()
+            self.gui.error('Clustering failed: {}'.format(str(e) or type(e).__name__))
+            return
+        if not finished:
+            done, total = job.progress
+            self.gui.info('{}... {}/{}'.format(job.stage, done, total), blankAfter=0)
+            self._clustering_poll = self.gui.table.after(self.CLUSTER_POLL_INTERVAL,
+                                                         self._poll_clustering, column)
+            return
+        self._clustering = None
+        if job.radius is not None:  # computed now, not read from the cache
+            self._store_neighbours(job.neighbours)
+        self._write_clusters(job.clusters, column)
+
+    def _cached_neighbours(self, keys, cutoff):
+        """
+        RMSDs computed before for this very set of solutions, up to a
+        radius not below `cutoff`, from memory or from disk.
+        """
+        signature = neighbours_signature(keys, self.CLUSTER_SUPERPOSE,
+                                         symmetry=self.CLUSTER_SYMMETRY)
+        neighbours = self._neighbours.get(signature)
+        if neighbours is not None and neighbours.covers(signature, cutoff):
+            return neighbours
+        if self.CLUSTER_CACHE_ON_DISK and self.path:
+            neighbours = NeighbourList.load(self.path, signature, cutoff)
+            if neighbours is not None:
+                self._neighbours[signature] = neighbours
+                return neighbours
+        return None
+
+    def _store_neighbours(self, neighbours):
+        self._neighbours[neighbours.signature] = neighbours
+        if self.CLUSTER_CACHE_ON_DISK and self.path:
+            neighbours.save(self.path, dependencies=[self.solution_path(key)
+                                                     for key in neighbours.keys])
+
+    def cancel_clustering(self):
+        if self._clustering_poll is not None:
+            self.gui.table.after_cancel(self._clustering_poll)
+            self._clustering_poll = None
+        if self._clustering is not None:
+            self._clustering.close()
+            self._clustering = None
+
+    def _write_clusters(self, clusters, column):
+        """
+        Store cluster numbers in the `Cluster` column, all at once, and
+        print a summary of each cluster.
+        """
+        if 'Cluster' not in self.gui.table.model.columnlabels:
+            self.gui.table.model.data.add_column('Cluster', kind='int')
+            self.gui.table.addColumn('Cluster')
+            self.gui.table.tablecolheader.reversedcols['Cluster'] = 0
+        data = self.gui.table.model.data
+        keys, numbers = [], []
         print('#\tSize\tRMSD\t{}'.format(column))
         for index, cluster in enumerate(clusters):
             rmsds = []
             column_values = []
-            for key, molecule, rmsd in cluster:
-                self.gui.table.model.data[key]['Cluster'] = index + 1
-                column_values.append(float(self.gui.table.model.data[key][column]))
+            for key, rmsd in cluster:
+                keys.append(key)
+                numbers.append(index + 1)
+                column_values.append(float(data[key][column]))
                 if rmsd is not None:
                     rmsds.append(rmsd)
             avg_rmsd = round(sum(rmsds)/len(rmsds), 3) if rmsds else 0.0
             avg_column_values = round(sum(column_values)/len(column_values), 3)
             print('\t'.join(map(str, (index+1, len(cluster), avg_rmsd, avg_column_values))))
-
+        data.set_values('Cluster', keys, numbers)
         self.gui.table.redrawTable()
-
+        self.gui.info('{} clusters found'.format(len(clusters)))
 
 
 class GaudiViewBaseModel(object):
@@ -316,15 +464,19 @@ class GaudiViewBaseModel(object):
 
         :molecules: A dictionary that allocates already processed molecules, as
                     opened by Chimera. The key is the base filename, whose value
-                    is a list of `chimera.Molecule` objects.
+                    is a list of `chimera.Molecule` objects. The controller
+                    replaces it with a :class:`gaudiview.cache.BoundedCache`,
+                    so entries can disappear (and their models be closed)
+                    when they are not in use.
 
         :metadata:  A dictionary that allocates metadata about each processed
                     molecule. It's a parallel dict to `self.molecules`, so the
                     keys are the same. The values should be lists of strings,
                     since they will end up in the details field of the GUI.
 
-        :data:      These holds the parsed input file. If it's not in the
-                    format requested by tkintertable, use a second attribute called
+        :data:      These holds the parsed input file. If it's not a
+                    :class:`gaudiview.columns.ColumnStore` (or a dict of dicts,
+                    as requested by tkintertable), use a second attribute called
                     `table_data` and remember to return it with
                     `controller.get_table_dict()`
 
@@ -12,15 +12,25 @@
 
 # Python
 from __future__ import absolute_import
+import base64
+import multiprocessing
 import os
+import pickle
+import Queue
+import shutil
 import subprocess
+import sys
 import tempfile
+import threading
+import traceback
 import chimera
 import Tkinter as tk
 import Pmw
 from importlib import import_module
 # Internal dependencies
 from gaudiview.extensions.base import GaudiViewBasePlugin
+from gaudiview.parsers import extract_structures
+from gaudiview import scores
 from libtangram.ui import TangramBaseDialog
 if not chimera.nogui:
     from gaudiview.gui import error, info
@@ -49,20 +59,398 @@ class GaudiObjectivePlugin(GaudiViewBasePlugin):
     }
 
     def do(self, proteinpath, ligandpath, objective, obj_kwargs):
-        from gaudi.base import MolecularIndividual, expressed
+        session = RescoringSession(objective, obj_kwargs)
+        try:
+            return session.score(proteinpath, ligandpath)
+        finally:
+            session.close()
+
+
+class RescoringSession(object):
+
+    """
+    Scores ligands against a receptor with a GaudiMM objective, setting
+    up the objective and the receptor only once. The receptor is loaded
+    again only when a ligand comes with a different one (compared by
+    file contents), so a batch of poses docked to the same receptor pays
+    its parsing and preparation once.
+
+    Parameters
+    ----------
+    objective : class
+        GaudiMM objective.
+    objective_kwargs : dict
+        Options of the objective.
+    """
+
+    def __init__(self, objective, objective_kwargs):
+        self.objective = objective(**objective_kwargs)
+        self.individual = None
+        self.receptor = None  # digest of the loaded receptor file
+
+    def score(self, proteinpath, ligandpath):
+        """
+        Score of the ligand in `ligandpath` against the receptor in
+        `proteinpath`.
+        """
+        from gaudi.base import expressed
         from gaudi.genes.molecule import Molecule
-        individual = MolecularIndividual(dummy=True)
-        individual.genes['Protein'] = protein = Molecule(path=proteinpath)
+        self._load_receptor(proteinpath)
+        individual = self.individual
         individual.genes['Ligand'] = ligand = Molecule(path=ligandpath)
+        try:
+            ligand.__ready__()
+            ligand.__expression_hooks__()
+            with expressed(individual):
+                return self.objective.evaluate(individual)
+        finally:
+            ligand.compound.destroy()
+            del individual.genes['Ligand']
+
+    def close(self):
+        """
+        Destroy the receptor.
+        """
+        if self.individual is not None:
+            self.individual.genes['Protein'].compound.destroy()
+        self.individual = self.receptor = None
+
+    def _load_receptor(self, path):
+        from gaudi.base import MolecularIndividual
+        from gaudi.genes.molecule import Molecule
+        digest = scores.file_digest(path)  # already known if the score was looked up
+        if digest == self.receptor:
+            return
+        self.close()
+        individual = MolecularIndividual(dummy=True)
+        individual.genes['Protein'] = Molecule(path=path)
         individual.__ready__()
         individual.__expression_hooks__()
-        obj = objective(**obj_kwargs)
-        with expressed(individual):
-            score = obj.evaluate(individual)
-        individual.genes['Protein'].compound.destroy()
-        individual.genes['Ligand'].compound.destroy()
-        del individual
-        return score
+        self.individual, self.receptor = individual, digest
+
+
+class RescoringJob(object):
+
+    """
+    Scores of many solutions with a GaudiMM objective, collected with
+    :meth:`poll`, so the caller's event loop (Tk's, in Chimera) is never
+    blocked for long. Scores are returned as soon as each one is ready.
+
+    Solutions are scored by worker processes: fresh ``chimera --nogui``
+    instances running :mod:`gaudiview.extensions.rescoring_worker`, not
+    forks of the current process, so they share nothing with the GUI.
+    Each one is sent a few tasks at a time through its stdin, and
+    writes the results to its stdout as it goes; a thread per worker
+    reads them. With a single worker, or if Chimera cannot be started,
+    one solution is scored per poll, in the current process instead.
+
+    Each worker, or the current process, extracts the molecule files of
+    its solutions and scores them in a :class:`RescoringSession` kept for
+    the whole job, so the receptor is only prepared once. Scores found in
+    the :mod:`gaudiview.scores` cache are returned without computing
+    them, and new ones are added to it.
+
+    Parameters
+    ----------
+    tasks : list of (key, path, destination, remove)
+        Solution zip of each key, where to extract its files and whether
+        to remove them once scored.
+    objective : class
+        GaudiMM objective.
+    objective_kwargs : dict
+        Options of the objective.
+    workers : int, optional
+        Number of worker processes, None for one per CPU.
+    cache : bool, optional
+        Use the persistent score cache.
+
+    Attributes
+    ----------
+    progress : tuple of int
+        Solutions scored and total solutions.
+    cached : int
+        Scores read from the cache.
+    failed : list of (key, str)
+        Solutions that could not be scored, and why.
+    workers : list
+        Worker processes still running. Empty if solutions are scored
+        in the current process.
+    """
+
+    #: Command that starts Chimera, None to use the one running GaudiView
+    CHIMERA = None
+    #: Tasks sent to each worker ahead of its results
+    TASKS_AHEAD = 2
+
+    def __init__(self, tasks, objective, objective_kwargs, workers=None, cache=True):
+        self.cache = scores.ScoreCache() if cache else None
+        cache_path = self.cache.path if cache else None
+        self.tasks = [(key, path, destination, remove, objective, objective_kwargs,
+                       cache_path)
+                      for (key, path, destination, remove) in tasks]
+        self.progress = (0, len(self.tasks))
+        self.cached = 0
+        self.failed = []
+        self.done = not self.tasks
+        self.workers = []
+        self._results = Queue.Queue()
+        self._unsent = self.tasks[::-1]  # next one last
+        workers = min(workers or multiprocessing.cpu_count(), len(self.tasks))
+        if workers > 1:
+            command = [self.CHIMERA or chimera_command(), '--nogui', '--silent',
+                       os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'rescoring_worker.py')]
+            try:
+                for _ in range(workers):
+                    self.workers.append(_Worker(command, self._results))
+            except (OSError, IOError) as e:
+                print('Rescoring in this process: could not start Chimera ({})'.format(e))
+                self._close_workers()
+        for worker in self.workers:
+            self._feed(worker)
+        self._local = (_rescore(task) for task in self.tasks)
+
+    def poll(self):
+        """
+        Scores finished since the last call, as a list of ``(key, score)``.
+        Check :attr:`done` to know when the job is over.
+        """
+        found, computed = [], []
+        while not self.done:
+            if self.workers:
+                try:
+                    worker, result = self._results.get_nowait()
+                except Queue.Empty:
+                    break
+                if result is None:  # the worker exited
+                    self._lost(worker)
+                    continue
+                worker.pending.pop(0)
+                self._feed(worker)
+            else:
+                result = next(self._local)
+            key, score, error, digest = result
+            if error is not None:
+                self.failed.append((key, error))
+            else:
+                found.append((key, score))
+                if digest is None:
+                    self.cached += 1
+                else:
+                    computed.append((digest, score))
+            self._count(1)
+            if not self.workers:
+                break
+        if computed and self.cache is not None:
+            self.cache.put_many(computed)
+        return found
+
+    def close(self):
+        """
+        Stop the workers. Solutions not scored yet are dropped.
+        """
+        self.done = True
+        self._close_workers()
+        _close_session()  # do not keep the receptor open in this process
+        if self.cache is not None:
+            self.cache.close()
+
+    def _close_workers(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+    def _feed(self, worker):
+        while len(worker.pending) < self.TASKS_AHEAD and self._unsent:
+            task = self._unsent.pop()
+            worker.pending.append(task)
+            try:
+                worker.send(task)
+            except (OSError, IOError):  # it exited, which is handled when read
+                break
+
+    def _lost(self, worker):
+        """
+        Fail the task a worker was scoring when it exited, and give the
+        others it was sent to the rest of workers. If none is left, they
+        all fail.
+        """
+        error = 'The rescoring process exited with code {}'.format(worker.process.wait())
+        self.workers.remove(worker)
+        lost = worker.pending[:1]
+        self._unsent.extend(reversed(worker.pending[1:]))
+        if not self.workers:
+            lost.extend(reversed(self._unsent))
+            self._unsent = []
+        self.failed.extend((task[0], error) for task in lost)
+        for other in self.workers:
+            self._feed(other)
+        self._count(len(lost))
+
+    def _count(self, scored):
+        self.progress = (self.progress[0] + scored, self.progress[1])
+        if self.progress[0] >= self.progress[1]:
+            self.close()
+
+
+class _Worker(object):
+
+    """
+    A rescoring worker process, whose results are put in `results`
+    by a thread as pairs ``(worker, result)``, and ``(worker, None)``
+    when it exits.
+    """
+
+    def __init__(self, command, results):
+        self.pending = []  # tasks sent, in order
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=os.name != 'nt')
+        try:
+            self.send(sys.path)
+        except (OSError, IOError):
+            self.process.kill()
+            raise
+        thread = threading.Thread(target=self._read, args=(results,))
+        thread.daemon = True
+        thread.start()
+
+    def send(self, item):
+        self.process.stdin.write(_encode(item))
+        self.process.stdin.flush()
+
+    def close(self):
+        """
+        Let the worker exit once idle, or kill it if it is not.
+        """
+        try:
+            self.process.stdin.close()
+        except (OSError, IOError):
+            pass
+        if self.pending and self.process.poll() is None:
+            self.process.terminate()
+
+    def _read(self, results):
+        for line in iter(self.process.stdout.readline, b''):
+            if line.startswith(_PREFIX):  # else, printed by Chimera before the worker
+                results.put((self, _decode(line)))
+        self.process.stdout.close()
+        self.process.wait()
+        results.put((self, None))
+
+
+def chimera_command():
+    """
+    Path of the ``chimera`` executable running this session, or just
+    its name, to find it in the PATH.
+    """
+    name = 'chimera.exe' if os.name == 'nt' else 'chimera'
+    root = os.environ.get('CHIMERA')  # set by Chimera's launcher
+    if root and os.path.isfile(os.path.join(root, 'bin', name)):
+        return os.path.join(root, 'bin', name)
+    return name
+
+
+def serve(tasks, results):
+    """
+    Work loop of a rescoring worker: score each task read from the
+    `tasks` file, until it is closed, and write each result to the
+    `results` file as soon as it is ready.
+    """
+    try:
+        for line in iter(tasks.readline, b''):
+            results.write(_encode(_rescore(_decode(line))))
+            results.flush()
+    finally:
+        _close_session()
+        for cache in _CACHES.values():
+            cache.close()
+
+
+_PREFIX = b'gaudiview-rescoring'
+
+
+def _encode(item):
+    """
+    `item` as a single line, marked so it is not mistaken for output
+    of anything else.
+    """
+    return _PREFIX + b' ' + base64.b64encode(pickle.dumps(item, 2)) + b'\n'
+
+
+def _decode(line):
+    return pickle.loads(base64.b64decode(line.split()[-1]))
+
+
+_SESSION = [None, None]  # (objective, options), RescoringSession of this process
+
+
+def _session(objective, objective_kwargs):
+    """
+    The session of this process for `objective`, kept between tasks so
+    the receptor is only prepared once per worker.
+    """
+    settings = (objective, sorted(objective_kwargs.items()))
+    if _SESSION[0] != settings:
+        _close_session()
+        _SESSION[:] = settings, RescoringSession(objective, objective_kwargs)
+    return _SESSION[1]
+
+
+def _close_session():
+    if _SESSION[1] is not None:
+        _SESSION[1].close()
+    _SESSION[:] = None, None
+
+
+_CACHES = {}  # path -> ScoreCache of this process
+
+
+def _cached_score(cache_path, digest):
+    try:
+        cache = _CACHES[cache_path]
+    except KeyError:
+        cache = _CACHES[cache_path] = scores.ScoreCache(cache_path)
+    return cache.get(digest)
+
+
+def _rescore(task):
+    """
+    Score one solution, in a worker or in the current process. Errors
+    are returned, not raised, so a broken solution does not stop the
+    whole job.
+
+    Returns
+    -------
+    key, score, error, and the cache key of the score if it had to be
+    computed (None if it was cached).
+    """
+    key, path, destination, remove, objective, objective_kwargs, cache_path = task
+    try:
+        try:
+            os.mkdir(destination)
+        except OSError:  # Assume it exists
+            pass
+        names, paths = extract_structures(path, destination)
+        if len(paths) < 2:
+            raise ValueError('{} does not contain a receptor and a ligand'.format(path))
+        paths.sort(key=os.path.getsize)
+        receptor, ligand = paths[-1], paths[0]
+        digest = None
+        if cache_path is not None:
+            name = '{}.{}'.format(objective.__module__, objective.__name__)
+            digest = scores.score_key(receptor, ligand, name, objective_kwargs)
+            score = _cached_score(cache_path, digest)
+            if score is not None:
+                return key, score, None, None
+        score = _session(objective, objective_kwargs).score(receptor, ligand)
+        return key, score, None, digest
+    except Exception:
+        return key, None, traceback.format_exc(), None
+    finally:
+        if remove:  # extracted to a RAM-backed dir, for this task only
+            shutil.rmtree(destination, ignore_errors=True)
+
 
 class GaudiObjectiveDialog(TangramBaseDialog):
 
@@ -14,17 +14,22 @@
 from __future__ import print_function
 from collections import OrderedDict
 import zipfile
-import tempfile
 import os
+import shutil
 import Tkinter
 # Chimera
 import chimera
 import Rotamers
 # External dependencies
-import yaml
+import numpy as np
 # Internal dependencies
 from gaudiview.extensions.base import GaudiViewBaseModel, GaudiViewBaseController
 from gaudiview.extensions import dsx
+from gaudiview.cache import read_cache, write_cache, ram_mkdtemp
+from gaudiview.columns import ColumnStore
+from gaudiview.coords import read_structure
+from gaudiview.parsers import parse_gaudi_output, extract_structures
+from gaudiview.prefetch import Prefetcher, neighbours
 
 
 def load(*args, **kwargs):
@@ -36,21 +41,27 @@ class GaudiModel(GaudiViewBaseModel):
     """
     Parses GAUDI output files and processes resulting Zip files.
 
+    If `SHARE_RECEPTOR` is set, solutions whose receptor has the same
+    topology as an already opened one reuse that Chimera molecule (see
+    :class:`SharedReceptor`) instead of opening a new copy.
+
     .. todo::
 
         Process metadata files (rotamers, h bonds, clashes).
 
-        Cache the protein file if possible.
-
     """
 
+    SHARE_RECEPTOR = True
+
     def __init__(self, path, *args, **kwargs):
         self.path = path
         self.basedir = os.path.dirname(path)
         self.data, self.table_data, self.headers = self.parse()
         self.metadata = {}
         self.molecules = {}
-        self.tempdir = tempfile.mkdtemp('gaudiview')
+        self.receptors = {}  # topology signature -> SharedReceptor
+        self.shared = {}  # solution path -> SharedReceptor
+        self.tempdir = ram_mkdtemp('gaudiview')
         try:
             self.index = max(a for (a, b) in chimera.openModels.listIds())
         except ValueError:
@@ -58,58 +69,157 @@ class GaudiModel(GaudiViewBaseModel):
 
     def parse(self):
         """
-        Since the output files are already YAML-formatted, we
-        only need to load them with PyYaml. However, tkintertable
-        requests a specific hierarchy of the data, so we provide that
-        too.
+        The output files are YAML-formatted, but loading the whole
+        thing with PyYaml is too slow for big runs. We use a specialized
+        parser instead (see :func:`gaudiview.parsers.parse_gaudi_output`),
+        which falls back to PyYaml if the layout is not the expected one.
+        The parsed results are saved in a sidecar cache, so reopening
+        the same file skips the parsing altogether.
+
+        The table is returned as a :class:`gaudiview.columns.ColumnStore`,
+        which tkintertable can use as if it were a dict of dicts.
         """
-        with open(self.path) as f:
-            data = yaml.load(f)
-        headers = ['Filename'] + data['GAUDI.objectives']
-        table_data = OrderedDict()
-        for filename, score in data['GAUDI.results'].iteritems():
-            table_data[os.path.join(self.basedir, filename)] = \
-                OrderedDict((k, v)
-                            for (k, v) in zip(headers, [filename] + score))
+        cached = read_cache(self.path)
+        if cached is None:
+            data, objectives, filenames, columns = parse_gaudi_output(self.path)
+            write_cache(self.path, {'data': data, 'objectives': objectives},
+                        strings=[filenames], arrays=columns)
+        else:
+            info, (filenames,), columns = cached
+            data, objectives = info['data'], info['objectives']
+        headers = ['Filename'] + objectives
+        table_data = ColumnStore(
+            [os.path.join(self.basedir, filename) for filename in filenames],
+            OrderedDict(zip(headers, [filenames] + list(columns))),
+            kinds={'Filename': 'text'})
 
         return data, table_data, headers
 
     def parse_zip(self, path):
         """
-        GAUDI zips its results files. We extract them on the fly to temp
-        directories and feed those to the corresponding parsers (Chimera
-        and YAML, as of now).
+        GAUDI zips its results files. Only the molecule files are
+        extracted, to a RAM-backed temp directory if possible (see
+        :func:`gaudiview.parsers.extract_structures`), and opened
+        in Chimera. The rest of the archive is not decompressed.
         """
         try:
-            z = zipfile.ZipFile(path)
+            meta, paths = self.extract(path)
         except zipfile.BadZipfile:
             print("{} is not a valid GAUDI result".format(path))
         else:
             self.index += 1
-            tmp = os.path.join(
-                self.tempdir, os.path.splitext(os.path.basename(path))[0])
-            try:
-                os.mkdir(tmp)
-            except OSError:  # Assume it exists
-                pass
-            z.extractall(tmp)
+            receptor = None
+            if self.SHARE_RECEPTOR and len(paths) > 1:  # else there is no receptor
+                receptor = max(paths, key=os.path.getsize)
             mol2 = []
-            meta = z.namelist()
-            subid = 0
-            for name in os.listdir(tmp):
-                absname = os.path.join(tmp, name)
-                if name.endswith(".mol2") or name.endswith(".pdb"):
-                    mol2.extend(
-                        m for m in chimera.openModels.open(absname, baseId=self.index,
-                                                           subid=subid,
-                                                           shareXform=True,
-                                                           temporary=True))
-                    subid += 1
-                elif name.endswith(".yaml"):
-                    meta.append(yaml.load(absname))
-            z.close()
+            for subid, absname in enumerate(paths):
+                if absname == receptor:
+                    mol2.extend(self._open_receptor(path, absname, subid))
+                    continue
+                mol2.extend(m for m in chimera.openModels.open(absname, baseId=self.index,
+                                                               subid=subid,
+                                                               shareXform=True,
+                                                               temporary=True))
             return sorted(mol2, key=lambda m: m.numAtoms), meta
 
+    def _open_receptor(self, path, receptor, subid):
+        """
+        Open the `receptor` file of solution `path`, or reuse an opened
+        receptor with the same topology and just record its coordinates.
+        """
+        try:
+            structure = read_structure(receptor)
+        except (IOError, ValueError):
+            structure = None
+        shared = structure and self.receptors.get(structure.signature)
+        if not shared:
+            molecules = chimera.openModels.open(receptor, baseId=self.index, subid=subid,
+                                                shareXform=True, temporary=True)
+            if structure is None or len(molecules) != 1:
+                return molecules
+            try:
+                shared = SharedReceptor(molecules[0], structure)
+            except ValueError:  # atoms do not map one to one
+                return molecules
+            self.receptors[structure.signature] = shared
+        shared.add(path, structure.coords, receptor)
+        self.shared[path] = shared
+        return [shared.molecule]
+
+    def shared_receptors(self):
+        return [shared.molecule for shared in self.receptors.values()]
+
+    def receptor_path(self, path):
+        """
+        Receptor file of solution `path`, if its receptor is shared.
+        The shared molecule was opened from a different solution, so its
+        `openedAs` does not point to this one.
+        """
+        try:
+            return self.shared[path].poses[path][2]
+        except KeyError:
+            return None
+
+    def forget(self, path):
+        """
+        Drop the receptor coordinates stored for solution `path`. If it
+        was the last solution of a shared receptor, the receptor is
+        closed too, and returned.
+        """
+        shared = self.shared.pop(path, None)
+        if shared is None:
+            return None
+        shared.poses.pop(path, None)
+        if shared.poses:
+            return None
+        self.receptors.pop(shared.signature, None)
+        chimera.openModels.close([shared.molecule])
+        return shared.molecule
+
+    def close_receptors(self):
+        """
+        Close every shared receptor.
+        """
+        chimera.openModels.close(self.shared_receptors())
+        self.receptors.clear()
+        self.shared.clear()
+
+    def extract(self, path):
+        """
+        Extract the molecule files of solution `path` to its temp
+        directory. Safe to call from other threads.
+        """
+        tmp = self.extraction_dir(path)
+        try:
+            os.mkdir(tmp)
+        except OSError:  # Assume it exists
+            pass
+        return extract_structures(path, tmp)
+
+    def extraction_dir(self, path):
+        """
+        Temp directory where the files of solution `path` are extracted.
+        """
+        return os.path.join(self.tempdir, os.path.splitext(os.path.basename(path))[0])
+
+    def discard(self, path):
+        """
+        Remove the extracted files of solution `path`. The temp directory
+        is usually in RAM, so they should not outlive its models.
+        """
+        shutil.rmtree(self.extraction_dir(path), ignore_errors=True)
+
+    def prefetch(self, key):
+        """
+        Get solution `key` ready to be opened, from a worker thread.
+        Chimera models can only be created in the main thread, so this
+        just extracts the files; broken zips are reported on display.
+        """
+        try:
+            self.extract(os.path.join(self.basedir, key))
+        except zipfile.BadZipfile:
+            pass
+
     def details(self, key=None):
         if key:
             data = "\n".join(self.metadata[key])
@@ -145,13 +255,135 @@ class GaudiModel(GaudiViewBaseModel):
                 z.close()
 
 
+class SharedReceptor(object):
+
+    """
+    A receptor molecule shared by all the solutions whose receptor file
+    has the same topology. The molecule keeps the coordinates of the
+    first solution (the reference) and, for every other solution, only
+    the atoms that moved are stored and applied on display.
+
+    Parameters
+    ----------
+    molecule : chimera.Molecule
+        Receptor opened from `structure`.
+    structure : gaudiview.coords.Structure
+        Headless reading of the same file, used as reference.
+    tolerance : float, optional
+        Coordinates closer than this (in A) are considered unchanged.
+    """
+
+    def __init__(self, molecule, structure, tolerance=1e-3):
+        atoms = dict((a.serialNumber, a) for a in molecule.atoms)
+        if len(atoms) != len(structure.serials) or molecule.numAtoms != len(atoms):
+            raise ValueError('Atoms do not map one to one')
+        try:
+            self.atoms = [atoms[serial] for serial in structure.serials]
+        except KeyError:
+            raise ValueError('Atoms do not map one to one')
+        self.molecule = molecule
+        self.signature = structure.signature
+        self.reference = structure.coords
+        self.tolerance = tolerance
+        self.poses = {}  # solution -> (moved atom indices, their coords, file)
+        self.current = None
+        self._moved = np.empty(0, dtype=int)
+
+    def add(self, key, coords, path=None):
+        moved = np.flatnonzero(np.abs(coords - self.reference).max(axis=1) > self.tolerance)
+        self.poses[key] = moved, coords[moved], path
+
+    def apply(self, key):
+        """
+        Set the coordinates of solution `key`, touching only the atoms
+        that differ from the reference in this pose or the previous one.
+        """
+        if key == self.current or key not in self.poses:
+            return
+        moved, coords, _ = self.poses[key]
+        atoms = self.atoms
+        for i in np.setdiff1d(self._moved, moved):
+            atoms[i].setCoord(chimera.Point(*self.reference[i]))
+        for i, xyz in zip(moved, coords):
+            atoms[i].setCoord(chimera.Point(*xyz))
+        self._moved = moved
+        self.current = key
+
+
 class GaudiController(GaudiViewBaseController):
 
+    #: Solutions to prefetch above and below the current row. 0 to disable.
+    PREFETCH_DISTANCE = 3
+    #: Processes used for rescoring (None for one per CPU), each a separate
+    #: ``chimera --nogui``. With 1, or if Chimera cannot be started again,
+    #: solutions are scored in Chimera's process, one per event loop step.
+    RESCORE_WORKERS = None
+    #: Milliseconds between checks of a running rescoring job with workers
+    RESCORE_POLL_INTERVAL = 200
+    #: Reuse scores computed before for the same files and objective
+    #: (see gaudiview.scores)
+    RESCORE_CACHE = True
+
     def __init__(self, *args, **kwargs):
         GaudiViewBaseController.__init__(self, *args, **kwargs)
         self.basedir = self.model.basedir
         self.HAS_MORE_GUI = True
         self._gaudi_obj_dialog = None
+        self._rescoring = None
+        self._rescoring_poll = None
+        self.prefetcher = Prefetcher(self.model.prefetch, distance=self.PREFETCH_DISTANCE)
+
+    def selection_changed(self, *args):
+        GaudiViewBaseController.selection_changed(self, *args)
+        self.prefetch_neighbours()
+
+    def order_changed(self, trigger, data, row):
+        self.prefetcher.cancel()
+
+    def prefetch_neighbours(self):
+        """
+        Extract the solutions around the current row, in the current
+        sort order, in the background.
+        """
+        if not self.prefetcher.distance:
+            return
+        table = self.gui.table
+        keys = []
+        for row in neighbours(table.currentrow, table.model.getRowCount(),
+                              self.prefetcher.distance):
+            key = table.model.getRecName(row)
+            if key not in self.molecules:
+                keys.append(key)
+        self.prefetcher.request(keys)
+
+    def close_all(self):
+        self.prefetcher.stop()
+        self.cancel_rescoring()
+        GaudiViewBaseController.close_all(self)
+        self.model.close_receptors()
+        shutil.rmtree(self.model.tempdir, ignore_errors=True)
+
+    def opened(self):
+        # Shared receptors are closed on their own, even if unlisted
+        return self.owned(GaudiViewBaseController.opened(self))
+
+    def owned(self, molecules):
+        shared = self.model.shared_receptors()
+        return [m for m in molecules if not any(m is s for s in shared)]
+
+    def evict(self, key, molecules):
+        GaudiViewBaseController.evict(self, key, molecules)
+        self.metadata.pop(key, None)
+        path = self.solution_path(key)
+        receptor = self.model.forget(path)
+        if receptor is not None:
+            self.displayed[:] = [m for m in self.displayed if m is not receptor]
+        self.prefetcher.forget(key)
+        if not self.prefetcher.busy(key):
+            self.model.discard(path)
+
+    def solution_path(self, key):
+        return os.path.join(self.basedir, key)
 
     def display(self, *keys):
         """
@@ -171,6 +403,9 @@ class GaudiController(GaudiViewBaseController):
                 self.metadata[k] = meta
             finally:
                 self.displayed.extend(self.molecules[k])
+            shared = self.model.shared.get(os.path.join(self.basedir, k))
+            if shared is not None:
+                shared.apply(os.path.join(self.basedir, k))
         else:
             active = self.gui.selection_listbox.curselection()
             self.gui.selection_listbox.delete(0, 'end')
@@ -233,33 +468,77 @@ class GaudiController(GaudiViewBaseController):
 
     def _add_column(self):
         from gaudiview.extensions.gaudiobj import GaudiObjectiveDialog
-        keys = self.selected or self.gui.table.model.data
-        if len(keys) > 50:
-            raise chimera.UserError('Too many solutions requested! Max 50.')
+        if self._rescoring is not None:
+            self.gui.info('Rescoring is still running')
+            return
         self._gaudi_obj_dialog = GaudiObjectiveDialog(callback=self._add_column_cb)
         self._gaudi_obj_dialog.enter()
 
     def _add_column_cb(self):
+        """
+        Rescore the selected solutions (or all of them) in the background,
+        filling the objective column as scores come in.
+        """
         if self._gaudi_obj_dialog is None:
             return
         if not self._gaudi_obj_dialog._returned_OK:
             return
-        if len(self.selected) > 1:
-            data = {k: self.gui.table.model.data[k] for k in self.selected}
-        else:
-            data = self.gui.table.model.data
-        from gaudiview.extensions.gaudiobj import GaudiObjectivePlugin
+        from gaudiview.extensions.gaudiobj import RescoringJob
+        keys = self.selected if len(self.selected) > 1 else list(self.gui.table.model.data)
         objective = self._gaudi_obj_dialog.objective
         objective_kw = self._gaudi_obj_dialog.objective_kwargs
         objname = objective.__name__
         if objname not in self.gui.table.model.columnlabels:
+            self.gui.table.model.data.add_column(objname)
             self.gui.table.addColumn(objname)
             self.gui.table.tablecolheader.reversedcols[objname] = 0
-        total = len(data)
-        for i, (k, d) in enumerate(data.iteritems(), 1):
-            mols = sorted(self.display(k), key=lambda m: len(m.atoms))
-            d[objname] = GaudiObjectivePlugin().do(objective=objective,
-                proteinpath=mols[-1].openedAs[0],
-                ligandpath=mols[0].openedAs[0], obj_kwargs=objective_kw)
-            self.gui.status('Rescored {} out of {}'.format(i, total))
-        self.gui.table.redrawTable()
+        tasks = []
+        for key in keys:
+            path = os.path.join(self.basedir, key)
+            # Files of solutions that are not open are only needed for scoring
+            remove = key not in self.molecules and not self.prefetcher.busy(key)
+            tasks.append((key, path, self.model.extraction_dir(path), remove))
+        self._rescoring = RescoringJob(tasks, objective, objective_kw,
+                                       workers=self.RESCORE_WORKERS,
+                                       cache=self.RESCORE_CACHE)
+        self.gui.add_column_btn.configure(text='Cancel rescoring',
+                                          command=self.cancel_rescoring)
+        self._poll_rescoring(objname)
+
+    def _poll_rescoring(self, objname):
+        job = self._rescoring
+        self._rescoring_poll = None
+        scores = job.poll()
+        if scores:
+            keys, values = zip(*scores)
+            self.gui.table.model.data.set_values(objname, keys, values)
+            self.gui.table.redrawTable()
+        done, total = job.progress
+        if not job.done:
+            self.gui.info('Rescoring... {}/{}'.format(done, total), blankAfter=0)
+            # In Chimera's process, just let Tk handle its events between solutions
+            interval = self.RESCORE_POLL_INTERVAL if job.workers else 1
+            self._rescoring_poll = self.gui.table.after(interval, self._poll_rescoring,
+                                                        objname)
+            return
+        for key, error in job.failed:
+            print('Could not rescore {}:\n{}'.format(key, error))
+        self._finish_rescoring()
+        summary = 'Rescored {} solutions ({} from cache)'.format(
+            done - len(job.failed), job.cached)
+        if job.failed:
+            self.gui.error('{}, {} failed'.format(summary, len(job.failed)))
+        else:
+            self.gui.info(summary)
+
+    def cancel_rescoring(self):
+        if self._rescoring_poll is not None:
+            self.gui.table.after_cancel(self._rescoring_poll)
+            self._rescoring_poll = None
+        if self._rescoring is not None:
+            self._rescoring.close()
+            self._finish_rescoring()
+
+    def _finish_rescoring(self):
+        self._rescoring = None
+        self.gui.add_column_btn.configure(text='Rescore', command=self._add_column)
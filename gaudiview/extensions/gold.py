@@ -12,6 +12,7 @@
 
 # Python
 from __future__ import division, print_function
+from array import array
 from collections import OrderedDict
 import glob
 import itertools
@@ -22,6 +23,11 @@ import chimera
 # Internal dependencies
 from gaudiview.extensions.base import GaudiViewBaseModel, GaudiViewBaseController
 from gaudiview.extensions import dsx
+from gaudiview.cache import read_cache, write_cache, LazyFileBlocks
+from gaudiview.columns import ColumnStore
+from gaudiview.coords import read_structure
+from gaudiview.parsers import scan_gold_solutions
+from gaudiview.scores import ScoreCache, score_key
 from gaudiview.gui import info, error
 
 
@@ -43,6 +49,10 @@ class GoldModel(GaudiViewBaseModel):
 
     """
 
+    SCAN_WORKERS = None
+    SCAN_CHUNKSIZE = 256
+    METADATA_CACHE_SIZE = 32
+
     def __init__(self, path, *args, **kwargs):
         self.path = path
         self.basedir, self.file = os.path.split(path)
@@ -86,9 +96,17 @@ class GoldModel(GaudiViewBaseModel):
         However, some essays contain multiple instances of these parameters,
         so we must exhaust all the options with itertools.product.
 
-        We also get rid of ranked symlinks and save the comment section from
-        each mol2.
+        We also get rid of ranked symlinks and save the location of the
+        comment section from each mol2.
+
+        Solution files are scanned in a pool of `SCAN_WORKERS` processes
+        (all CPUs if None; 1 disables the pool), `SCAN_CHUNKSIZE` files
+        at a time.
         """
+        cached = read_cache(self.path)
+        if cached is not None:
+            return self._parse_from_cache(*cached)
+
         ligand_basepaths = []
         basedirs = []
         proteinpath = None
@@ -112,9 +130,9 @@ class GoldModel(GaudiViewBaseModel):
                         continue
                     rotamers[respos] = None
 
-        parsed = OrderedDict()
+        solution_dirs = set()
+        mol2_files = []
         parsed_filenames = set()
-        metadata = {}
         for base, ligand in itertools.product(basedirs, ligand_basepaths):
             path = os.path.normpath(os.path.join(self.basedir, base,
                                                  '*_' + os.path.basename(ligand) + '_*_*.mol2'))
@@ -122,36 +140,76 @@ class GoldModel(GaudiViewBaseModel):
             if not solutions:
                 raise chimera.UserError("Solution set for {} was not found. "
                                         "Check paths in your gold.conf".format(ligand))
+            solution_dirs.add(os.path.dirname(path))
             for mol2 in solutions:
                 mol2 = os.path.realpath(mol2)  # discard symlinks
                 if mol2 in parsed_filenames:
                     continue
-                with open(mol2) as f:
-                    lines = f.read().splitlines()
-                    j = lines.index('> <Gold.Score>')
-                    self.headers = ['Filename'] + lines[j + 1].strip().split()
-                    data = [mol2] + map(float, lines[j + 2].split())
-                    # This the hierarchy requested by tkintertable
-                    # Each entry must be tagged by its header, such as:
-                    # {row_id(abspath): {column: value, column2: value, ...}}
-                    parsed[mol2] = OrderedDict(
-                        OrderedDict((k, v) for (k, v) in zip(self.headers, data)))
-                    parsed_filenames.add(mol2)
-                    # Since the file is open, why not get metadata now?
-                    k = lines.index('@<TRIPOS>COMMENT')
-                    metadata[mol2] = lines[k + 1:]
-
+                mol2_files.append(mol2)
+                parsed_filenames.add(mol2)
+
+        # Reading thousands of files is slow, so do it in parallel.
+        # We only keep the location of the COMMENT section (metadata),
+        # which is read on demand (see `LazyFileBlocks`).
+        scanned = scan_gold_solutions(mol2_files, workers=self.SCAN_WORKERS,
+                                      chunksize=self.SCAN_CHUNKSIZE)
+        columns = OrderedDict()
+        for i, (headers, scores, _) in enumerate(scanned):
+            for header, score in zip(headers, scores):
+                try:
+                    columns[header].append(score)
+                except KeyError:  # first time we see this header
+                    columns[header] = array('d', [float('nan')]) * i
+                    columns[header].append(score)
+            for column in columns.values():
+                if len(column) == i:  # header missing in this solution
+                    column.append(float('nan'))
+
+        # Get rid of the common path in absolute name
+        # This leaves a short unique name, adequate for GUI
         commonpath = common_path_of_filenames(parsed_filenames)
-        for v in parsed.values():
-            # Get rid of the common path in absolute name
-            # This leaves a short unique name, adequate for GUI
-            v['Filename'] = os.path.relpath(v['Filename'], commonpath)
-
-        self.data = parsed
-        self.metadata = metadata
+        filenames = [os.path.relpath(mol2, commonpath) for mol2 in mol2_files]
+
+        self.headers = ['Filename'] + list(columns)
+        self.data = ColumnStore(mol2_files, OrderedDict([('Filename', filenames)] + columns.items()),
+                                kinds={'Filename': 'text'})
+        self.metadata = LazyFileBlocks(mol2_files,
+                                       [offset for (_, _, (offset, _)) in scanned],
+                                       [length for (_, _, (_, length)) in scanned],
+                                       maxsize=self.METADATA_CACHE_SIZE)
         self.commonpath = commonpath
         self.proteinpath = proteinpath
         self.rotamers = rotamers
+        self._write_cache(sorted(solution_dirs))
+
+    def _write_cache(self, solution_dirs):
+        """
+        Save parsed results in a sidecar cache, keyed by the
+        modification times of the solution files and their directories.
+        """
+        keys = list(self.data)
+        info = {'headers': self.headers,
+                'commonpath': self.commonpath,
+                'proteinpath': self.proteinpath,
+                'rotamers': sorted(self.rotamers)}
+        strings = [keys, self.data.columns['Filename']]
+        arrays = [self.data.columns[h] for h in self.headers[1:]]
+        arrays.append(self.metadata.offsets)
+        arrays.append(self.metadata.lengths)
+        write_cache(self.path, info, strings=strings, arrays=arrays,
+                    dependencies=solution_dirs + keys)
+
+    def _parse_from_cache(self, info, strings, arrays):
+        keys, filenames = strings
+        columns, offsets, lengths = arrays[:-2], arrays[-2], arrays[-1]
+        self.headers = info['headers']
+        self.data = ColumnStore(keys, OrderedDict(zip(self.headers, [filenames] + columns)),
+                                kinds={'Filename': 'text'})
+        self.metadata = LazyFileBlocks(keys, offsets, lengths,
+                                       maxsize=self.METADATA_CACHE_SIZE)
+        self.commonpath = info['commonpath']
+        self.proteinpath = info['proteinpath']
+        self.rotamers = dict.fromkeys(info['rotamers'])
 
     def details(self, key=None):
         if key:
@@ -164,30 +222,173 @@ class GoldModel(GaudiViewBaseModel):
         return data
 
 
+class PoseSet(object):
+
+    """
+    All the poses of a ligand topology, as coordinate sets of a single
+    Chimera molecule. Showing another pose just switches the active
+    coordinate set.
+
+    Parameters
+    ----------
+    molecule : chimera.Molecule
+        Opened from the first pose.
+    structure : gaudiview.coords.Structure
+        Headless reading of the same file, to map atoms by serial number.
+    key : str
+        Solution the molecule was opened from.
+    """
+
+    def __init__(self, molecule, structure, key):
+        atoms = dict((a.serialNumber, a) for a in molecule.atoms)
+        if len(atoms) != len(structure.serials) or molecule.numAtoms != len(atoms):
+            raise ValueError('Atoms do not map one to one')
+        try:
+            self.atoms = [atoms[serial] for serial in structure.serials]
+        except KeyError:
+            raise ValueError('Atoms do not map one to one')
+        self.molecule = molecule
+        self.coordsets = {key: molecule.activeCoordSet}
+        self._next_id = max(molecule.coordSets) + 1
+
+    def add(self, key, coords):
+        coordset = self.molecule.newCoordSet(self._next_id, len(self.atoms))
+        self._next_id += 1
+        for atom, xyz in zip(self.atoms, coords):
+            atom.setCoord(chimera.Point(*xyz), coordset)
+        self.coordsets[key] = coordset
+
+    def remove(self, key):
+        """
+        Delete the coordinate set of `key`. Returns True when no poses
+        are left, and the molecule can be closed.
+        """
+        coordset = self.coordsets.pop(key, None)
+        if coordset is not None and self.coordsets:
+            if coordset is self.molecule.activeCoordSet:
+                self.molecule.activeCoordSet = next(iter(self.coordsets.values()))
+            self.molecule.deleteCoordSet(coordset)
+        return not self.coordsets
+
+    def show(self, key):
+        self.molecule.activeCoordSet = self.coordsets[key]
+
+
 class GoldController(GaudiViewBaseController):
 
+    #: Milliseconds between poses in automatic playback
+    PLAY_INTERVAL = 200
+
     def __init__(self, *args, **kwargs):
         GaudiViewBaseController.__init__(self, *args, **kwargs)
         self.HAS_SELECTION = False  # disable selection box in GUI
         self.HAS_MORE_GUI = True
+        self.posesets = {}  # topology signature -> PoseSet
+        self.poses = {}  # solution -> PoseSet
+        self._play_job = None
 
     def close_all(self):
-        chimera.openModels.close([m_ for m in self.model.molecules.values()
-                                  for m_ in m] + [self.model.protein])
+        self.stop_playing()
+        GaudiViewBaseController.close_all(self)
+        self.posesets.clear()
+        self.poses.clear()
+
+    def opened(self):
+        molecules = GaudiViewBaseController.opened(self)
+        molecules.extend(poses.molecule for poses in self.posesets.values())
+        return list(set(molecules + [self.model.protein]))
 
     def display(self, *keys):
         for k in keys:
             try:
                 self.show(*self.molecules[k])
             except KeyError:
-                path = os.path.join(self.model.commonpath, k)
-                self.molecules[k] = chimera.openModels.open(path, shareXform=True, temporary=True)
+                self.molecules[k] = self._open(k)
             finally:
                 self.displayed.extend(self.molecules[k])
+            if k in self.poses:
+                self.poses[k].show(k)
 
         if keys:
             return self.molecules[keys[-1]]
 
+    @property
+    def playback(self):
+        try:
+            return self.gui.playback_bool.get()
+        except AttributeError:  # no GUI yet
+            return False
+
+    def solution_path(self, key):
+        return os.path.join(self.model.commonpath, key)
+
+    def _open(self, key):
+        path = self.solution_path(key)
+        if not self.playback:
+            return chimera.openModels.open(path, shareXform=True, temporary=True)
+        # Playback mode: poses with the same topology share one molecule
+        try:
+            structure = read_structure(path)
+        except (IOError, ValueError):
+            structure = None
+        poses = structure and self.posesets.get(structure.signature)
+        if poses:
+            poses.add(key, structure.coords)
+        else:
+            molecules = chimera.openModels.open(path, shareXform=True, temporary=True)
+            if structure is None or len(molecules) != 1:
+                return molecules
+            try:
+                poses = PoseSet(molecules[0], structure, key)
+            except ValueError:
+                return molecules
+            self.posesets[structure.signature] = poses
+        self.poses[key] = poses
+        return [poses.molecule]
+
+    def owned(self, molecules):
+        shared = [poses.molecule for poses in self.posesets.values()]
+        return [m for m in molecules if not any(m is s for s in shared)]
+
+    def evict(self, key, molecules):
+        GaudiViewBaseController.evict(self, key, molecules)
+        poses = self.poses.pop(key, None)
+        if poses is not None and poses.remove(key):  # no poses left
+            for signature, other in list(self.posesets.items()):
+                if other is poses:
+                    del self.posesets[signature]
+            self.displayed[:] = [m for m in self.displayed if m is not poses.molecule]
+            chimera.openModels.close([poses.molecule])
+
+    def toggle_playing(self):
+        if self._play_job is None:
+            self.gui.play_btn.config(text='Stop')
+            self._play_job = self.gui.table.after(self.PLAY_INTERVAL, self._play_step)
+        else:
+            self.stop_playing()
+
+    def stop_playing(self):
+        if self._play_job is not None:
+            self.gui.table.after_cancel(self._play_job)
+            self._play_job = None
+            self.gui.play_btn.config(text='Play')
+
+    def _play_step(self):
+        """
+        Select the next row in the current sort order.
+        """
+        table = self.gui.table
+        row = table.currentrow + 1
+        if row >= table.model.getRowCount():
+            self.stop_playing()
+            return
+        table.setSelectedRow(row)
+        if row not in table.visiblerows:
+            table.set_yviews('moveto', float(row) / table.rows)
+        table.drawSelectedRow()
+        self.gui.triggers.activateTrigger(self.gui.SELECTION_CHANGED, None)
+        self._play_job = table.after(self.PLAY_INTERVAL, self._play_step)
+
     def process(self, *keys, **kwargs):
         """
         As of now, we only process rotamer info. We do so by parsing
@@ -202,7 +403,10 @@ class GoldController(GaudiViewBaseController):
         modified_residues = set()
         for key in keys:
             ligand = self.molecules[key]
-            mol2data = ligand[0].mol2data
+            if key in self.poses:  # the molecule holds other poses' data
+                mol2data = [line.rstrip() for line in self.model.metadata[key]]
+            else:
+                mol2data = ligand[0].mol2data
             if self.model.rotamers:
                 try:
                     start = mol2data.index('> <Gold.Protein.RotatedAtoms>')
@@ -259,7 +463,8 @@ class GoldController(GaudiViewBaseController):
             for a in res.atoms:
                 a.display = 1
 
-        # self._get_dsx_score(keys=keys)
+        if self.gui.dsx_bool.get():
+            self._get_dsx_score(keys=keys)
 
     def get_table_dict(self):
         return self.model.data
@@ -271,23 +476,54 @@ class GoldController(GaudiViewBaseController):
                                                  command=self.process)
         self.gui.dsx_check.grid(row=2, column=0, sticky='e')
 
+        # Pose playback: one molecule per ligand, one coordset per pose
+        self.gui.play_frame = Tkinter.Frame(self.gui.cliframe)
+        self.gui.playback_bool = Tkinter.BooleanVar()
+        self.gui.playback_check = Tkinter.Checkbutton(self.gui.play_frame,
+                                                      text="Pose playback",
+                                                      variable=self.gui.playback_bool)
+        self.gui.playback_check.pack(side='left')
+        self.gui.play_btn = Tkinter.Button(self.gui.play_frame, text='Play',
+                                           command=self.toggle_playing)
+        self.gui.play_btn.pack(side='left')
+        self.gui.play_frame.grid(row=4, column=0, sticky='w')
+
         self.gui.cliframe.pack(fill='x')
 
     def _get_dsx_score(self, keys=None):
+        if not self.model.proteinpath:
+            self.gui.error('DSX needs the protein file of the GOLD run')
+            return
         if 'DSX_score' not in self.gui.table.model.columnlabels:
             self.gui.table.addColumn('DSX_score')
             self.gui.table.tablecolheader.reversedcols['DSX_score'] = 0
         if keys is None:
-            data = self.gui.table.model.data.iteritems()
-        else:
-            data = ((k, self.gui.table.model.data[k]) for k in keys)
-        for k, d in data:
-            if 'DSX_score' not in d:
-                mol, = self.display(k)
-                dsx_score = dsx.DSXPlugin()
-                score = dsx_score.do(self.model.proteinpath, mol.openedAs[0])
-                d['DSX_score'] = score
+            keys = self.gui.table.model.data.keys()
+        data = self.gui.table.model.data
+        missing = [k for k in keys if 'DSX_score' not in data[k]]
+        if not missing:
+            return
+        # Scores computed before for the same files are filled at once
+        dsx_score = dsx.DSXPlugin()
+        options = {'potentials': getattr(dsx_score, 'potentials', None)}
+        digests = dict((k, score_key(self.model.proteinpath, self.solution_path(k),
+                                     'DSX', options))
+                       for k in missing)
+        cache = ScoreCache()
+        cached = cache.get_many(digests.values())
+        hits = [k for k in missing if digests[k] in cached]
+        data.set_values('DSX_score', hits, [cached[digests[k]] for k in hits])
+        self.gui.table.redrawTable()
+        if not hasattr(dsx_score, 'binary'):  # DSX is not configured, already reported
+            cache.close()
+            return
+        for k in missing:
+            if 'DSX_score' not in data[k]:
+                score = dsx_score.do(self.model.proteinpath, self.solution_path(k))
+                data[k]['DSX_score'] = score
+                cache.put_many([(digests[k], score)])
                 self.gui.table.redrawTable()
+        cache.close()
 
     @staticmethod
     def update_rotamers(protein, xyz, atomnum):
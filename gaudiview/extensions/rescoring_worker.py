@@ -0,0 +1,39 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Rescoring worker, started by :class:`gaudiview.extensions.gaudiobj.RescoringJob`
+as ``chimera --nogui --silent rescoring_worker.py``. The first line of
+its input is the ``sys.path`` of the job, so GaudiView and GaudiMM are
+found as they were there; see :func:`gaudiview.extensions.gaudiobj.serve`
+for the rest.
+"""
+
+import base64
+import os
+import pickle
+import sys
+
+
+def main():
+    # Only results go to the original stdout: anything else printed,
+    # by Chimera or GaudiMM, goes to stderr
+    results = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    for path in pickle.loads(base64.b64decode(sys.stdin.readline().split()[-1])):
+        if path not in sys.path:
+            sys.path.append(path)
+    from gaudiview.extensions.gaudiobj import serve
+    serve(sys.stdin, results)
+
+
+main()
@@ -19,6 +19,7 @@ import chimera
 # Internal dependencies
 from libtangram.ui import TangramBaseDialog
 from . import tables
+from .clustering import METHODS
 from .extensions.base import load_controller
 
 
@@ -36,6 +37,7 @@ class GaudiViewDialog(TangramBaseDialog):
     VERSION_URL = "https://api.github.com/repos/insilichem/gaudiview/releases/latest"
     SELECTION_CHANGED = "GaudiViewSelectionChanged"
     DBL_CLICK = "GaudiViewDoubleClick"
+    ORDER_CHANGED = "GaudiViewOrderChanged"
     EXIT = "GaudiViewExited"
 
 
@@ -48,10 +50,13 @@ class GaudiViewDialog(TangramBaseDialog):
         self.triggers = chimera.triggerSet.TriggerSet()
         self.triggers.addTrigger(self.SELECTION_CHANGED)
         self.triggers.addTrigger(self.DBL_CLICK)
+        self.triggers.addTrigger(self.ORDER_CHANGED)
         self.triggers.addHandler(
             self.SELECTION_CHANGED, self.controller.selection_changed, None)
         self.triggers.addHandler(
             self.DBL_CLICK, self.controller.double_click, None)
+        self.triggers.addHandler(
+            self.ORDER_CHANGED, self.controller.order_changed, None)
         # Disable ksdssp
         # chimera.triggers.addHandler("Model", self.suppressKsdssp, None)
 
@@ -68,8 +73,7 @@ class GaudiViewDialog(TangramBaseDialog):
         self.tframe.bind(
             '<Enter>', lambda event, caller=self.tframe: self.give_focus(event, caller))
         # Fill data in and create table
-        self.model = tables.TableModel()
-        self.model.importDict(self.controller.get_table_dict())
+        self.model = tables.ColumnarTableModel(self.controller.get_table_dict())
         fontsize = int(round(-11 * chimera.tkgui.app.winfo_fpixels('1i') / 72.0, 0))
         self.table = tables.Table(self.tframe, self.model, editable=False,
                                   gaudiparent=self, thefont=('Arial', fontsize),
@@ -125,6 +129,10 @@ class GaudiViewDialog(TangramBaseDialog):
         self.cluster_keymenu = Pmw.OptionMenu(
             self.cluster_frame, items=fields,
             menubutton_textvariable=self.cluster_key, initialitem=fields[0])
+        self.cluster_method = Tkinter.StringVar()
+        self.cluster_methodmenu = Pmw.OptionMenu(
+            self.cluster_frame, items=list(METHODS),
+            menubutton_textvariable=self.cluster_method, initialitem='Leader')
         self.cluster_cutoff = Tkinter.StringVar()
         self.cluster_cutoff.set('0.5')
         self.cluster_field = Tkinter.Entry(self.cluster_frame, width=4,
@@ -134,6 +142,8 @@ class GaudiViewDialog(TangramBaseDialog):
 
         Tkinter.Label(self.cluster_frame, text='Cluster by').pack(side='left')
         self.cluster_keymenu.pack(side='left', expand=True, fill='x')
+        Tkinter.Label(self.cluster_frame, text='using').pack(side='left')
+        self.cluster_methodmenu.pack(side='left')
         Tkinter.Label(self.cluster_frame, text='with RMSD cutoff').pack(side='left')
         self.cluster_field.pack(side='left')
         self.cluster_btn.pack(side='left')
@@ -176,10 +186,9 @@ class GaudiViewDialog(TangramBaseDialog):
         """
         Close unselected entries
         """
-        chimera.openModels.close(
-            [m_ for p in self.controller.molecules
-             for m_ in self.controller.model.molecules[p]
-             if p not in self.controller.selected])
+        molecules = self.controller.molecules
+        for p in [p for p in molecules if p not in self.controller.selected]:
+            self.controller.evict(p, molecules.pop(p))
 
     def OK(self):
         self.Apply()
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Sparse RMSD matrices: for each solution, the solutions closer than a
+given radius and their RMSD. Anything clustered with a cutoff below
+that radius can be computed from them, with no RMSD evaluation at all,
+so they are kept in memory and next to the input file, one file per
+set of solutions (``<input>.gaudiview-rmsd-<signature>``, see
+:mod:`gaudiview.cache`).
+
+This module does not depend on Chimera.
+"""
+
+# Python
+from __future__ import division
+import hashlib
+# External dependencies
+import numpy as np
+# Own
+from gaudiview.cache import read_cache, write_cache
+from gaudiview.rmsd import rmsd_one_to_many
+
+SUFFIX = '.gaudiview-rmsd'
+#: Atoms compared by the RMSD, see gaudiview.coords.Structure.heavy_coords
+SELECTION = 'heavy'
+#: Rows read at a time when going through every pair
+BLOCK_ROWS = 4096
+
+
+def neighbours_signature(keys, superpose=False, selection=SELECTION, symmetry=False):
+    """
+    Identifies the RMSD data of a set of solutions, whatever their
+    order, compared on the atoms given by `selection`.
+    """
+    digest = hashlib.sha1()
+    digest.update('{}|{}|'.format(selection, bool(superpose)).encode('utf-8'))
+    if symmetry:
+        digest.update(b'symmetry|')
+    for key in sorted(keys):
+        digest.update((key if isinstance(key, bytes) else key.encode('utf-8')) + b'\0')
+    return digest.hexdigest()
+
+
+class NeighbourList(object):
+
+    """
+    Symmetric sparse RMSD matrix, in compressed sparse row form. Row
+    `i` lists the poses closer than `radius` to pose `i` (itself
+    excluded), and their RMSD.
+
+    Parameters
+    ----------
+    keys : list of str
+        Solution of each row, sorted.
+    indptr : (M + 1,) int array
+        Row `i` spans ``indices[indptr[i]:indptr[i + 1]]``.
+    indices : (P,) int array
+    distances : (P,) float64 array
+    radius : float
+    signature : str
+        See :func:`neighbours_signature`.
+    """
+
+    def __init__(self, keys, indptr, indices, distances, radius, signature):
+        self.keys = list(keys)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.distances = np.asarray(distances, dtype=np.float64)
+        self.radius = radius
+        self.signature = signature
+        self._index = dict((key, i) for (i, key) in enumerate(self.keys))
+
+    @classmethod
+    def from_pairs(cls, keys, chunks, radius, signature):
+        """
+        Build the list from chunks of pairs of row numbers (each pair
+        given once), as ``(first, second, distances)`` arrays. Rows are
+        filled chunk by chunk, so no copy of all the pairs is needed.
+        """
+        chunks = list(chunks)
+        n = len(keys)
+        counts = np.zeros(n, dtype=np.int64)
+        for first, second, distances in chunks:
+            counts += np.bincount(first, minlength=n)
+            counts += np.bincount(second, minlength=n)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        values = np.empty(indptr[-1], dtype=np.float64)
+        cursor = indptr[:-1].copy()
+        for first, second, distances in chunks:
+            for rows, cols in ((first, second), (second, first)):
+                if not len(rows):
+                    continue
+                order = np.argsort(rows, kind='mergesort')
+                rows = rows[order]
+                # Position of each entry among those of the same row
+                starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+                rank = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+                slots = cursor[rows] + rank
+                indices[slots] = cols[order]
+                values[slots] = distances[order]
+                cursor += np.bincount(rows, minlength=n)
+        return cls(keys, indptr, indices, values, radius, signature)
+
+    def pairs_array(self, dtype=np.float64):
+        """
+        Every pair once, as ``(first, second, distances)`` arrays with
+        ``first < second``, and `distances` of the given `dtype`. Only
+        the result is allocated in full (see :meth:`upper_pairs`).
+        """
+        first = np.empty(self.pairs, dtype=np.int32)
+        second = np.empty(self.pairs, dtype=np.int32)
+        distances = np.empty(self.pairs, dtype=dtype)
+        filled = 0
+        for rows, cols, values in self.upper_pairs():
+            first[filled:filled + len(rows)] = rows
+            second[filled:filled + len(rows)] = cols
+            distances[filled:filled + len(rows)] = values
+            filled += len(rows)
+        return first[:filled], second[:filled], distances[:filled]
+
+    def upper_pairs(self, rows=BLOCK_ROWS):
+        """
+        Every pair once, as :meth:`pairs_array`, in chunks of the pairs
+        of `rows` consecutive rows.
+        """
+        for start in range(0, len(self.keys), rows):
+            stop = min(start + rows, len(self.keys))
+            begin, end = self.indptr[start], self.indptr[stop]
+            first = np.repeat(np.arange(start, stop, dtype=np.int32),
+                              np.diff(self.indptr[start:stop + 1]))
+            second = self.indices[begin:end]
+            upper = first < second
+            yield first[upper], second[upper], self.distances[begin:end][upper]
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def pairs(self):
+        return len(self.indices) // 2
+
+    def index(self, key):
+        return self._index[key]
+
+    def row(self, i):
+        """
+        Neighbours of pose `i` and their RMSD.
+        """
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:stop], self.distances[start:stop]
+
+    def covers(self, signature, cutoff):
+        """
+        True if this list can be used to cluster the solutions with
+        `signature` at `cutoff`.
+        """
+        return signature == self.signature and cutoff <= self.radius
+
+    def save(self, path, dependencies=()):
+        """
+        Store the list next to input file `path`. See
+        :func:`gaudiview.cache.write_cache` for `dependencies`.
+        """
+        info = {'radius': self.radius, 'signature': self.signature}
+        return write_cache(path, info, strings=[self.keys],
+                           arrays=[self.indptr, self.indices, self.distances],
+                           dependencies=dependencies, suffix=_suffix(self.signature))
+
+    @classmethod
+    def load(cls, path, signature, cutoff):
+        """
+        The list stored next to `path`, if it is still valid and
+        :meth:`covers` `signature` at `cutoff`. Else, None.
+        """
+        cached = read_cache(path, suffix=_suffix(signature))
+        if cached is None:
+            return None
+        info, (keys,), (indptr, indices, distances) = cached
+        if info['signature'] != signature or cutoff > info['radius']:
+            return None
+        return cls(keys, _as_numpy(indptr, np.int64), _as_numpy(indices, np.int32),
+                   _as_numpy(distances, np.float64), info['radius'], signature)
+
+
+def _suffix(signature):
+    # Clustering another selection must not overwrite the file of this one
+    return '{}-{}'.format(SUFFIX, signature[:16])
+
+
+def _as_numpy(values, dtype):
+    """
+    View an :class:`array.array` read from the cache as a NumPy array,
+    without copying it if the types match.
+    """
+    if values.itemsize == np.dtype(dtype).itemsize and values.typecode in 'ilqd':
+        return np.frombuffer(values, dtype=values.typecode).astype(dtype, copy=False)
+    return np.array(values, dtype=dtype)
+
+
+def search_rows(poses, start, stop, radius, superpose=False, sorted_by=None,
+                bounds=None, tolerance=1e-5, symmetry=None):
+    """
+    Pairs of `poses` closer than `radius`, for rows ``start:stop``
+    against the rows after them.
+
+    Parameters
+    ----------
+    poses : (M, N, 3) array
+    sorted_by : (M,) array, optional
+        Non-decreasing values such that ``|sorted_by[i] - sorted_by[j]|``
+        is a lower bound of the RMSD between poses `i` and `j` (their
+        RMSD to a reference pose, for example). Only the rows within
+        `radius` of each other in `sorted_by` are compared.
+    bounds : callable, optional
+        Takes a row and an array of rows, and returns a lower bound of
+        their RMSDs. Rows whose bound exceeds `radius` are skipped.
+    symmetry : gaudiview.symmetry.Symmetry, optional
+        Of the molecule, for symmetry-corrected RMSDs.
+
+    Returns
+    -------
+    first, second : int32 arrays
+    distances : float64 array
+    """
+    first, second, distances = [], [], []
+    for i in range(start, stop):
+        if sorted_by is None:
+            end = len(poses)
+        else:
+            end = np.searchsorted(sorted_by, sorted_by[i] + radius + tolerance, side='right')
+        candidates = np.arange(i + 1, end)
+        if len(candidates) and bounds is not None:
+            candidates = candidates[bounds(i, candidates) <= radius + tolerance]
+        if not len(candidates):
+            continue
+        rmsds = rmsd_one_to_many(poses[i], poses[candidates], superpose=superpose,
+                                 symmetry=symmetry)
+        close = rmsds <= radius
+        first.append(np.full(close.sum(), i, dtype=np.int32))
+        second.append(candidates[close].astype(np.int32))
+        distances.append(rmsds[close])
+    if not first:
+        return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32),
+                np.empty(0, dtype=np.float64))
+    return np.concatenate(first), np.concatenate(second), np.concatenate(distances)
@@ -0,0 +1,385 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Fast readers for the input files handled by the extensions.
+
+These functions do not depend on Chimera, so they can be used (and
+benchmarked) from any Python interpreter.
+"""
+
+# Python
+from __future__ import print_function
+from array import array
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zipfile
+# External dependencies
+import yaml
+
+try:
+    YamlLoader = yaml.CLoader
+except AttributeError:  # PyYAML built without libyaml
+    YamlLoader = yaml.Loader
+
+STRUCTURE_EXTENSIONS = ('.mol2', '.pdb')
+
+_YAML_SPECIAL_FLOATS = {
+    '.nan': float('nan'), '.NaN': float('nan'), '.NAN': float('nan'),
+    '.inf': float('inf'), '.Inf': float('inf'), '.INF': float('inf'),
+    '+.inf': float('inf'), '+.Inf': float('inf'), '+.INF': float('inf'),
+    '-.inf': float('-inf'), '-.Inf': float('-inf'), '-.INF': float('-inf'),
+}
+
+
+class UnknownLayout(ValueError):
+
+    """
+    Raised by the specialized parsers when the file does not follow
+    the expected layout. Callers should fall back to a generic parser.
+    """
+    pass
+
+
+def load_yaml(stream):
+    """
+    Load a YAML document with the C loader, if available.
+    """
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+def parse_gaudi_output(path):
+    """
+    Parse a GaudiMM ``*.gaudi-output`` file.
+
+    The ``GAUDI.results`` block, which holds one entry per solution, is read
+    line by line straight into numeric arrays. The rest of the file
+    (``GAUDI.objectives``, comments, and so on) is small, so it is handed to
+    the libyaml loader. If the file does not look like a GaudiMM output,
+    the whole file is loaded with YAML instead.
+
+    Returns
+    -------
+    data : dict
+        Every top-level key in the file except ``GAUDI.results``.
+    objectives : list of str
+        Contents of ``GAUDI.objectives``.
+    filenames : list of str
+        Keys of ``GAUDI.results``, in file order.
+    columns : list of array.array
+        One array of doubles per objective, parallel to `filenames`.
+    """
+    try:
+        return _parse_gaudi_output_by_lines(path)
+    except UnknownLayout:
+        return _parse_gaudi_output_with_yaml(path)
+
+
+def _parse_gaudi_output_by_lines(path):
+    rest = []
+    filenames = []
+    columns = None
+    values = None
+    in_results = False
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            if in_results and line[0] in ' -':
+                stripped = line.strip()
+                if stripped.startswith('- '):
+                    if values is None:
+                        raise UnknownLayout('Orphan sequence item: ' + stripped)
+                    values.append(_yaml_float(stripped[2:]))
+                    continue
+                _store_gaudi_row(columns, values)
+                if stripped.endswith(':'):
+                    filenames.append(_yaml_key(stripped[:-1]))
+                    values = []
+                elif ': [' in stripped and stripped.endswith(']'):
+                    key, _, flow = stripped.partition(': [')
+                    filenames.append(_yaml_key(key))
+                    values = [_yaml_float(v) for v in flow[:-1].split(',') if v.strip()]
+                else:
+                    raise UnknownLayout('Unexpected line: ' + stripped)
+                if columns is None:
+                    columns = []
+                continue
+            if in_results:
+                _store_gaudi_row(columns, values)
+                values = None
+                in_results = False
+            if line.startswith('GAUDI.results:'):
+                inline = line[len('GAUDI.results:'):].strip()
+                if inline == '{}':
+                    continue
+                if inline:
+                    raise UnknownLayout('GAUDI.results is not a block mapping')
+                in_results = True
+            else:
+                rest.append(line)
+    if in_results:
+        _store_gaudi_row(columns, values)
+
+    data = load_yaml(''.join(rest)) if rest else {}
+    if not isinstance(data, dict) or 'GAUDI.objectives' not in data:
+        raise UnknownLayout('GAUDI.objectives not found')
+    if 'GAUDI.results' in data:
+        raise UnknownLayout('GAUDI.results is not a block mapping')
+    objectives = data['GAUDI.objectives']
+    if columns is None:
+        columns = [array('d') for _ in objectives]
+    if len(columns) != len(objectives):
+        raise UnknownLayout('Number of scores does not match GAUDI.objectives')
+    if any(len(column) != len(filenames) for column in columns):
+        raise UnknownLayout('Some solutions have no scores')
+    return data, objectives, filenames, columns
+
+
+def _parse_gaudi_output_with_yaml(path):
+    with open(path) as f:
+        data = load_yaml(f)
+    results = data.pop('GAUDI.results')
+    objectives = data['GAUDI.objectives']
+    filenames = []
+    columns = [array('d') for _ in objectives]
+    for filename, scores in results.items():
+        filenames.append(filename)
+        for column, score in zip(columns, scores):
+            column.append(float('nan') if score is None else float(score))
+    return data, objectives, filenames, columns
+
+
+def _store_gaudi_row(columns, values):
+    if values is None:
+        return
+    if not columns:
+        columns.extend(array('d') for _ in values)
+    elif len(values) != len(columns):
+        raise UnknownLayout('Inconsistent number of scores')
+    for column, value in zip(columns, values):
+        column.append(value)
+
+
+def _yaml_float(token):
+    token = token.strip()
+    try:
+        return float(token)
+    except ValueError:
+        try:
+            return _YAML_SPECIAL_FLOATS[token]
+        except KeyError:
+            raise UnknownLayout('Not a number: ' + token)
+
+
+def _yaml_key(token):
+    token = token.strip()
+    if not token:
+        raise UnknownLayout('Empty key')
+    if token[0] in '\'"':
+        if len(token) < 2 or token[-1] != token[0] or token[0] in token[1:-1]:
+            raise UnknownLayout('Complex key: ' + token)
+        return token[1:-1]
+    if token[0] in '?&*!|>%@`{[':
+        raise UnknownLayout('Complex key: ' + token)
+    return token
+
+
+def scan_gold_solution(path):
+    """
+    Extract the score block and the location of the COMMENT section
+    of a GOLD solution (a mol2 file).
+
+    The file is memory-mapped and searched for byte markers: the COMMENT
+    section is located backwards from the end of the file and the score
+    block forwards from there, so the atoms and bonds sections are never
+    decoded. Only the three lines of the score block are.
+
+    Returns
+    -------
+    headers : list of str
+        Field names found after ``> <Gold.Score>``.
+    scores : list of float
+        Values for each of those fields.
+    comment : tuple of int
+        Byte offset and length of the ``@<TRIPOS>COMMENT`` section,
+        not including the section header.
+    """
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):  # empty files, exotic filesystems
+            buf = f.read()
+        try:
+            return _scan_gold_buffer(buf)
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+
+
+def _scan_gold_buffer(buf):
+    comment = buf.rfind(b'@<TRIPOS>COMMENT')
+    if comment == -1:
+        raise ValueError('@<TRIPOS>COMMENT section not found')
+    start = buf.find(b'\n', comment) + 1 or len(buf)
+    score = buf.find(b'> <Gold.Score>', comment)
+    if score == -1:
+        score = buf.find(b'> <Gold.Score>')
+    if score == -1:
+        raise ValueError('> <Gold.Score> block not found')
+    end = score
+    for _ in range(3):
+        end = buf.find(b'\n', end) + 1
+        if not end:
+            end = len(buf)
+            break
+    block = buf[score:end].splitlines()
+    headers = [_native(h) for h in block[1].split()]
+    scores = [float(v) for v in block[2].split()]
+    return headers, scores, (start, len(buf) - start)
+
+
+def scan_gold_solutions(paths, workers=None, chunksize=256):
+    """
+    Run :func:`scan_gold_solution` over `paths`, in a pool of processes.
+
+    Parameters
+    ----------
+    paths : list of str
+    workers : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+        Use 1 to scan in the current process.
+    chunksize : int, optional
+        Number of files sent to a worker at once.
+
+    Returns
+    -------
+    A list with the result of :func:`scan_gold_solution` for each
+    path, in the same order.
+    """
+    return map_in_pool(scan_gold_solution, paths, workers=workers, chunksize=chunksize)
+
+
+def map_in_pool(func, items, workers=None, chunksize=256):
+    """
+    ``[func(item) for item in items]``, computed in a pool of processes.
+
+    `func` must be a picklable, module-level function. Items are sent to
+    the workers in chunks of `chunksize`. If `workers` is 1, there is
+    only one chunk or a pool cannot be created, everything runs in the
+    current process.
+    """
+    items = list(items)
+    chunks = [(func, items[i:i + chunksize]) for i in range(0, len(items), chunksize)]
+    pool = None
+    if len(chunks) > 1:
+        pool = process_pool(workers)
+    if pool is None:
+        return [result for chunk in chunks for result in _map_chunk(chunk)]
+    try:
+        results = pool.map(_map_chunk, chunks, chunksize=1)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return [result for chunk in results for result in chunk]
+
+
+def process_pool(workers=None):
+    """
+    A :class:`multiprocessing.Pool` of `workers` processes (one per CPU
+    by default), or None if `workers` is 1 or a pool cannot be created.
+    """
+    if workers == 1:
+        return None
+    try:
+        return multiprocessing.Pool(workers)
+    except (OSError, ImportError, NotImplementedError):  # no fork or no semaphores
+        return None
+
+
+def _map_chunk(chunk):
+    func, items = chunk
+    return [func(item) for item in items]
+
+
+def extract_structures(path, destination, extensions=STRUCTURE_EXTENSIONS):
+    """
+    Extract the molecule files contained in a GaudiMM solution zip.
+
+    Only top-level members ending with one of `extensions` are
+    decompressed, straight from the archive to `destination`; the rest
+    of the archive is never read. Files already present in `destination`
+    with the expected size are not extracted again. Each file is written
+    to a temporary name and then renamed, so this can run concurrently
+    with itself (e.g. from a prefetching thread).
+
+    Returns
+    -------
+    names : list of str
+        Every member of the archive.
+    paths : list of str
+        The extracted molecule files, in archive order.
+
+    Raises
+    ------
+    zipfile.BadZipfile
+        If `path` is not a zip file.
+    """
+    paths = []
+    with zipfile.ZipFile(path) as z:
+        for info in structure_members(z, extensions):
+            target = os.path.join(destination, info.filename)
+            if not _has_size(target, info.file_size):
+                fd, tmp = tempfile.mkstemp('.part', dir=destination)
+                try:
+                    with z.open(info) as source, os.fdopen(fd, 'wb') as f:
+                        shutil.copyfileobj(source, f, 1 << 20)
+                except BaseException:
+                    os.remove(tmp)
+                    raise
+                try:
+                    os.rename(tmp, target)
+                except OSError:
+                    os.remove(tmp)
+                    # Windows does not overwrite on rename; fine if someone
+                    # else has just extracted it
+                    if not _has_size(target, info.file_size):
+                        raise
+            paths.append(target)
+        return z.namelist(), paths
+
+
+def structure_members(archive, extensions=STRUCTURE_EXTENSIONS):
+    """
+    Top-level members of an open :class:`zipfile.ZipFile` whose name
+    ends with one of `extensions`, as ``ZipInfo`` objects in archive order.
+    """
+    return [info for info in archive.infolist()
+            if '/' not in info.filename and info.filename.endswith(extensions)]
+
+
+def _has_size(path, size):
+    try:
+        return os.path.getsize(path) == size
+    except OSError:
+        return False
+
+
+def _native(s):
+    return s if isinstance(s, str) else s.decode('utf-8')
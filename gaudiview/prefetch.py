@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Background prefetching of solutions while browsing the table.
+
+Prefetch functions run in a worker thread, so they must not touch
+Chimera or Tk. They should only do the file work (decompressing,
+reading...) that the main thread would otherwise do on first visit.
+
+This module does not depend on Chimera.
+"""
+
+# Python
+from __future__ import print_function
+import threading
+# Internal dependencies
+from .cache import LRUCache
+
+
+class Prefetcher(object):
+
+    """
+    Calls ``func(key)`` in a background thread for the keys passed to
+    :meth:`request`, in order. A new request, or :meth:`cancel`, drops
+    whatever is still pending. Keys that were already prefetched are
+    skipped.
+
+    Parameters
+    ----------
+    func : callable
+        Takes a key. Exceptions are printed, not raised.
+    distance : int, optional
+        How many rows around the current one should be prefetched,
+        in each direction. 0 disables prefetching.
+    """
+
+    def __init__(self, func, distance=3, remember=4096):
+        self.func = func
+        self.distance = distance
+        self._pending = []
+        self._current = None
+        self._done = LRUCache(remember)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def request(self, keys):
+        """
+        Replace the pending keys with `keys`.
+        """
+        with self._condition:
+            self._pending = [key for key in keys if key not in self._done]
+            self._stopped = False
+            self._condition.notify()
+        if self._pending and (self._thread is None or not self._thread.is_alive()):
+            self._thread = threading.Thread(target=self._run, name='gaudiview-prefetch')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def cancel(self):
+        """
+        Drop pending keys. The one being processed, if any, is finished.
+        """
+        with self._condition:
+            del self._pending[:]
+
+    def busy(self, key):
+        """
+        Whether `key` is pending or being prefetched.
+        """
+        with self._condition:
+            return key == self._current or key in self._pending
+
+    def forget(self, key):
+        """
+        Mark `key` as not prefetched, so it can be requested again.
+        """
+        with self._condition:
+            self._done.pop(key, None)
+
+    def stop(self):
+        """
+        Cancel pending keys and let the worker thread exit.
+        """
+        with self._condition:
+            del self._pending[:]
+            self._stopped = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                key = self._current = self._pending.pop(0)
+            try:
+                self.func(key)
+            except Exception as e:
+                print('Could not prefetch {}: {}'.format(key, e))
+            else:
+                with self._condition:
+                    self._done[key] = True
+            finally:
+                with self._condition:
+                    self._current = None
+
+
+def neighbours(row, count, distance):
+    """
+    Rows around `row` in a table of `count` rows, closest first and
+    alternating next and previous: row+1, row-1, row+2, row-2...
+    """
+    rows = []
+    for offset in range(1, distance + 1):
+        for neighbour in (row + offset, row - offset):
+            if 0 <= neighbour < count:
+                rows.append(neighbour)
+    return rows
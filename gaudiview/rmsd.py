@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Batched RMSD kernels over stacks of coordinates.
+
+Every function takes (N, 3) arrays or (M, N, 3) stacks of poses of the
+same molecule, with atoms in the same order (see
+:meth:`gaudiview.coords.Structure.heavy_coords`). The RMSD is
+untransformed (poses compared in place, as docking solutions
+share the receptor frame) unless ``superpose=True``, which computes the
+RMSD after optimal superposition (Kabsch). A `symmetry` (see
+:mod:`gaudiview.symmetry`) makes every RMSD the lowest over the
+equivalent orderings of the atoms of the molecule.
+
+This module does not depend on Chimera.
+"""
+
+# Python
+from __future__ import division
+# External dependencies
+import numpy as np
+
+#: Maximum number of coordinates (pairs x atoms x 3) held in memory at
+#: once by :func:`rmsd_many_to_many`
+BLOCK_SIZE = 1 << 22
+
+
+def rmsd(reference, probe, superpose=False, symmetry=None):
+    """
+    RMSD between two (N, 3) arrays of coordinates.
+    """
+    return float(rmsd_one_to_many(reference, probe[np.newaxis], superpose=superpose,
+                                  symmetry=symmetry)[0])
+
+
+def rmsd_one_to_many(reference, probes, superpose=False, symmetry=None):
+    """
+    RMSD between a (N, 3) `reference` and each of the (M, N, 3) `probes`.
+
+    Returns
+    -------
+    (M,) float64 array
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    probes = np.asarray(probes, dtype=np.float64)
+    if probes.ndim != 3 or probes.shape[1:] != reference.shape:
+        raise ValueError('Shapes do not match: {} and {}'.format(reference.shape,
+                                                                  probes.shape))
+    if superpose or symmetry is not None:
+        return rmsd_pairs(np.repeat(reference[np.newaxis], len(probes), axis=0), probes,
+                          superpose=superpose, symmetry=symmetry)
+    diff = probes - reference
+    return np.sqrt((diff * diff).sum(axis=2).mean(axis=1))
+
+
+def rmsd_pairs(first, second, superpose=False, symmetry=None):
+    """
+    RMSD between the pairs of poses of two (M, N, 3) stacks.
+
+    Returns
+    -------
+    (M,) float64 array
+    """
+    if symmetry is not None:
+        return symmetry.rmsd_pairs(first, second, superpose=superpose)
+    if superpose:
+        return _kabsch_rmsd(first, second)
+    diff = second - first
+    return np.sqrt((diff * diff).sum(axis=2).mean(axis=1))
+
+
+def rmsd_many_to_many(first, second=None, superpose=False, block_size=None, symmetry=None):
+    """
+    RMSD between each pose in `first` and each pose in `second`, both
+    (M, N, 3) stacks. If `second` is None, `first` is compared with itself.
+    Pairs are computed in blocks of, at most, `block_size` coordinates
+    (:data:`BLOCK_SIZE` by default), so memory stays bounded.
+
+    Returns
+    -------
+    (len(first), len(second)) float64 array
+    """
+    first = np.asarray(first, dtype=np.float64)
+    second = first if second is None else np.asarray(second, dtype=np.float64)
+    if first.ndim != 3 or first.shape[1:] != second.shape[1:]:
+        raise ValueError('Shapes do not match: {} and {}'.format(first.shape, second.shape))
+    result = np.empty((len(first), len(second)))
+    pose_size = max(1, first.shape[1] * 3)
+    if symmetry is not None:
+        pose_size *= symmetry.size
+    rows = max(1, (block_size or BLOCK_SIZE) // (pose_size * max(1, len(second))))
+    for start in range(0, len(first), rows):
+        block = first[start:start + rows]
+        if superpose or symmetry is not None:
+            a = np.repeat(block, len(second), axis=0)
+            b = np.tile(second, (len(block), 1, 1))
+            values = rmsd_pairs(a, b, superpose=superpose, symmetry=symmetry)
+            values = values.reshape(len(block), len(second))
+        else:
+            diff = block[:, np.newaxis] - second[np.newaxis]
+            values = np.sqrt((diff * diff).sum(axis=3).mean(axis=2))
+        result[start:start + len(block)] = values
+    return result
+
+
+def _kabsch_rmsd(first, second):
+    """
+    Superposed RMSD between the pairs of poses in two (M, N, 3) stacks.
+    Only the singular values of the covariance matrices are needed,
+    not the rotations themselves.
+    """
+    # Which of the two poses comes first must not change the result, not
+    # even the last bit, so the RMSD matrix is symmetric and cached RMSDs
+    # (see gaudiview.neighbours) are interchangeable with fresh ones.
+    # Swapping the poses transposes the covariance matrix, so it is
+    # transposed back for the pairs whose first pose is the "larger" one.
+    swap = is_larger(first, second)
+    first = first - first.mean(axis=1)[:, np.newaxis]
+    second = second - second.mean(axis=1)[:, np.newaxis]
+    covariance = (first[:, :, :, np.newaxis] * second[:, :, np.newaxis, :]).sum(axis=1)
+    covariance[swap] = covariance[swap].transpose(0, 2, 1)
+    singular = np.linalg.svd(covariance, compute_uv=False)
+    # Reflections are not allowed: flip the smallest singular value
+    singular[:, -1] *= np.where(np.linalg.det(covariance) < 0, -1, 1)
+    squares = (first * first).sum(axis=(1, 2)) + (second * second).sum(axis=(1, 2))
+    msd = (squares - 2 * singular.sum(axis=1)) / first.shape[1]
+    return np.sqrt(np.maximum(msd, 0))
+
+
+class PoseStack(object):
+
+    """
+    Growable (M, N, 3) stack of poses, to compare new poses against all
+    the previous ones in a single call. Storage doubles when full, so
+    appending is amortized O(N).
+
+    Parameters
+    ----------
+    capacity : int, optional
+        Initial number of poses that fit without growing.
+    """
+
+    def __init__(self, capacity=16):
+        self._capacity = capacity
+        self._data = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, pose):
+        if self._data is None:
+            self._data = np.empty((self._capacity,) + np.shape(pose))
+        elif self._size == len(self._data):
+            grown = np.empty((2 * len(self._data),) + self._data.shape[1:])
+            grown[:self._size] = self._data
+            self._data = grown
+        self._data[self._size] = pose
+        self._size += 1
+
+    @property
+    def poses(self):
+        """
+        (M, N, 3) view of the stored poses. Appending may invalidate it.
+        """
+        if self._data is None:
+            return np.empty((0, 0, 3))
+        return self._data[:self._size]
+
+
+def is_larger(first, second):
+    """
+    Total order between the pairs of poses of two stacks, used to put
+    each pair in a canonical order.
+    """
+    a, b = first[:, 0, 0], second[:, 0, 0]
+    sum_a, sum_b = first.sum(axis=(1, 2)), second.sum(axis=(1, 2))
+    return (a > b) | ((a == b) & (sum_a > sum_b))
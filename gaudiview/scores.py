@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Persistent cache of rescoring results.
+
+Scores are stored in a SQLite database in the user's home
+(:data:`PATH`), under a key that only depends on contents: the receptor
+file, the ligand file, the objective and its options (see
+:func:`score_key`). Rescoring the same poses again, from the same file
+reopened later or from a copy of it, reads the scores back instead of
+computing them.
+
+Errors (no SQLite, read-only home, locked or corrupt database...) are
+not fatal: the cache is just skipped.
+
+This module does not depend on Chimera.
+"""
+
+# Python
+from __future__ import print_function
+import hashlib
+import json
+import math
+import os
+try:
+    import sqlite3
+except ImportError:  # Python built without SQLite
+    sqlite3 = None
+# Own
+from gaudiview.cache import LRUCache
+
+PATH = os.path.join(os.path.expanduser('~'), '.gaudiview', 'scores.sqlite')
+ENABLED = True
+#: Keys looked up per query, below SQLite's limit of variables
+BATCH_SIZE = 500
+
+_DIGESTS = LRUCache(4096)  # (path, size, mtime) -> digest
+
+
+def file_digest(path):
+    """
+    SHA-1 of the contents of `path`. Remembered while the file keeps its
+    size and modification time, since the same receptor is hashed for
+    every pose.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    digest = _DIGESTS.get(key)
+    if digest is None:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        digest = _DIGESTS[key] = sha1.hexdigest()
+    return digest
+
+
+def score_key(receptor, ligand, objective, options=None):
+    """
+    Key of the score of the `ligand` file against the `receptor` file
+    with `objective` (a name) and its `options` (a JSON-like dict; key
+    order and tuples vs lists do not matter).
+    """
+    normalized = json.dumps(options or {}, sort_keys=True, default=repr)
+    payload = '\0'.join([file_digest(receptor), file_digest(ligand), objective, normalized])
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class ScoreCache(object):
+
+    """
+    Scores by :func:`score_key`. The database is opened on first use,
+    so instances can be created before forking workers.
+
+    Parameters
+    ----------
+    path : str, optional
+        SQLite database, :data:`PATH` by default.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or PATH
+        self._connection = None
+        self.enabled = ENABLED and sqlite3 is not None
+
+    def get_many(self, keys):
+        """
+        Cached scores of `keys`, as a dict with the keys found.
+        """
+        keys = list(keys)
+        found = {}
+        connection = self._connect()
+        if connection is None:
+            return found
+        try:
+            for start in range(0, len(keys), BATCH_SIZE):
+                batch = keys[start:start + BATCH_SIZE]
+                found.update(connection.execute(
+                    'SELECT key, score FROM scores WHERE key IN ({})'.format(
+                        ','.join('?' * len(batch))), batch))
+        except sqlite3.Error:
+            self._disable()
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items):
+        """
+        Store ``(key, score)`` pairs, all in one transaction.
+        """
+        rows = []
+        for key, score in items:
+            try:
+                score = float(score)
+            except (TypeError, ValueError):  # not a number, not cached
+                continue
+            if math.isinf(score) or math.isnan(score):  # SQLite stores NaN as NULL
+                continue
+            rows.append((key, score))
+        connection = self._connect()
+        if connection is None or not rows:
+            return
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO scores (key, score) VALUES (?, ?)', rows)
+        except sqlite3.Error:
+            self._disable()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _connect(self):
+        if self._connection is not None or not self.enabled:
+            return self._connection
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.path, timeout=10)
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS scores '
+                                   '(key TEXT PRIMARY KEY, score REAL NOT NULL)')
+        except (OSError, sqlite3.Error) as e:
+            print('Score cache disabled:', e)
+            self.enabled = False
+            return None
+        self._connection = connection
+        return connection
+
+    def _disable(self):
+        self.close()
+        self.enabled = False
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+##############
+# GAUDIView: Light interface to explore
+# solutions from GaudiMM and more
+# Authors:  Jaime Rodriguez-Guerra Pedregal
+#            <jaime.rodriguezguerra@uab.cat>
+#           Jean-Didier Marechal
+#            <jeandidier.marechal@uab.cat>
+# Web: https://github.com/insilichem/gaudiview
+##############
+
+"""
+Symmetry-corrected RMSD.
+
+Atoms that are equivalent in the molecular graph (the two oxygens of a
+carboxylate, the ortho and meta carbons of a phenyl ring...) can swap
+places between two poses that are otherwise identical. Comparing the
+atoms in file order then inflates the RMSD. Here, the automorphisms of
+the graph of heavy atoms are enumerated once per topology, and the RMSD
+is the lowest over all of them.
+
+Topologies with more than :data:`MAX_AUTOMORPHISMS` automorphisms fall
+back to the best assignment (Hungarian algorithm) between atoms of the
+same class of equivalence, which needs SciPy. For in-place RMSD, this is
+a lower bound of the symmetry-corrected RMSD. After superposition, it is
+not even a metric (see :meth:`Symmetry.metric`). Without SciPy, these
+topologies are compared without symmetry correction.
+
+This module does not depend on Chimera.
+"""
+
+# Python
+from __future__ import division, print_function
+# External dependencies
+import numpy as np
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+# Own
+from gaudiview.rmsd import BLOCK_SIZE, is_larger, rmsd_pairs
+
+#: Automorphisms enumerated per topology, at most. Each one costs an
+#: RMSD evaluation per pair of poses.
+MAX_AUTOMORPHISMS = 256
+#: Search steps allowed, per automorphism and atom, before giving up
+SEARCH_STEPS = 64
+
+_SYMMETRIES = {}
+_warned = False
+
+
+class Symmetry(object):
+
+    """
+    Equivalent orderings of the atoms of a molecule.
+
+    Parameters
+    ----------
+    permutations : (K, N) int array, optional
+        Every automorphism, the identity included.
+    classes : list of int arrays, optional
+        Atoms that may be equivalent, used instead of `permutations`
+        when there are too many of them.
+    """
+
+    def __init__(self, permutations=None, classes=None):
+        self.permutations = None
+        if permutations is not None:
+            self.permutations = np.asarray(permutations, dtype=np.intp)
+        self.classes = [np.asarray(atoms, dtype=np.intp) for atoms in classes or ()]
+
+    @property
+    def size(self):
+        """
+        RMSD evaluations per pair of poses.
+        """
+        return 1 if self.permutations is None else len(self.permutations)
+
+    def metric(self, superpose=False):
+        """
+        Whether the corrected RMSD obeys the triangle inequality, which
+        the lower bounds used to prune RMSDs rely on. The best assignment
+        is made before rotating, so it does not after superposition.
+        """
+        return self.permutations is not None or not superpose
+
+    def rmsd_pairs(self, first, second, superpose=False):
+        """
+        Symmetry-corrected RMSD between the pairs of poses of two
+        (M, N, 3) stacks. See :func:`gaudiview.rmsd.rmsd_pairs`.
+        """
+        first = np.asarray(first, dtype=np.float64)
+        second = np.asarray(second, dtype=np.float64)
+        # Each pair is put in a canonical order, so which pose comes
+        # first does not change the result, not even the last bit
+        swap = is_larger(first, second)[:, np.newaxis, np.newaxis]
+        first, second = np.where(swap, second, first), np.where(swap, first, second)
+        if self.permutations is None:
+            return self._assigned(first, second, superpose)
+        n_perms, n_atoms = self.permutations.shape
+        result = np.empty(len(first))
+        rows = max(1, BLOCK_SIZE // (n_perms * n_atoms * 3))
+        for start in range(0, len(first), rows):
+            stop = min(start + rows, len(first))
+            permuted = first[start:stop][:, self.permutations].reshape(-1, n_atoms, 3)
+            values = rmsd_pairs(permuted, np.repeat(second[start:stop], n_perms, axis=0),
+                                superpose=superpose)
+            result[start:stop] = values.reshape(-1, n_perms).min(axis=1)
+        return result
+
+    def _assigned(self, first, second, superpose):
+        result = rmsd_pairs(first, second, superpose=superpose)
+        if linear_sum_assignment is None or not self.classes:
+            return result
+        for m in range(len(first)):
+            a, b = first[m], second[m]
+            if superpose:  # assigned after centering, not after rotating
+                a, b = a - a.mean(axis=0), b - b.mean(axis=0)
+            order = np.arange(len(a))
+            for atoms in self.classes:
+                delta = a[atoms][:, np.newaxis] - b[atoms][np.newaxis]
+                rows, cols = linear_sum_assignment((delta * delta).sum(axis=2))
+                order[atoms[cols]] = atoms[rows]
+            value = rmsd_pairs(first[m][order][np.newaxis], second[m][np.newaxis],
+                               superpose=superpose)[0]
+            result[m] = min(result[m], value)
+        return result
+
+
+def topology_symmetry(structure, limit=None):
+    """
+    :func:`symmetry_of` the heavy atoms of a
+    :class:`gaudiview.coords.Structure`, computed once per topology.
+    """
+    try:
+        return _SYMMETRIES[structure.signature]
+    except KeyError:
+        elements, bonds = structure.heavy_graph()
+        symmetry = _SYMMETRIES[structure.signature] = symmetry_of(elements, bonds, limit)
+        return symmetry
+
+
+def symmetry_of(elements, bonds, limit=None):
+    """
+    :class:`Symmetry` of a molecular graph, or None if it has none (or
+    no bonds to tell).
+    """
+    global _warned
+    if not len(bonds):
+        return None
+    permutations = automorphisms(elements, bonds, limit)
+    if permutations is None:
+        if linear_sum_assignment is None:
+            if not _warned:
+                print('Symmetry correction disabled for molecules with more than',
+                      limit or MAX_AUTOMORPHISMS, 'automorphisms: SciPy is not installed')
+                _warned = True
+            return None
+        return Symmetry(classes=[atoms for atoms in equivalence_classes(elements, bonds)
+                                 if len(atoms) > 1])
+    if len(permutations) == 1:
+        return None
+    return Symmetry(permutations)
+
+
+def equivalence_classes(elements, bonds):
+    """
+    Classes of atoms that cannot be told apart by their element and
+    those of their neighbours, at any distance (colour refinement).
+    Atoms swapped by an automorphism are always in the same class.
+    """
+    colours = _refine(elements, _neighbours(len(elements), bonds))
+    classes = {}
+    for atom, colour in enumerate(colours):
+        classes.setdefault(colour, []).append(atom)
+    return [np.array(atoms) for (colour, atoms) in sorted(classes.items())]
+
+
+def automorphisms(elements, bonds, limit=None):
+    """
+    Every permutation of the atoms that preserves elements and bonds
+    (the identity included), as a (K, N) int array. None if
+    there are more than `limit` (:data:`MAX_AUTOMORPHISMS` by default)
+    or they take too long to find.
+    """
+    if limit is None:
+        limit = MAX_AUTOMORPHISMS
+    n = len(elements)
+    neighbours = _neighbours(n, bonds)
+    colours = _refine(elements, neighbours)
+    candidates = {}
+    for atom, colour in enumerate(colours):
+        candidates.setdefault(colour, []).append(atom)
+    order = _search_order(colours, neighbours, candidates)
+    mapping = [-1] * n
+    used = [False] * n
+    found = []
+    budget = [SEARCH_STEPS * limit * max(n, 1)]
+
+    def extend(depth):
+        if depth == n:
+            found.append(list(mapping))
+            return len(found) <= limit
+        atom = order[depth]
+        mapped = [mapping[j] for j in neighbours[atom] if mapping[j] >= 0]
+        for candidate in candidates[colours[atom]]:
+            budget[0] -= 1
+            if budget[0] < 0:
+                return False
+            if used[candidate] or not all(image in neighbours[candidate] for image in mapped):
+                continue
+            # No bonds to mapped atoms other than the images of its neighbours
+            if sum(used[j] for j in neighbours[candidate]) != len(mapped):
+                continue
+            mapping[atom], used[candidate] = candidate, True
+            complete = extend(depth + 1)
+            mapping[atom], used[candidate] = -1, False
+            if not complete:
+                return False
+        return True
+
+    if not extend(0):
+        return None
+    return np.array(found, dtype=np.intp).reshape(-1, n)
+
+
+def _neighbours(n, bonds):
+    neighbours = [set() for _ in range(n)]
+    for a, b in np.asarray(bonds).reshape(-1, 2).tolist():
+        if a != b:
+            neighbours[a].add(b)
+            neighbours[b].add(a)
+    return neighbours
+
+
+def _refine(elements, neighbours):
+    """
+    Colour of each atom: its element, refined with the colours of its
+    neighbours until the number of colours no longer grows.
+    """
+    colours = _relabel([(element, len(bonded)) for (element, bonded)
+                        in zip(elements, neighbours)])
+    while True:
+        refined = _relabel([(colours[atom], tuple(sorted(colours[j] for j in bonded)))
+                            for (atom, bonded) in enumerate(neighbours)])
+        if len(set(refined)) == len(set(colours)):
+            return refined
+        colours = refined
+
+
+def _relabel(values):
+    labels = dict((value, i) for (i, value) in enumerate(sorted(set(values))))
+    return [labels[value] for value in values]
+
+
+def _search_order(colours, neighbours, candidates):
+    """
+    Atoms in the order they are mapped: breadth-first from the atom
+    with the fewest candidates, so that the neighbours mapped before
+    each atom restrict its candidates as much as possible.
+    """
+    order, seen = [], set()
+    for start in sorted(range(len(colours)), key=lambda atom: len(candidates[colours[atom]])):
+        if start in seen:
+            continue
+        seen.add(start)
+        queue = [start]
+        while queue:
+            atom = queue.pop(0)
+            order.append(atom)
+            for j in sorted(neighbours[atom], key=lambda j: len(candidates[colours[j]])):
+                if j not in seen:
+                    seen.add(j)
+                    queue.append(j)
+    return order
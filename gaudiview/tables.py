@@ -11,6 +11,7 @@
 ##############
 
 import sys
+import math
 import Pmw
 
 # External dependencies
@@ -20,9 +21,181 @@ from tkintertable.Tables import TableCanvas, ColumnHeader, RowHeader, AutoScroll
 from tkintertable.Filtering import *
 from tkintertable.TableModels import TableModel
 from tkintertable.Tables_IO import TableImporter
+# External dependencies
+import numpy as np
+# Internal dependencies
+from .columns import ColumnStore, filter_mask, FILTER_OPERATORS, BOOLEAN_OPERATORS
+
+
+class ColumnarTableModel(TableModel):
+
+    """
+    A tkintertable model whose data lives in a :class:`ColumnStore`.
+
+    ``model.data`` is the store itself, so ``data[key][column]`` keeps
+    working, but no per-row dicts are built or copied.
+    """
+
+    def __init__(self, store):
+        self.initialiseFields()
+        if not isinstance(store, ColumnStore):
+            store = ColumnStore.from_dict(store)
+        self.data = store
+        self.columnNames = list(store.columns)
+        # importDict used to add every column as 'text', which displays
+        # the raw value; keep it that way
+        self.columntypes = dict((name, 'text') for name in self.columnNames)
+        self.columnlabels = dict((name, name) for name in self.columnNames)
+        self.columnOrder = None
+        self.default_display = {'text': 'showstring', 'number': 'numtostring'}
+        self.sortkey = self.columnNames[0] if self.columnNames else None
+        # Rows are never reordered in the store. Instead, `order` holds the
+        # store row numbers in sort order, and `view` the subset of `order`
+        # that passes the current filter, if any.
+        self.order = np.arange(len(store))
+        self._mask = None
+        self.view = self.order
+        self._positions = None
+        # (column, reverse) pairs, most significant first
+        self.sortkeys = []
+
+    @property
+    def reclist(self):
+        """Record keys, in sort order. Built on demand."""
+        key_at = self.data.key_at
+        return [key_at(i) for i in self.order]
+
+    @property
+    def filteredrecs(self):
+        """Record keys that pass the current filter, or None."""
+        if self._mask is None:
+            return None
+        key_at = self.data.key_at
+        return [key_at(i) for i in self.view]
+
+    @filteredrecs.setter
+    def filteredrecs(self, names):
+        if names is None:
+            self.setFilterMask(None)
+        else:
+            mask = np.zeros(len(self.data), dtype=bool)
+            rows = [self.data.row_index(name) for name in names]
+            mask[np.array(rows, dtype=int)] = True
+            self.setFilterMask(mask)
+
+    def setFilterMask(self, mask):
+        """
+        Show only the store rows where `mask` is True (all, if None).
+        """
+        self._mask = mask
+        self._update_view()
+
+    def filterBy(self, filtercol, value, op='contains', userecnames=False,
+                 progresscallback=None):
+        """
+        Keys of the records that pass one filter, in sort order. Kept for
+        tkintertable's doFiltering; Table.doFilter uses masks directly.
+        """
+        mask = self.data.mask(filtercol, op, value)
+        key_at = self.data.key_at
+        return [key_at(i) for i in self.order[mask[self.order]]]
+
+    def _update_view(self):
+        if self._mask is None:
+            self.view = self.order
+        else:
+            self.view = self.order[self._mask[self.order]]
+        self._positions = None
+
+    @property
+    def positions(self):
+        """
+        Inverse of `view`: table row of each store row, or -1 if it is
+        filtered out. Built lazily after each sort or filter.
+        """
+        if self._positions is None:
+            positions = np.full(len(self.data), -1, dtype=np.intp)
+            positions[self.view] = np.arange(len(self.view))
+            self._positions = positions
+        return self._positions
+
+    def getRowCount(self):
+        return len(self.view)
+
+    def getRecName(self, rowIndex):
+        if not len(self.view):
+            return None
+        return self.data.key_at(self.view[rowIndex])
+
+    def getRecordIndex(self, recname):
+        try:
+            row = self.data.row_index(recname)
+        except (KeyError, TypeError):
+            raise ValueError('{} is not in table'.format(recname))
+        position = self.positions[row]
+        if position < 0:
+            raise ValueError('{} is not in table'.format(recname))
+        return int(position)
+
+    def setSortOrder(self, columnIndex=None, columnName=None, reverse=0):
+        """
+        Sort by a column. Previous sort columns are kept as tie breakers,
+        as successive stable sorts would do, and the whole order is
+        computed with one lexsort over cached per-column indexes.
+        Only the row-order index changes; the store is left untouched.
+        """
+        if columnName is not None and columnName in self.columnNames:
+            self.sortkey = columnName
+        elif columnIndex is not None:
+            self.sortkey = self.getColumnName(columnIndex)
+        else:
+            return
+        self.sortkeys = [(self.sortkey, bool(reverse))] + \
+            [(name, rev) for (name, rev) in self.sortkeys if name != self.sortkey]
+        self.order = self.data.lexsort(self.sortkeys)
+        self._update_view()
+
+    def getCellRecord(self, rowIndex, columnIndex):
+        return self.data.get_value(self.data.row_index(self.getRecName(rowIndex)),
+                                   self.getColumnName(columnIndex))
+
+    def getRecordAttributeAtColumn(self, rowIndex=None, columnIndex=None,
+                                   recName=None, columnName=None):
+        if recName is None:
+            recName = self.getRecName(rowIndex)
+        if columnName is None:
+            columnName = self.getColumnName(columnIndex)
+        try:
+            value = self.data.get_value(self.data.row_index(recName), columnName)
+        except KeyError:
+            return ''
+        return '' if value is None else value
+
+    def getlongestEntry(self, columnIndex):
+        return max(5, self.data.longest(self.getColumnName(columnIndex)))
+
+    def addColumn(self, colname=None, coltype=None):
+        if colname is None:
+            colname = str(self.getColumnCount() + 1)
+        self.data.add_column(colname)
+        TableModel.addColumn(self, colname, coltype)
 
 
 class Table(TableCanvas):
+
+    """
+    Results table. Only the rows in sight (plus `overscan` rows above and
+    below) have canvas items, and those items are reused while scrolling,
+    sorting or filtering, so redrawing costs the same for 100 or 1M rows.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # Pool of reusable canvas items: one (stripe, gridline,
+        # [text per column]) tuple per row slot
+        self._slots = []
+        self._slot_cols = None
+        TableCanvas.__init__(self, *args, **kwargs)
+
     def set_defaults(self):
         """Set default settings"""
         self.cellwidth = 60
@@ -31,6 +204,7 @@ class Table(TableCanvas):
         self.horizlines = 1
         self.vertlines = 0
         self.alternaterows = 1
+        self.alternaterowcolor = "#E4E4E4"
         self.autoresizecols = 1
         self.inset = 2
         self.x_start = 0
@@ -45,6 +219,141 @@ class Table(TableCanvas):
         self.selectedcolor = "yellow"
         self.rowselectedcolor = "#DDDDDD"
         self.multipleselectioncolor = "#DDDDDD"
+        self.overscan = 5
+
+    def redrawVisible(self, event=None, callback=None):
+        """
+        Redraw the visible portion of the canvas.
+
+        tkintertable deletes and recreates every cell item on each call.
+        Here, a pool of row slots is kept and only their position, text
+        and color are updated.
+        """
+        model = self.model
+        self.rows = model.getRowCount()
+        self.cols = model.getColumnCount()
+        if self.cols == 0 or self.rows == 0:
+            self._clear_slots()
+            self.delete("vline")
+            self.delete("entry")
+            self.delete("rowrect")
+            self.delete("currentrect")
+            return
+        self.configure(bg=self.cellbackgr)
+        self.setColPositions()
+        self.rowrange = xrange(self.rows)
+        self.configure(scrollregion=(0, 0, self.tablewidth + self.x_start,
+                                     self.rowheight * self.rows + 10))
+
+        x1, y1, x2, y2 = self.getVisibleRegion()
+        startrow, endrow = self.getVisibleRows(y1, y2)
+        self.visiblerows = range(startrow, endrow)
+        self.visiblecols = range(*self.getVisibleCols(x1, x2))
+        self.delete("fillrect")
+        first, last = max(0, startrow - self.overscan), min(self.rows, endrow + self.overscan)
+        self._draw_slots(first, last, callback)
+        self._draw_vertical_lines(first, last)
+
+        self.tablecolheader.redraw()
+        self.tablerowheader.redraw(align=self.align, showkeys=self.showkeynamesinheader)
+        self.drawSelectedRow()
+        if len(self.multiplerowlist) > 1:
+            self.tablerowheader.drawSelectedRows(self.multiplerowlist)
+            self.drawMultipleRows(self.multiplerowlist)
+        self.lower("stripe")
+
+    def _draw_slots(self, first, last, callback=None):
+        """
+        Fill the row slots with rows `first` to `last` (not included),
+        creating slots if needed and hiding the ones left over.
+        """
+        model = self.model
+        ncols = self.cols
+        if self._slot_cols != ncols or (self._slots and not self.type(self._slots[0][1])):
+            # Columns changed or someone deleted our items: start over
+            self._clear_slots()
+            self._slot_cols = ncols
+        while len(self._slots) < last - first:
+            stripe = self.create_rectangle(0, 0, 0, 0, fill=self.alternaterowcolor,
+                                           outline="", tag="stripe")
+            line = self.create_line(0, 0, 0, 0, fill=self.grid_color,
+                                    width=self.linewidth, tag="gridline")
+            texts = [self.create_text(0, 0, text="", font=self.thefont, tag="text")
+                     for _ in range(ncols)]
+            self._slots.append((stripe, line, texts))
+
+        h = self.rowheight
+        positions = self.col_positions
+        anchor = self.align if self.align in ("w", "e") else "center"
+        # tkintertable stores pixel font sizes as negative numbers
+        scale = 8.5 * abs(float(self.fontsize)) / 12
+        visible = set(self.visiblecols)
+        for k, (stripe, line, texts) in enumerate(self._slots):
+            row = first + k
+            if row >= last:
+                for item in [stripe, line] + texts:
+                    self.itemconfigure(item, state="hidden")
+                continue
+            if callback is not None:
+                callback()
+            y = self.y_start + row * h
+            self.coords(stripe, self.x_start, y, self.tablewidth, y + h)
+            self.itemconfigure(stripe, state="normal" if self.alternaterows and row % 2
+                               else "hidden")
+            self.coords(line, self.x_start, y + h, self.tablewidth, y + h)
+            self.itemconfigure(line, state="normal" if self.horizlines else "hidden")
+            for col, item in enumerate(texts):
+                if col not in visible:
+                    self.itemconfigure(item, state="hidden")
+                    continue
+                x1, x2 = positions[col], positions[col + 1]
+                w = x2 - x1
+                if anchor == "w":
+                    x = x1 + 1
+                elif anchor == "e":
+                    x = x2 - 1
+                else:
+                    x = x1 + w / 2.0
+                text = self._cell_text(model.getValueAt(row, col), w, scale)
+                self.coords(item, x, y + h / 2.0)
+                self.itemconfigure(item, text=text, anchor=anchor, state="normal",
+                                   fill=model.getColorAt(row, col, "fg") or "black")
+                bgcolor = model.getColorAt(row, col, "bg")
+                if bgcolor is not None:
+                    self.drawRect(row, col, color=bgcolor)
+
+    def _draw_vertical_lines(self, first, last):
+        """
+        Column separators, over the rows with slots, if `vertlines` is set.
+        """
+        self.delete("vline")
+        if not self.vertlines:
+            return
+        y1, y2 = self.y_start + first * self.rowheight, self.y_start + last * self.rowheight
+        edges = set(self.col_positions[col + side] for col in self.visiblecols
+                    for side in (0, 1))
+        for x in sorted(edges):
+            self.create_line(x, y1, x, y2, fill=self.grid_color,
+                             width=self.linewidth, tag=("gridline", "vline"))
+
+    @staticmethod
+    def _cell_text(value, width, scale):
+        """Truncate cell contents to fit, like TableCanvas.drawText"""
+        if isinstance(value, (float, int, long)):
+            value = str(value)
+        if not value or width <= 10:
+            return ""
+        if width < 15:
+            return "."
+        if len(value) * scale > width:
+            value = value[:int(math.floor(width / scale))]
+        return value
+
+    def _clear_slots(self):
+        for stripe, line, texts in self._slots:
+            self.delete(stripe, line, *texts)
+        self._slots = []
+        self._slot_cols = None
 
     def adjustColumnWidths(self):
         """Optimally adjust col widths to accomodate the longest entry
@@ -196,22 +505,31 @@ class Table(TableCanvas):
 
     def doFilter(self, event=None):
         """Filter the table display by some column values.
-        We simply pass the model search function to the the filtering
-        class and that handles everything else.
-        See filtering frame class for how searching is done.
+        Each filter bar is evaluated as a boolean mask over a whole
+        column and the masks are combined with bitwise operations
+        (see :func:`gaudiview.columns.filter_mask`).
         """
         if self.model is None:
             return
-        names = self.filterframe.doFiltering(searchfunc=self.model.filterBy)
-        if not names:
+        filters = [f.getFilter() for f in self.filterframe.filters]
+        mask = filter_mask(self.model.data, filters)
+        matches = int(np.count_nonzero(mask))
+        self.filterframe.updateResults(matches)
+        if not matches:
             self.filtered = False
             return
-        # create a list of filtered recs
-        self.model.filteredrecs = names
+        self.model.setFilterMask(mask)
         self.filtered = True
+        self.gaudiparent.triggers.activateTrigger(self.gaudiparent.ORDER_CHANGED, None)
         self.redrawTable()
         return
 
+    def showAll(self):
+        self.model.setFilterMask(None)
+        self.filtered = False
+        self.gaudiparent.triggers.activateTrigger(self.gaudiparent.ORDER_CHANGED, None)
+        self.redrawTable()
+
     def setSelectedRow(self, row):
         """Set currently selected row and reset multiple row list"""
         self.currentrow = row
@@ -248,6 +566,7 @@ class Table(TableCanvas):
         )
         self.lower("rowrect")
         self.lower("fillrect")
+        self.lower("stripe")
         self.tablerowheader.drawSelectedRows(self.currentrow)
 
     def drawMultipleRows(self, rowlist):
@@ -259,6 +578,7 @@ class Table(TableCanvas):
             self.drawSelectedRow(r)
         self.lower("multiplesel")
         self.lower("fillrect")
+        self.lower("stripe")
         return
 
 
@@ -332,9 +652,13 @@ class Headers(ColumnHeader):
             self.columnlabels[sortkey] = "{} {}".format(
                 (u"\u25B2", u"\u25BC")[int(self.reversedcols[sortkey])], sortkey
             )
-            self.table.sortTable(self.table.currentcol, reverse=self.reversedcols[sortkey])
-            self.table.currentrow = self.table.model.getRecordIndex(former_selected_row)
-            self.table.drawSelectedRow()
+            self.model.setSortOrder(self.table.currentcol, reverse=self.reversedcols[sortkey])
+            gaudiparent = self.table.gaudiparent
+            gaudiparent.triggers.activateTrigger(gaudiparent.ORDER_CHANGED, None)
+            try:
+                self.table.currentrow = self.model.getRecordIndex(former_selected_row)
+            except ValueError:  # nothing was selected
+                pass
             self.table.redrawTable()
 
 
@@ -389,8 +713,8 @@ class FilterBar_(FilterBar):
 
     """Class providing filter widgets"""
 
-    operators = ["=", "!=", ">", "<", ">=", "<=", "contains"]
-    booleanops = ["AND", "OR", "NOT"]
+    operators = list(FILTER_OPERATORS)
+    booleanops = list(BOOLEAN_OPERATORS)
 
     def __init__(self, parent, index, fields):
         Frame.__init__(self, parent)